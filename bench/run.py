@@ -0,0 +1,336 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Benchmark harness for the ioboxd export and retrieval endpoints.
+
+   The ioboxd application from this source tree is run in a separate, multi-threaded WSGI server process against a
+   stub ERMrest catalog and hatrac store of synthetic data (see stub_ermrest.py), and each scenario is run at each of
+   the requested client concurrency levels. The server process is restarted for every scenario, so that its memory
+   high-water mark is attributable to that scenario.
+
+   Results are written as JSON, one record per scenario and concurrency level, with request latency percentiles,
+   throughput, bytes transferred, error count and the server's peak resident memory.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import datetime
+import platform
+import tempfile
+import threading
+import subprocess
+import requests
+
+import stub_ermrest
+
+SCENARIOS = ["export_file", "export_bag", "export_assets", "retrieve_small", "retrieve_large"]
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def parse_size(value):
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def rss_high_water(pid):
+    """Return the peak resident set size of a process in bytes, or None where /proc is not available."""
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class ServiceProcess(object):
+    """An ioboxd server process, with its own service configuration and storage directory."""
+
+    def __init__(self, workdir, service_config):
+        self.home = os.path.join(workdir, "home")
+        self.storage_path = os.path.join(workdir, "storage")
+        self.port = free_port()
+        self.url = "http://127.0.0.1:%d" % self.port
+        self.process = None
+        if not os.path.isdir(self.home):
+            os.makedirs(self.home)
+        config = dict(service_config)
+        config["storage_path"] = self.storage_path
+        with open(os.path.join(self.home, "ioboxd_config.json"), "w") as config_file:
+            json.dump(config, config_file, indent=2)
+
+    def start(self, timeout=30):
+        server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+        self.process = subprocess.Popen([sys.executable, server, self.home, str(self.port)])
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("The ioboxd server exited with status %s" % self.process.returncode)
+            try:
+                requests.get(self.url + "/metrics", timeout=1)
+                return
+            except requests.exceptions.RequestException:
+                time.sleep(0.1)
+        raise RuntimeError("The ioboxd server did not start within %d seconds" % timeout)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+    def rss_high_water(self):
+        return rss_high_water(self.process.pid)
+
+
+class Benchmark(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="ioboxd-bench-")
+        self.data = stub_ermrest.SyntheticData(args.rows, args.width, args.cell_size, args.asset_count,
+                                               args.asset_size)
+        self.stub_port = free_port()
+        self.stub = stub_ermrest.serve(self.stub_port, self.data)
+        self.service_config = {
+            "authentication": None,
+            # every export request must be run in full to measure export performance
+            "export_cache": {"enabled": False},
+            "single_flight": {"enabled": False},
+            "export_admission": {"max_exports": 0, "max_exports_per_user": 0},
+        }
+        self.service_config.update(json.loads(args.service_config or "{}"))
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.stub.shutdown()
+        if not self.args.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def next_sequence(self):
+        with self.lock:
+            self.sequence += 1
+            return self.sequence
+
+    def catalog_config(self, query_processors):
+        return {
+            "host": "http://127.0.0.1:%d" % self.stub_port,
+            "catalog_id": "1",
+            "query_processors": query_processors
+        }
+
+    def table_queries(self, processor="csv"):
+        # each request queries distinctly named tables, so that no two requests are identical
+        sequence = self.next_sequence()
+        return [{"processor": processor,
+                 "processor_params": {"query_path": "/entity/bench:table%d_%d" % (i, sequence),
+                                      "output_path": "table%d" % i}}
+                for i in range(self.args.tables)]
+
+    def export_file_config(self):
+        return {"catalog": self.catalog_config(self.table_queries())}
+
+    def export_bag_config(self):
+        return {"bag": {"bag_name": "bench-%d" % self.next_sequence(), "bag_archiver": "zip"},
+                "catalog": self.catalog_config(self.table_queries())}
+
+    def export_assets_config(self):
+        queries = [{"processor": "download",
+                    "processor_params": {"query_path": "/attribute/bench:assets_%d/url,length,filename,md5,sha256" %
+                                                       self.next_sequence(),
+                                         "output_path": "assets"}}]
+        return {"catalog": self.catalog_config(queries)}
+
+    @staticmethod
+    def result_urls(response):
+        return [line.strip() for line in response.text.splitlines() if line.strip()]
+
+    def run_clients(self, concurrency, count, make_request):
+        """Issue count requests from concurrency client threads, returning the samples and the elapsed time.
+
+           Each sample is the tuple (latency, ok, response bytes).
+        """
+        samples = list()
+        pending = list(range(count))
+        lock = threading.Lock()
+
+        def client():
+            session = requests.Session()
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    index = pending.pop()
+                start = time.time()
+                try:
+                    ok, nbytes = make_request(session, index)
+                except Exception as e:
+                    sys.stderr.write("Request failed: %s\n" % e)
+                    ok, nbytes = False, 0
+                with lock:
+                    samples.append((time.time() - start, ok, nbytes))
+
+        start = time.time()
+        threads = [threading.Thread(target=client) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return samples, time.time() - start
+
+    def post_export(self, service, path, config_factory):
+        def request(session, index):
+            response = session.post(service.url + path, json=config_factory())
+            return response.status_code in (200, 201), len(response.content)
+        return request
+
+    def get_content(self, url):
+        def request(session, index):
+            response = session.get(url, stream=True)
+            nbytes = 0
+            for buf in response.iter_content(1024 * 1024):
+                nbytes += len(buf)
+            return response.status_code == 200, nbytes
+        return request
+
+    def prepare_large_export(self, service):
+        """Create a completed export of a single large file directly under the storage path, and return its URL."""
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        os.environ["HOME"] = service.home
+        from ioboxd.export.manifest import create_manifest
+
+        key = "bench-large-%d" % self.next_sequence()
+        export_dir = os.path.join(service.storage_path, key)
+        os.makedirs(export_dir)
+        with open(os.path.join(export_dir, ".access"), "w") as access:
+            access.write("*\n")
+        with open(os.path.join(export_dir, "large.bin"), "wb") as large:
+            for buf in stub_ermrest.SyntheticData.object_chunks(key, self.args.large_size):
+                large.write(buf)
+        create_manifest(export_dir)
+        return "%s/export/file/%s/large.bin" % (service.url, key)
+
+    def scenario(self, name, service):
+        """Return the (request count, request function) of a scenario, run against a started service."""
+        if name == "export_file":
+            return self.args.requests, self.post_export(service, "/export/file", self.export_file_config)
+        if name == "export_bag":
+            return self.args.requests, self.post_export(service, "/export/bdbag", self.export_bag_config)
+        if name == "export_assets":
+            return self.args.requests, self.post_export(service, "/export/file", self.export_assets_config)
+        if name == "retrieve_small":
+            response = requests.post(service.url + "/export/file", json=self.export_file_config())
+            response.raise_for_status()
+            return self.args.requests * 10, self.get_content(self.result_urls(response)[0])
+        if name == "retrieve_large":
+            return self.args.large_requests, self.get_content(self.prepare_large_export(service))
+        raise ValueError("Unknown scenario: %s" % name)
+
+    def run(self):
+        results = list()
+        for name in self.args.scenarios:
+            for concurrency in self.args.concurrency:
+                service = ServiceProcess(os.path.join(self.workdir, "%s-%d" % (name, concurrency)),
+                                         self.service_config)
+                service.start()
+                try:
+                    count, request = self.scenario(name, service)
+                    samples, elapsed = self.run_clients(concurrency, count, request)
+                    result = self.summarize(name, concurrency, samples, elapsed, service.rss_high_water())
+                finally:
+                    service.stop()
+                results.append(result)
+                sys.stderr.write("%-16s c=%-3d n=%-5d errors=%-4d %8.2f req/s  p50=%.3fs  p99=%.3fs  %s\n" % (
+                    name, concurrency, result["requests"], result["errors"], result["requests_per_second"],
+                    result["latency"]["p50"] or 0, result["latency"]["p99"] or 0,
+                    "rss=%.1fMiB" % (result["server_rss_high_water"] / 1048576.0)
+                    if result["server_rss_high_water"] else ""))
+        return results
+
+    @staticmethod
+    def summarize(name, concurrency, samples, elapsed, rss):
+        latencies = sorted([latency for latency, ok, nbytes in samples if ok])
+        nbytes = sum([sample[2] for sample in samples])
+        return dict(
+            scenario=name,
+            concurrency=concurrency,
+            requests=len(samples),
+            errors=len([sample for sample in samples if not sample[1]]),
+            seconds=round(elapsed, 6),
+            requests_per_second=round(len(samples) / elapsed, 3) if elapsed else None,
+            bytes=nbytes,
+            bytes_per_second=round(nbytes / elapsed, 1) if elapsed else None,
+            latency=dict(
+                min=latencies[0] if latencies else None,
+                mean=round(sum(latencies) / len(latencies), 6) if latencies else None,
+                p50=percentile(latencies, 0.5),
+                p90=percentile(latencies, 0.9),
+                p99=percentile(latencies, 0.99),
+                max=latencies[-1] if latencies else None),
+            server_rss_high_water=rss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ioboxd export and retrieval endpoints.")
+    parser.add_argument("--scenarios", type=lambda s: s.split(","), default=SCENARIOS,
+                        help="Comma-separated scenarios to run, from: %s" % ",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 4, 16],
+                        help="Comma-separated client concurrency levels (default 1,4,16).")
+    parser.add_argument("--requests", type=int, default=20, help="Export requests per run (default 20).")
+    parser.add_argument("--large-requests", type=int, default=2, help="Large retrievals per run (default 2).")
+    parser.add_argument("--tables", type=int, default=2, help="Queries (tables) per export (default 2).")
+    parser.add_argument("--rows", type=int, default=10000, help="Rows per table (default 10000).")
+    parser.add_argument("--width", type=int, default=10, help="Text columns per table (default 10).")
+    parser.add_argument("--cell-size", type=int, default=16, help="Characters per column value (default 16).")
+    parser.add_argument("--asset-count", type=int, default=10, help="Objects per asset export (default 10).")
+    parser.add_argument("--asset-size", type=parse_size, default="1m", help="Bytes per object (default 1m).")
+    parser.add_argument("--large-size", type=parse_size, default="2g", help="Bytes of the large file (default 2g).")
+    parser.add_argument("--service-config", help="JSON object of additional service configuration.")
+    parser.add_argument("--output", default="bench-results.json", help="Results file (default bench-results.json).")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory of the benchmark.")
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args)
+    try:
+        results = benchmark.run()
+    finally:
+        benchmark.close()
+
+    report = dict(
+        timestamp=datetime.datetime.utcnow().isoformat() + "Z",
+        host=dict(platform=platform.platform(), python=platform.python_version(),
+                  cpus=os.sysconf("SC_NPROCESSORS_ONLN")),
+        parameters=dict([(k, v) for k, v in vars(args).items() if k != "output"]),
+        results=results)
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    sys.stderr.write("Results written to %s\n" % args.output)
+    return 1 if any([result["errors"] for result in results]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Run the ioboxd web application from this source tree in a multi-threaded WSGI server, for benchmarking.
+
+   Usage: server.py <home directory> <port>
+
+   The service configuration is read from ioboxd_config.json in the given home directory, in place of the home
+   directory of the service user.
+"""
+
+import os
+import sys
+import time
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+try:
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from socketserver import ThreadingMixIn
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    start_time = time.time()
+    home, port = sys.argv[1], int(sys.argv[2])
+    os.environ["HOME"] = home
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import web
+    import ioboxd
+    from ioboxd.startup import process_started
+
+    application = web.application(ioboxd.web_urls(), globals()).wsgifunc()
+    process_started(start_time)
+    server = make_server("127.0.0.1", port, application, server_class=ThreadingWSGIServer,
+                         handler_class=QuietWSGIRequestHandler)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
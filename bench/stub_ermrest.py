@@ -0,0 +1,231 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""A stub ERMrest catalog and hatrac object store serving synthetic data, for benchmarking ioboxd.
+
+   Every table of the catalog has the same number of rows, each with an "RID" column and a configurable number of
+   text columns of a configurable width. Tables whose name contains "assets" instead describe hatrac objects, with
+   the "url", "length", "filename", "md5" and "sha256" columns used by the "download" and "fetch" export processors.
+
+   Objects are served from /hatrac/bench/<size>/<name>, with deterministic content of <size> bytes generated on the fly,
+   so that arbitrarily large objects can be served without storing them.
+
+   Data queries (entity, attribute and attributegroup) ignore any filters and projections, but honor the "limit" query
+   parameter and the "@after(RID)" paging modifier. Aggregate queries return the row count of the table.
+"""
+
+import re
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+import threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+
+BLOCK_SIZE = 64 * 1024
+CATALOG_PATH = re.compile(r'^/ermrest/catalog/([^/]+)/?$')
+SCHEMA_PATH = re.compile(r'^/ermrest/catalog/([^/]+)/schema/?$')
+QUERY_PATH = re.compile(r'^/ermrest/catalog/([^/]+)/(entity|attribute|attributegroup|aggregate)/(.*)$')
+OBJECT_PATH = re.compile(r'^/hatrac/bench/(\d+)/([^/:]+)(:[^/]+)?$')
+AFTER_MODIFIER = re.compile(r'@after\(([^)]*)\)')
+SORT_MODIFIER = re.compile(r'@sort\([^)]*\)')
+
+
+class SyntheticData(object):
+
+    def __init__(self, rows=1000, width=10, cell_size=16, asset_count=10, asset_size=1024 * 1024):
+        self.rows = rows
+        self.width = width
+        self.cell_size = cell_size
+        self.asset_count = asset_count
+        self.asset_size = asset_size
+        self.snaptime = "2TA-%X" % int(time.time())
+        self.digests = dict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def object_chunks(name, size):
+        """Generate the deterministic content of an object, in blocks."""
+        seed = hashlib.sha256(name.encode('utf-8')).digest()
+        block = (seed * (BLOCK_SIZE // len(seed) + 1))[:BLOCK_SIZE]
+        remaining = size
+        while remaining > 0:
+            buf = block[:min(BLOCK_SIZE, remaining)]
+            remaining -= len(buf)
+            yield buf
+
+    def object_digests(self, name, size):
+        """Return the (md5, sha256) hex digests of an object, computing them on first use."""
+        with self.lock:
+            digests = self.digests.get((name, size))
+        if digests is None:
+            md5 = hashlib.md5()
+            sha256 = hashlib.sha256()
+            for buf in self.object_chunks(name, size):
+                md5.update(buf)
+                sha256.update(buf)
+            digests = (md5.hexdigest(), sha256.hexdigest())
+            with self.lock:
+                self.digests[(name, size)] = digests
+        return digests
+
+    def columns(self, table):
+        if "assets" in table:
+            return ["RID", "url", "length", "filename", "md5", "sha256"]
+        return ["RID"] + ["c%d" % i for i in range(1, self.width + 1)]
+
+    def row_count(self, table):
+        return self.asset_count if "assets" in table else self.rows
+
+    def row(self, table, index):
+        if "assets" in table:
+            name = "%s-%d.bin" % (table.replace(":", "-"), index)
+            md5, sha256 = self.object_digests(name, self.asset_size)
+            return [str(index), "/hatrac/bench/%d/%s" % (self.asset_size, name), self.asset_size, name, md5, sha256]
+        return [str(index)] + [("%s-%d-%d-" % (table, index, i)).ljust(self.cell_size, "x")[:self.cell_size]
+                               for i in range(1, self.width + 1)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    data = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = unquote(url.path)
+        params = parse_qs(url.query)
+
+        match = CATALOG_PATH.match(path)
+        if match:
+            return self.send_json(200, dict(id=match.group(1), snaptime=self.data.snaptime))
+        if SCHEMA_PATH.match(path):
+            return self.send_json(200, dict(schemas=dict()))
+        match = QUERY_PATH.match(path)
+        if match:
+            return self.send_query(match.group(2), match.group(3), params)
+        match = OBJECT_PATH.match(path)
+        if match:
+            return self.send_object(int(match.group(1)), match.group(2))
+        return self.send_json(404, dict(error="Not found: %s" % path))
+
+    def send_query(self, api, query, params):
+        after = AFTER_MODIFIER.search(query)
+        start = int(after.group(1)) + 1 if after and after.group(1).isdigit() else 0
+        query = SORT_MODIFIER.sub('', AFTER_MODIFIER.sub('', query))
+        table = query.split("/", 1)[0].split("=")[-1]
+        count = self.data.row_count(table)
+
+        if api == "aggregate":
+            alias = query.rstrip("/").rsplit("/", 1)[-1].split(":=", 1)[0] or "cnt"
+            return self.send_json(200, [{alias: count}])
+
+        limit = params.get("limit", ["none"])[0]
+        end = count if not limit.isdigit() else min(count, start + int(limit))
+        accept = params.get("accept", [self.headers.get('Accept', 'application/json')])[0]
+        csv = "csv" in accept
+
+        # the response is streamed with no Content-Length, and delimited by closing the connection
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv' if csv else 'application/json')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        if self.command == 'HEAD':
+            return
+        columns = self.data.columns(table)
+        lines = list()
+        if csv:
+            lines.append(",".join(columns) + "\n")
+        else:
+            lines.append("[")
+        for index in range(start, end):
+            row = self.data.row(table, index)
+            if csv:
+                lines.append(",".join([str(value) for value in row]) + "\n")
+            else:
+                lines.append(("," if index > start else "") + json.dumps(dict(zip(columns, row))))
+            if len(lines) >= 1000:
+                self.wfile.write("".join(lines).encode('utf-8'))
+                lines = list()
+        if not csv:
+            lines.append("]")
+        self.wfile.write("".join(lines).encode('utf-8'))
+
+    def send_object(self, size, name):
+        md5, sha256 = self.data.object_digests(name, size)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.send_header('Content-MD5', base64.b64encode(bytearray.fromhex(md5)).decode('ascii'))
+        self.send_header('Content-SHA256', base64.b64encode(bytearray.fromhex(sha256)).decode('ascii'))
+        self.send_header('ETag', '"%s"' % sha256)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        for buf in self.data.object_chunks(name, size):
+            self.wfile.write(buf)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(port, data, host="127.0.0.1"):
+    """Start a stub server for the given SyntheticData on a background thread, and return the server."""
+    handler = type("BoundStubHandler", (StubHandler,), dict(data=data))
+    server = StubServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name="stub-ermrest")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a stub ERMrest catalog and hatrac store of synthetic data.")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rows", type=int, default=1000, help="Rows per table.")
+    parser.add_argument("--width", type=int, default=10, help="Text columns per table.")
+    parser.add_argument("--cell-size", type=int, default=16, help="Characters per text column value.")
+    parser.add_argument("--asset-count", type=int, default=10, help="Rows (objects) per assets table.")
+    parser.add_argument("--asset-size", type=int, default=1024 * 1024, help="Bytes per object.")
+    args = parser.parse_args()
+    server = serve(args.port, SyntheticData(args.rows, args.width, args.cell_size, args.asset_count, args.asset_size))
+    sys.stderr.write("Serving stub ERMrest catalog at http://127.0.0.1:%d/ermrest/catalog/1\n" % args.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
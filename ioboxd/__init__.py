@@ -3,19 +3,29 @@
 # Distributed under the Apache License, Version 2.0. See LICENSE for more info.
 #
 
-from ioboxd.export.rest import ExportRetrieve
-from ioboxd.export.providers.file.rest import ExportFiles
-from ioboxd.export.providers.bdbag.rest import ExportBag
+from ioboxd.rest import ServiceMetrics
+from ioboxd.export.rest import ExportRetrieve, ExportStatus, ExportProgress, ExportUploads, ExportUpload
+from ioboxd.export.providers.file.rest import ExportFiles, ExportFilesEstimate
+from ioboxd.export.providers.bdbag.rest import ExportBag, ExportBagEstimate
 
 
 def web_urls():
     """Builds and returns the web_urls for web.py.
     """
     urls = (
+        '/metrics', ServiceMetrics,
+        '/export/upload/?', ExportUploads,
+        '/export/upload/([^/]+)', ExportUpload,
         '/export/bdbag/?', ExportBag,
+        '/export/bdbag/estimate', ExportBagEstimate,
+        '/export/bdbag/([^/]+)/status', ExportStatus,
+        '/export/bdbag/([^/]+)/progress', ExportProgress,
         '/export/bdbag/([^/]+)', ExportRetrieve,
         '/export/bdbag/([^/]+)/(.+)', ExportRetrieve,
         '/export/file/?', ExportFiles,
+        '/export/file/estimate', ExportFilesEstimate,
+        '/export/file/([^/]+)/status', ExportStatus,
+        '/export/file/([^/]+)/progress', ExportProgress,
         '/export/file/([^/]+)', ExportRetrieve,
         '/export/file/([^/]+)/(.+)', ExportRetrieve,
     )
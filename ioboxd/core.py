@@ -9,20 +9,28 @@
 """
 
 import os
+import atexit
 import logging
 import web
 import json
 import random
 import base64
 import datetime
+import email.utils
+import hashlib
 import pytz
 import webauthn2
 import struct
+import threading
+import time
 import urllib
 import ioboxd
+from io import BytesIO
 from collections import OrderedDict
 from logging.handlers import SysLogHandler
 from webauthn2.util import merge_config, context_from_environment
+from ioboxd.metrics import MetricsRegistry
+from ioboxd.logs import AuditFormatter, QueueHandler, LogWriter, ExportLogRouter
 
 SERVICE_BASE_DIR = os.path.expanduser("~")
 STORAGE_BASE_DIR = os.path.join("ioboxd", "data")
@@ -46,6 +54,28 @@ else:
     config = merge_config(defaults=DEFAULT_CONFIG)
 
 STORAGE_PATH = config.get('storage_path')
+DOWNLOAD_CHUNK_SIZE = config.get('download_chunk_size', 1024 * 1024)
+MAX_BYTE_RANGES = config.get('max_byte_ranges', 64)
+MAX_REQUEST_BODY_SIZE = config.get('max_request_body_size', 64 * 1024 * 1024)
+
+DEFAULT_AUTH_CACHE_CONFIG = {
+    "enabled": True,
+    "ttl": 60,
+    "max_entries": 1024
+}
+AUTH_CACHE_CONFIG = dict(DEFAULT_AUTH_CACHE_CONFIG)
+AUTH_CACHE_CONFIG.update(config.get("auth_cache", dict()))
+
+DEFAULT_LOG_QUEUE_CONFIG = {
+    "enabled": True,
+    "max_queued": 10000,
+    "batch_size": 100
+}
+LOG_QUEUE_CONFIG = dict(DEFAULT_LOG_QUEUE_CONFIG)
+LOG_QUEUE_CONFIG.update(config.get("log_queue", dict()))
+
+# service metrics, shared by all service processes through per-process snapshots under the storage path
+metrics = MetricsRegistry(os.path.join(STORAGE_PATH, ".metrics"), config.get('metrics_flush_interval', 10))
 
 # instantiate webauthn2 manager if using webauthn
 AUTHENTICATION = config.get("authentication", None)
@@ -60,9 +90,22 @@ try:
 except:
     # this fallback allows this file to at least be cleanly imported on non-Unix systems
     sysloghandler = logging.StreamHandler()
-syslogformatter = logging.Formatter('%(name)s[%(process)d.%(thread)d]: %(message)s')
+syslogformatter = AuditFormatter('%(name)s[%(process)d.%(thread)d]: %(message)s')
 sysloghandler.setFormatter(syslogformatter)
-logger.addHandler(sysloghandler)
+if LOG_QUEUE_CONFIG["enabled"]:
+    # write to syslog on a background thread, off the request path
+    log_writer = LogWriter([sysloghandler], LOG_QUEUE_CONFIG["max_queued"], LOG_QUEUE_CONFIG["batch_size"],
+                           on_drop=lambda: metrics.increment("ioboxd_log_records_dropped_total"))
+    log_writer.start()
+    atexit.register(log_writer.stop)
+    logger.addHandler(QueueHandler(log_writer))
+else:
+    logger.addHandler(sysloghandler)
+
+# export logs are written by a single handler on the root logger, which routes records by thread to the running exports
+export_logs = ExportLogRouter()
+logging.getLogger().addHandler(export_logs)
+logging.getLogger().setLevel(logging.INFO)
 
 
 def log_parts():
@@ -95,7 +138,7 @@ def request_trace(tracedata):
         ]
         if v
     ])
-    logger.info(json.dumps(od, separators=(', ', ':')).encode('utf-8'))
+    logger.info(od)
 
 
 class RestException(web.HTTPError):
@@ -116,8 +159,12 @@ class RestException(web.HTTPError):
 
 
 class NotModified(RestException):
+    """A 304 response, which has no body. Its validators are the headers already set on the response."""
     status = '304 Not Modified'
-    message = 'Resource not modified.'
+    message = ''
+
+    def __init__(self, message=None, headers=None):
+        web.HTTPError.__init__(self, self.status, headers or {}, '')
 
 
 class TemplatedRestException(RestException):
@@ -183,6 +230,11 @@ class LengthRequired(RestException):
     message = 'Content-Length header is required for this request.'
 
 
+class RequestEntityTooLarge(RestException):
+    status = '413 Request Entity Too Large'
+    message = 'The request body is larger than this resource accepts.'
+
+
 class PreconditionFailed(RestException):
     status = '412 Precondition Failed'
     message = 'Resource state does not match requested preconditions.'
@@ -198,6 +250,11 @@ class BadRange(RestException):
             web.header('Content-Range', 'bytes */%d' % nbytes)
 
 
+class TooManyRequests(RestException):
+    status = '429 Too Many Requests'
+    message = 'Too many requests from this client, please try again later.'
+
+
 class InternalServerError(RestException):
     status = '500 Internal Server Error'
     message = 'A processing error prevented the server from fulfilling this request.'
@@ -213,6 +270,200 @@ class BadGateway(RestException):
     message = 'A downstream processing error prevented the server from fulfilling this request.'
 
 
+class ServiceUnavailable(RestException):
+    status = '503 Service Unavailable'
+    message = 'The service is temporarily unable to fulfill this request.'
+
+
+class LRUCache(object):
+    """A thread-safe, bounded mapping which discards its least recently used entries, and optionally expires entries.
+
+       A ttl of None means that entries do not expire.
+    """
+
+    def __init__(self, capacity, ttl=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                return default
+            self.entries[key] = entry
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + self.ttl if self.ttl is not None else None)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+def stream_file(f, offset=0, nbytes=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Generate the contents of an open file object in chunks of at most chunk_size bytes.
+
+       The file is read starting at offset, for nbytes bytes or until EOF if nbytes is None, and is closed when the
+       generator is exhausted or discarded.
+    """
+    try:
+        f.seek(offset)
+        remaining = nbytes
+        while remaining is None or remaining > 0:
+            buf = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not buf:
+                break
+            if remaining is not None:
+                remaining -= len(buf)
+            yield buf
+    finally:
+        f.close()
+
+
+def stream_multipart_ranges(f, parts, trailer):
+    """Generate a multipart/byteranges body from an open file object and a list of (header, first, last) parts."""
+    try:
+        for header, first, last in parts:
+            yield header
+            for buf in stream_file(f, first, last - first + 1):
+                yield buf
+        yield trailer
+    finally:
+        f.close()
+
+
+def copy_request_body(out, max_bytes, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Copy the request body to a file object in chunks, and return the number of bytes copied.
+
+       The body is read up to its Content-Length, or to the end of input if there is none (e.g. a chunked request).
+       RequestEntityTooLarge is raised if the body is larger than max_bytes.
+    """
+    stream = web.ctx.env['wsgi.input']
+    content_length = web.ctx.env.get('CONTENT_LENGTH')
+    remaining = int(content_length) if content_length else None
+    if remaining is not None and remaining > max_bytes:
+        raise RequestEntityTooLarge()
+    nbytes = 0
+    while remaining is None or remaining > 0:
+        buf = stream.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not buf:
+            break
+        nbytes += len(buf)
+        if nbytes > max_bytes:
+            raise RequestEntityTooLarge()
+        if remaining is not None:
+            remaining -= len(buf)
+        out.write(buf)
+    return nbytes
+
+
+def read_request_body(max_bytes=MAX_REQUEST_BODY_SIZE):
+    """Return the request body.
+
+       Unlike web.data(), the body is read in chunks and rejected as soon as it exceeds max_bytes, so that the memory
+       held for a request body is bounded by max_bytes regardless of its declared or actual size.
+    """
+    body = BytesIO()
+    copy_request_body(body, max_bytes)
+    return body.getvalue()
+
+
+def parse_http_date(value):
+    """Parse an HTTP-date header value into integer seconds since the epoch, or None if absent or malformed."""
+    if not value:
+        return None
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return int(email.utils.mktime_tz(parsed))
+
+
+def etag_matches(header, etag, weak=False):
+    """Test an If-Match, If-None-Match or If-Range header value against an entity tag.
+
+       Strong comparison is used unless weak is True, in which case "W/" prefixes are disregarded.
+    """
+    if header.strip() == '*':
+        return True
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def parse_byte_ranges(header, nbytes, max_ranges=MAX_BYTE_RANGES):
+    """Parse a Range header value into a sorted list of coalesced, inclusive (first, last) byte ranges.
+
+       Returns None if the header is malformed or uses units other than bytes, in which case it should be ignored.
+       Raises BadRange if the header is well-formed but none of its ranges are satisfiable.
+    """
+    units, sep, range_set = header.partition('=')
+    if not sep or units.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for spec in range_set.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        if not sep:
+            return None
+        try:
+            if not first.strip():
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix > 0 and nbytes > 0:
+                    ranges.append((max(nbytes - suffix, 0), nbytes - 1))
+            else:
+                first = int(first)
+                last = int(last) if last.strip() else None
+                if first < 0 or (last is not None and last < first):
+                    return None
+                if first < nbytes:
+                    ranges.append((first, nbytes - 1 if last is None else min(last, nbytes - 1)))
+        except ValueError:
+            return None
+
+    if not ranges:
+        raise BadRange(nbytes=nbytes)
+
+    ranges.sort()
+    coalesced = [ranges[0]]
+    for first, last in ranges[1:]:
+        prev_first, prev_last = coalesced[-1]
+        if first <= prev_last + 1:
+            coalesced[-1] = (prev_first, max(prev_last, last))
+        else:
+            coalesced.append((first, last))
+
+    # pathological numbers of ranges are answered with the full representation instead
+    if len(coalesced) > max_ranges:
+        return None
+
+    return coalesced
+
+
+# client authentication contexts resolved by the webauthn2 manager, keyed by a digest of the client's credentials
+auth_cache = LRUCache(AUTH_CACHE_CONFIG["max_entries"], ttl=AUTH_CACHE_CONFIG["ttl"])
+
+
 def client_has_identity(identity):
     if identity == "*":
         return True
@@ -239,17 +490,46 @@ def get_client_wallet():
         return None
 
 
+def get_auth_cache_key():
+    """Return a digest of the credentials presented by the client, or None if it presented none."""
+    cookie = web.cookies().get("webauthn")
+    authorization = web.ctx.env.get('HTTP_AUTHORIZATION')
+    if not cookie and not authorization:
+        return None
+    return hashlib.sha256(json.dumps([cookie, authorization]).encode('utf-8')).hexdigest()
+
+
 def get_client_auth_context(from_environment=True):
+    """Resolve the client authentication context of the current request into web.ctx.webauthn2_context.
+
+       The context is resolved at most once per request: from the environment if possible, or otherwise (and always
+       when from_environment is False, since only it provides the wallet) by the webauthn2 manager. Contexts resolved
+       by the manager are also cached for a short time across requests presenting the same credentials.
+    """
+    resolved = web.ctx.get('ioboxd_auth_resolved')
+    if resolved == "manager" or (from_environment and resolved == "environment"):
+        return
 
     try:
         if from_environment:
             web.ctx.webauthn2_context = context_from_environment()
             if web.ctx.webauthn2_context is not None and web.ctx.webauthn2_context.client is not None:
+                web.ctx.ioboxd_auth_resolved = "environment"
                 return
 
-        web.debug("falling back to webauthn2_manager.get_request_context() after failed context_from_environment()")
-        web.ctx.webauthn2_context = webauthn2_manager.get_request_context() if webauthn2_manager else None
-    except (ValueError, IndexError):
+        cache_key = get_auth_cache_key() if AUTH_CACHE_CONFIG["enabled"] and webauthn2_manager else None
+        context = auth_cache.get(cache_key) if cache_key else None
+        if context is None:
+            web.debug("falling back to webauthn2_manager.get_request_context() after failed context_from_environment()")
+            context = webauthn2_manager.get_request_context() if webauthn2_manager else None
+            if cache_key and context is not None:
+                auth_cache.put(cache_key, context)
+                metrics.increment('ioboxd_auth_cache_total', result='miss')
+        else:
+            metrics.increment('ioboxd_auth_cache_total', result='hit')
+        web.ctx.webauthn2_context = context
+        web.ctx.ioboxd_auth_resolved = "manager"
+    except (ValueError, IndexError) as e:
         web.debug("Exception getting client authentication context: %s" % str(e))
         raise Unauthorized('The requested service requires client authentication.')
 
@@ -268,6 +548,8 @@ def web_method():
             web.ctx.webauthn2_manager = webauthn2_manager
             web.ctx.webauthn2_context = webauthn2.Context()  # set empty context for sanity
             web.ctx.ioboxd_request_trace = request_trace
+            web.ctx.ioboxd_timings = OrderedDict()
+            web.ctx.ioboxd_auth_resolved = None
 
             # get client authentication context
             get_client_auth_context()
@@ -315,10 +597,20 @@ def web_method():
                         ('session', session),
                         ('track', web.ctx.webauthn2_context.tracking if web.ctx.webauthn2_context else None),
                         ('dcctx', dcctx),
+                        ('timings', web.ctx.ioboxd_timings),
                     ]
                     if v
                 ])
-                logger.info(json.dumps(od, separators=(', ', ':')).encode('utf-8'))
+                # serialized by the log writer, off the request thread
+                logger.info(od)
+
+                status = web.ctx.status.split(' ', 1)[0] if web.ctx.status else None
+                metrics.increment('ioboxd_requests_total', method=web.ctx.method, status=status)
+                metrics.observe('ioboxd_request_seconds', parts['elapsed'], method=web.ctx.method)
+                try:
+                    metrics.flush()
+                except Exception as e:
+                    web.debug("Unable to write metrics snapshot: %s" % str(e))
 
         return wrapper
 
@@ -338,20 +630,134 @@ class RestHandler(object):
     def trace(self, msg):
         web.ctx.ioboxd_request_trace(msg)
 
-    def get_content(self, file_path, client_context, get_body=True):
-
-        web.ctx.status = '200 OK'
-        nbytes = os.path.getsize(file_path)
-        web.header('Content-Length', nbytes)
-
-        if not get_body:
-            return
+    def get_content(self, file_path, client_context, get_body=True, content_type='application/octet-stream',
+                    offload=None):
+        """Send the content of a file, honoring conditional request headers and byte range requests.
 
+           If offload is given, it is called with the file path, and may return the headers with which to hand the
+           sending of the file body over to the front-end web server (e.g. X-Sendfile), which then also serves any
+           byte range requested.
+        """
         try:
             f = open(file_path, 'rb')
-            return f.read()
         except Exception as e:
-            raise NotFound(e)
+            raise NotFound(str(e))
+
+        try:
+            stat = os.fstat(f.fileno())
+            nbytes = stat.st_size
+            last_modified = int(stat.st_mtime)
+            if self.http_etag is None:
+                # export artifacts are never modified in place, so file identity, size and mtime imply the content
+                self.http_etag = '"%x-%x-%x"' % (stat.st_ino, nbytes, int(stat.st_mtime * 1000000))
+            web.header('ETag', self.http_etag)
+            web.header('Last-Modified', email.utils.formatdate(last_modified, usegmt=True))
+            web.header('Accept-Ranges', 'bytes')
+            if self.http_vary:
+                web.header('Vary', ', '.join(self.http_vary))
+            self.http_check_preconditions(last_modified)
+            offload_headers = offload(file_path) if offload and get_body else None
+            ranges = self.http_get_ranges(nbytes, last_modified) if not offload_headers else None
+        except:
+            f.close()
+            raise
+
+        if offload_headers:
+            f.close()
+            web.ctx.status = '200 OK'
+            web.header('Content-Type', content_type)
+            for name, value in offload_headers.items():
+                web.header(name, value)
+            return ''
+
+        if not ranges:
+            web.ctx.status = '200 OK'
+            web.header('Content-Type', content_type)
+            web.header('Content-Length', nbytes)
+            if not get_body:
+                f.close()
+                return
+            return self.send_file(f)
+
+        web.ctx.status = '206 Partial Content'
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            web.ctx.ioboxd_request_content_range = '%d-%d/%d' % (first, last, nbytes)
+            web.header('Content-Type', content_type)
+            web.header('Content-Range', 'bytes %d-%d/%d' % (first, last, nbytes))
+            web.header('Content-Length', last - first + 1)
+            if not get_body:
+                f.close()
+                return
+            return self.send_file(f, first, last - first + 1)
+
+        web.ctx.ioboxd_request_content_range = '%s/%d' % (
+            ','.join(['%d-%d' % (first, last) for first, last in ranges]), nbytes)
+        boundary = base64.b16encode(struct.pack('Q', random.getrandbits(64)))
+        parts = [('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+            boundary, content_type, first, last, nbytes), first, last) for first, last in ranges]
+        trailer = '\r\n--%s--\r\n' % boundary
+        web.header('Content-Type', 'multipart/byteranges; boundary=%s' % boundary)
+        web.header('Content-Length', sum([len(header) + last - first + 1 for header, first, last in parts]) +
+                   len(trailer))
+        if not get_body:
+            f.close()
+            return
+        return stream_multipart_ranges(f, parts, trailer)
+
+    def http_check_preconditions(self, last_modified):
+        """Evaluate conditional request headers against the current ETag and modification time.
+
+           Raises NotModified or PreconditionFailed as appropriate, per RFC 7232 section 6. The validators of the
+           resource must already have been set on the response.
+        """
+        if_match = web.ctx.env.get('HTTP_IF_MATCH')
+        if if_match is not None:
+            if not etag_matches(if_match, self.http_etag):
+                raise PreconditionFailed()
+        else:
+            if_unmodified_since = parse_http_date(web.ctx.env.get('HTTP_IF_UNMODIFIED_SINCE'))
+            if if_unmodified_since is not None and last_modified > if_unmodified_since:
+                raise PreconditionFailed()
+
+        if_none_match = web.ctx.env.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            if etag_matches(if_none_match, self.http_etag, weak=True):
+                if web.ctx.method in ('GET', 'HEAD'):
+                    raise NotModified()
+                raise PreconditionFailed()
+        elif web.ctx.method in ('GET', 'HEAD'):
+            if_modified_since = parse_http_date(web.ctx.env.get('HTTP_IF_MODIFIED_SINCE'))
+            if if_modified_since is not None and last_modified <= if_modified_since:
+                raise NotModified()
+
+    def http_get_ranges(self, nbytes, last_modified):
+        """Return the list of (first, last) byte ranges requested, or None if the full content should be sent."""
+        range_header = web.ctx.env.get('HTTP_RANGE')
+        if not range_header or web.ctx.method not in ('GET', 'HEAD'):
+            return None
+
+        # a Range qualified by a stale validator is ignored in favor of sending the full (current) representation
+        if_range = web.ctx.env.get('HTTP_IF_RANGE')
+        if if_range:
+            if if_range.startswith('"'):
+                if not etag_matches(if_range, self.http_etag):
+                    return None
+            elif parse_http_date(if_range) != last_modified:
+                return None
+
+        return parse_byte_ranges(range_header, nbytes)
+
+    def send_file(self, f, offset=0, nbytes=None):
+        """Return a WSGI iterable over the file, so that the body is never fully buffered in memory.
+
+           When the server provides wsgi.file_wrapper and the whole file is requested, it is used so that the server
+           may apply platform-specific optimizations such as sendfile(2). Otherwise a chunked generator is used.
+        """
+        file_wrapper = web.ctx.env.get('wsgi.file_wrapper')
+        if file_wrapper and offset == 0 and nbytes is None:
+            return file_wrapper(f, DOWNLOAD_CHUNK_SIZE)
+        return stream_file(f, offset, nbytes)
 
     def create_response(self, urls, force_uri_list=False):
         """Form response for resource creation request."""
@@ -368,6 +774,23 @@ class RestHandler(object):
         web.header('Content-Length', len(body))
         return body
 
+    def accepted_response(self, url):
+        """Form response for a request accepted for asynchronous processing."""
+        web.ctx.status = '202 Accepted'
+        web.header('Content-Type', 'text/uri-list')
+        web.header('Location', url)
+        body = url + '\n'
+        web.header('Content-Length', len(body))
+        return body
+
+    def redirect_response(self, url):
+        """Form response redirecting the client to another location for the requested content."""
+        web.ctx.status = '307 Temporary Redirect'
+        web.header('Location', url)
+        web.header('Cache-Control', 'no-store')
+        web.header('Content-Length', 0)
+        return ''
+
     def delete_response(self):
         """Form response for deletion request."""
         web.ctx.status = '204 No Content'
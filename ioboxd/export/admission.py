@@ -0,0 +1,148 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Export admission control.
+
+   The number of exports running at once is limited globally and for each client identity, across all of the service
+   processes. Each unit of concurrency is a "slot" file under the storage path, and an export holds its slots by
+   keeping an exclusive flock() on them for as long as it runs, so that slots held by a process are released by the
+   kernel should that process exit or be recycled.
+
+   Requests over the per-identity limit are rejected immediately with 429. Requests over the global limit wait for a
+   slot, holding one of a bounded number of wait slots, and are rejected with 503 if no wait slot is free or no export
+   slot becomes free in time. Both responses carry a Retry-After header.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from ioboxd.core import STORAGE_PATH, config, metrics, TooManyRequests, ServiceUnavailable
+from ioboxd.metrics import timed
+
+DEFAULT_ADMISSION_CONFIG = {
+    "max_exports": 8,
+    "max_exports_per_user": 4,
+    "max_waiting": 4,
+    "max_wait": 60,
+    "retry_after": 30
+}
+
+POLL_INTERVAL = 0.25
+
+
+class AdmissionController(object):
+    """Limits the number of concurrent exports. A limit of 0 means unlimited."""
+
+    def __init__(self, path, max_exports, max_exports_per_user, max_waiting, max_wait, retry_after):
+        self.path = path
+        self.max_exports = max_exports
+        self.max_exports_per_user = max_exports_per_user
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+
+    def try_acquire(self, name, count):
+        """Acquire one of count slots of the given name without waiting, and return it, or None if all are held.
+
+           The returned slot is an open file which holds the slot until it is closed.
+        """
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        for i in range(count):
+            slot = open(os.path.join(self.path, "%s.%d" % (name, i)), 'a')
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except IOError as e:
+                slot.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+        return None
+
+    def acquire(self, name, count, timeout=None):
+        """Acquire one of count slots of the given name, waiting for up to timeout seconds, or forever if None."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            slot = self.try_acquire(name, count)
+            if slot is not None or (deadline is not None and time.time() >= deadline):
+                return slot
+            time.sleep(POLL_INTERVAL)
+
+    def retry_headers(self):
+        return {'Retry-After': str(self.retry_after)}
+
+    def admit(self, identity, blocking=False):
+        """Acquire an export slot for the client identity, and return the list of slots to be released afterwards.
+
+           When blocking is True, wait for as long as it takes for slots to become free instead of rejecting the
+           request. This is used for asynchronous export jobs, which are already bounded by the job queue.
+        """
+        slots = list()
+        try:
+            if self.max_exports_per_user:
+                name = "user-%s" % hashlib.sha256((identity or "*").encode('utf-8')).hexdigest()[:32]
+                slot = self.acquire(name, self.max_exports_per_user) if blocking else \
+                    self.try_acquire(name, self.max_exports_per_user)
+                if slot is None:
+                    metrics.increment('ioboxd_admission_total', result='rejected_user')
+                    raise TooManyRequests("Too many exports are already running for this user, please try again "
+                                          "later.", headers=self.retry_headers())
+                slots.append(slot)
+
+            if self.max_exports:
+                slot = self.try_acquire("export", self.max_exports)
+                if slot is None and blocking:
+                    slot = self.acquire("export", self.max_exports)
+                elif slot is None:
+                    waiting = self.try_acquire("wait", self.max_waiting) if self.max_waiting else None
+                    if waiting is None:
+                        metrics.increment('ioboxd_admission_total', result='rejected_busy')
+                        raise ServiceUnavailable("Too many exports are running, please try again later.",
+                                                 headers=self.retry_headers())
+                    try:
+                        metrics.increment('ioboxd_admission_total', result='queued')
+                        slot = self.acquire("export", self.max_exports, self.max_wait)
+                    finally:
+                        waiting.close()
+                    if slot is None:
+                        metrics.increment('ioboxd_admission_total', result='rejected_timeout')
+                        raise ServiceUnavailable("Timed out waiting to start the export, please try again later.",
+                                                 headers=self.retry_headers())
+                slots.append(slot)
+        except Exception:
+            for slot in slots:
+                slot.close()
+            raise
+
+        metrics.increment('ioboxd_admission_total', result='admitted')
+        return slots
+
+    @contextmanager
+    def admitted(self, identity, blocking=False, timings=None):
+        """Hold an export slot for the client identity for the duration of the context."""
+        with timed(metrics, timings, "admission"):
+            slots = self.admit(identity, blocking)
+        try:
+            yield
+        finally:
+            for slot in slots:
+                slot.close()
+
+
+admission_config = dict(DEFAULT_ADMISSION_CONFIG)
+admission_config.update(config.get("export_admission", dict()))
+admission_controller = AdmissionController(os.path.join(STORAGE_PATH, ".admission"),
+                                           admission_config["max_exports"],
+                                           admission_config["max_exports_per_user"],
+                                           admission_config["max_waiting"],
+                                           admission_config["max_wait"],
+                                           admission_config["retry_after"])
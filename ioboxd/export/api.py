@@ -1,31 +1,67 @@
 import os
 import sys
 import errno
+import fcntl
+import json
+import time
+import shutil
+import hashlib
 import logging
+import threading
 import uuid
+import Queue
 import web
-from deriva.core import urlparse, format_credential, format_exception
-from deriva.transfer import GenericDownloader
-from deriva.transfer.download import DerivaDownloadAuthenticationError, DerivaDownloadAuthorizationError, \
-    DerivaDownloadConfigurationError, DerivaDownloadError
+from collections import OrderedDict
+from contextlib import contextmanager
+from deriva.core import ErmrestCatalog, urlparse, format_credential, format_exception
 from ioboxd.core import STORAGE_PATH, AUTHENTICATION, client_has_identity, get_client_identity, get_client_wallet, \
-    BadRequest, Unauthorized, Forbidden, Conflict, BadGateway, logger as sys_logger
+    BadRequest, Unauthorized, Forbidden, Conflict, BadGateway, ServiceUnavailable, logger as sys_logger, \
+    config as service_config, metrics, export_logs
+from ioboxd.metrics import timed
+from ioboxd.export.sessions import pooled_sessions
+from ioboxd.export.storage import storage_manager, get_dir_size
+from ioboxd.export.backends import storage_backend
+from ioboxd.export.manifest import create_manifest, get_manifest, read_access_descriptor, MANIFEST_FILE
+from ioboxd.export.objects import fetching_objects, can_access_objects
+from ioboxd.export.encoding import encode_manifest, CONTENT_ENCODING_CONFIG
+from ioboxd.export.archive import ARCHIVE_FORMATS
+from ioboxd.export.uploads import get_completed_upload_path
+from ioboxd.export.progress import create_progress, tracking_queries
+from ioboxd.export.checkpoint import create_checkpoint, is_running, CHECKPOINT_CONFIG
 
 logger = logging.getLogger('')
 logger.propagate = False
 
+DEFAULT_CACHE_CONFIG = {
+    "enabled": True,
+    "ttl": 3600,
+    "max_bytes": 10 * 1024 * 1024 * 1024
+}
+CACHE_CONFIG = dict(DEFAULT_CACHE_CONFIG)
+CACHE_CONFIG.update(service_config.get("export_cache", dict()))
+CACHE_PATH = os.path.abspath(os.path.join(STORAGE_PATH, ".cache"))
 
-def configure_logging(level=logging.INFO, log_path=None):
+DEFAULT_SINGLE_FLIGHT_CONFIG = {
+    "enabled": True,
+    "max_wait": 300,
+    "retry_after": 30
+}
+SINGLE_FLIGHT_CONFIG = dict(DEFAULT_SINGLE_FLIGHT_CONFIG)
+SINGLE_FLIGHT_CONFIG.update(service_config.get("single_flight", dict()))
+FLIGHT_POLL_INTERVAL = 0.25
+FLIGHT_FILE_MAX_AGE = 86400
 
-    logger.setLevel(level)
-    if log_path:
-        handler = logging.FileHandler(log_path)
-    else:
-        handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-    logger.addHandler(handler)
+STREAM_BAG_ARCHIVES = service_config.get("stream_bag_archives", False)
 
-    return handler
+DEFAULT_QUERY_CONCURRENCY_CONFIG = {
+    "max_per_export": 4,
+    "max_per_host": 8
+}
+QUERY_CONCURRENCY_CONFIG = dict(DEFAULT_QUERY_CONCURRENCY_CONFIG)
+QUERY_CONCURRENCY_CONFIG.update(service_config.get("query_concurrency", dict()))
+
+host_semaphores = dict()
+host_semaphores_lock = threading.Lock()
 
 
 def create_output_dir():
@@ -41,6 +77,16 @@ def create_output_dir():
     return key, output_dir
 
 
+def is_export_key(key):
+    """Test whether key has the form of the keys given by create_output_dir(), so that it names an export directory
+       directly under the storage path.
+    """
+    try:
+        return str(uuid.UUID(key)) == key
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+
 def get_final_output_path(output_path, output_name=None, ext=''):
     return ''.join([os.path.join(output_path, output_name) if output_name else output_path, ext])
 
@@ -50,82 +96,733 @@ def create_access_descriptor(directory, identity):
         access.writelines(''.join([identity if identity else "*", '\n']))
 
 
-def check_access(directory):
+def grant_access(directory, identity):
+    """Add an identity to the access descriptor of an export, e.g. for a request which joined it in flight."""
+    identity = identity if identity else "*"
+    if identity in read_access_descriptor(directory):
+        return
+    with open(os.path.abspath(os.path.join(directory, ".access")), 'a') as access:
+        access.write(''.join([identity, '\n']))
+
+
+def check_access(directory, manifest=None):
     if not AUTHENTICATION:
         return True
 
-    with open(os.path.abspath(os.path.join(directory, ".access")), 'r') as access:
-        for identity in access.readlines():
-            if client_has_identity(identity.strip()):
+    owners = manifest["owners"] if manifest else read_access_descriptor(directory)
+    for identity in owners:
+        if client_has_identity(identity):
+            return True
+    if manifest:
+        # identities granted access after the manifest was written are only listed in the access descriptor
+        for identity in read_access_descriptor(directory):
+            if identity not in owners and client_has_identity(identity):
                 return True
     return False
 
 
-def export(config=None, base_dir=None, quiet=False, files_only=False):
+def prepare_export(config=None, files_only=False):
+    """Parse the export configuration and resolve the client's credentials, identity and wallet.
 
-    log_handler = configure_logging(logging.WARN if quiet else logging.INFO,
-                                    log_path=os.path.abspath(os.path.join(base_dir, '.log')))
+       This must be called on the request thread, since it depends on the web request context. The returned dictionary
+       is passed to run_export(). Its "owner" member is the identity to be recorded in the export's access descriptor,
+       and its "cache_key" member identifies the export in the result cache, or is None if it cannot be cached. Its
+       "flight_key" member identifies concurrent, identical exports, which may be coalesced by single_flight() across
+       clients with the same attribute scope, and its "resume_key" member identifies an interrupted export of the same
+       client, which may be resumed by the export (see lookup_checkpoint()).
+    """
+    if not config:
+        raise BadRequest("No configuration specified.")
+    server = dict()
     try:
-        if not config:
-            raise BadRequest("No configuration specified.")
-        server = dict()
-        try:
-            # parse host/catalog params
-            catalog_config = config["catalog"]
-            host = catalog_config["host"]
-            if host.startswith("http"):
-                url = urlparse(host)
-                server["protocol"] = url.scheme
-                server["host"] = url.netloc
+        # parse host/catalog params
+        catalog_config = config["catalog"]
+        host = catalog_config["host"]
+        if host.startswith("http"):
+            url = urlparse(host)
+            server["protocol"] = url.scheme
+            server["host"] = url.netloc
+        else:
+            server["protocol"] = "https"
+            server["host"] = host
+        server["catalog_id"] = catalog_config.get('catalog_id', "1")
+
+        # parse credential params
+        token = catalog_config.get("token", None)
+        username = catalog_config.get("username", "Anonymous")
+        password = catalog_config.get("password", None)
+
+        # sanity-check some bag params
+        if "bag" in config:
+            if files_only:
+                del config["bag"]
             else:
-                server["protocol"] = "https"
-                server["host"] = host
-            server["catalog_id"] = catalog_config.get('catalog_id', "1")
-
-            # parse credential params
-            token = catalog_config.get("token", None)
-            username = catalog_config.get("username", "Anonymous")
-            password = catalog_config.get("password", None)
-
-            # sanity-check some bag params
-            if "bag" in config:
-                if files_only:
-                    del config["bag"]
-                else:
-                    if not config["bag"].get("bag_archiver"):
-                        config["bag"]["bag_archiver"] = "zip"
+                if not config["bag"].get("bag_archiver"):
+                    config["bag"]["bag_archiver"] = "zip"
 
-        except (KeyError, AttributeError) as e:
-            raise BadRequest('Error parsing configuration: %s' % format_exception(e))
+        # an export may reuse the objects fetched by a previous export. This does not affect the export result, and so
+        # is not part of the configuration identifying it.
+        base_export = config.pop("base_export", None)
 
-        try:
-            auth_token = token if token else web.cookies().get("webauthn")
-            credentials = format_credential(token=auth_token,
-                                            username=username,
-                                            password=password)
-        except ValueError as e:
-            raise Unauthorized(format_exception(e))
+    except (KeyError, AttributeError) as e:
+        raise BadRequest('Error parsing configuration: %s' % format_exception(e))
 
-        try:
+    try:
+        auth_token = token if token else web.cookies().get("webauthn")
+        credentials = format_credential(token=auth_token,
+                                        username=username,
+                                        password=password)
+    except ValueError as e:
+        raise Unauthorized(format_exception(e))
+
+    timings = web.ctx.ioboxd_timings
+    try:
+        with timed(metrics, timings, "auth"):
             identity = get_client_identity()
             user_id = username if not identity else identity.get('display_name', identity.get('id'))
-            create_access_descriptor(base_dir, identity=username if not identity else identity.get('id'))
+            owner = username if not identity else identity.get('id')
             wallet = get_client_wallet()
-        except (KeyError, AttributeError) as e:
-            raise BadRequest(format_exception(e))
+    except (KeyError, AttributeError) as e:
+        raise BadRequest(format_exception(e))
+
+    base_sources = get_base_export_sources(base_export) if base_export else None
+
+    scope = get_client_access_scope()
+    cache_key = snaptime = None
+    if CACHE_CONFIG.get("enabled"):
+        with timed(metrics, timings, "snapshot"):
+            snaptime = get_catalog_snapshot(server, credentials)
+        if snaptime:
+            cache_key = make_cache_key(config, server, snaptime, owner, scope)
+    # the catalog data visible to a client is determined by its attribute scope and any credentials in the
+    # configuration, which are both part of the key, so requests of different clients may share a single export once
+    # their access to its objects has been confirmed (see read_flight_result)
+    flight_key = make_cache_key(config, server, snaptime, None, scope)
+    # an interrupted export is only resumed by its owner, with the same credentials
+    resume_key = make_cache_key(config, server, snaptime, owner, scope)
+
+    # when archives are streamed at retrieval time, the bag is left as a directory and the requested archive format is
+    # recorded instead. Post-processors may operate on the archive file itself, so such exports are archived as usual.
+    stream_archiver = None
+    bag_config = config.get("bag")
+    if bag_config and STREAM_BAG_ARCHIVES and not config.get("post_processors") and \
+            bag_config.get("bag_archiver") in ARCHIVE_FORMATS:
+        stream_archiver = bag_config.pop("bag_archiver")
+
+    # a remote file manifest staged as an upload is added to the bag after it has been created, so the bag is left as
+    # a directory by the downloader and archived afterwards
+    remote_file_manifest = bag_archiver = None
+    if bag_config and bag_config.get("remote_file_manifest"):
+        if config.get("post_processors"):
+            raise BadRequest("A remote file manifest cannot be combined with post processors.")
+        remote_file_manifest = get_completed_upload_path(bag_config.pop("remote_file_manifest"))
+        if not stream_archiver:
+            bag_archiver = bag_config.pop("bag_archiver", None)
+
+    return dict(server=server, config=config, credentials=credentials, identity=identity, wallet=wallet,
+                user_id=user_id, owner=owner, cache_key=cache_key, flight_key=flight_key, resume_key=resume_key,
+                stream_archiver=stream_archiver, remote_file_manifest=remote_file_manifest, bag_archiver=bag_archiver,
+                base_sources=base_sources, sources=dict(), timings=timings)
+
+
+def get_base_export_sources(key):
+    """Return the sources of the objects fetched by a previous export, as a mapping of URL to local file path."""
+    if not isinstance(key, basestring):
+        raise BadRequest("The base export must be given by its identifier, a string.")
+    if not is_export_key(key):
+        raise BadRequest("Invalid base export identifier: %s" % key)
+    base_dir = os.path.abspath(os.path.join(STORAGE_PATH, key))
+    if not os.path.isdir(base_dir):
+        raise BadRequest("The base export %s does not exist. It was never created or has been deleted." % key)
+    manifest = get_manifest(base_dir)
+    if manifest is None:
+        raise BadRequest("The base export %s has not completed." % key)
+    if not check_access(base_dir, manifest):
+        raise Forbidden("The currently authenticated user is not permitted to access the base export %s." % key)
+    return dict([(url, os.path.join(base_dir, path)) for path, url in manifest.get("sources", dict()).items()])
+
+
+def get_catalog_snapshot(server, credentials):
+    """Resolve the snapshot time of the catalog to be exported, or None if it cannot be determined."""
+    catalog_id = server["catalog_id"]
+    if "@" in catalog_id:
+        return catalog_id.split("@", 1)[1]
+    try:
+        catalog = ErmrestCatalog(server["protocol"], server["host"], catalog_id, credentials)
+        with pooled_sessions(server, credentials, catalog=catalog):
+            return catalog.get("/").json().get("snaptime")
+    except Exception as e:
+        sys_logger.warning("Unable to resolve snapshot of catalog [%s] on host [%s]: %s" %
+                           (catalog_id, server["host"], format_exception(e)))
+        return None
+
+
+def get_client_access_scope():
+    """Return the sorted list of attribute identifiers of the client, which determine the catalog data visible to it."""
+    context = web.ctx.webauthn2_context
+    if not context or not context.attributes:
+        return []
+    return sorted(set([attrib['id'] for attrib in context.attributes]))
+
+
+def get_credential_digest(catalog_config):
+    """Return a one-way digest of the secrets given in a catalog configuration, or None if there are none."""
+    secrets = [catalog_config.get("token"), catalog_config.get("password")]
+    if not any(secrets):
+        return None
+    return hashlib.sha256(json.dumps(secrets).encode('utf-8')).hexdigest()
 
+
+def make_cache_key(config, server, snaptime, owner, scope):
+    """Compute the result cache key for an export: a hash over a canonical form of everything determining its content.
+
+       Secrets are replaced by a digest of them in the hashed configuration, so that exports made with different
+       credentials are never confused, without the secrets themselves being part of the key.
+    """
+    canonical_config = dict(config)
+    catalog_config = dict(canonical_config.get("catalog", dict()))
+    credentials = get_credential_digest(catalog_config)
+    catalog_config.pop("token", None)
+    catalog_config.pop("password", None)
+    canonical_config["catalog"] = catalog_config
+    canonical = json.dumps(dict(config=canonical_config, server=server, snaptime=snaptime, owner=owner, scope=scope,
+                                credentials=credentials), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def make_cache_path():
+    if not os.path.isdir(CACHE_PATH):
         try:
-            sys_logger.info("Creating export at [%s] on behalf of user: %s" % (base_dir, user_id))
-            downloader = GenericDownloader(server, output_dir=base_dir, config=config, credentials=credentials)
-            return downloader.download(identity=identity, wallet=wallet)
-        except DerivaDownloadAuthenticationError as e:
-            raise Unauthorized(format_exception(e))
-        except DerivaDownloadAuthorizationError as e:
-            raise Forbidden(format_exception(e))
-        except DerivaDownloadConfigurationError as e:
-            raise Conflict(format_exception(e))
-        except Exception as e:
-            raise BadGateway(format_exception(e))
+            os.makedirs(CACHE_PATH)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+
+@contextmanager
+def cache_lock():
+    """Serialize updates to the result cache across threads and processes with an exclusive lock file."""
+    make_cache_path()
+    with open(os.path.join(CACHE_PATH, ".lock"), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_cache_entry_path(cache_key):
+    return os.path.join(CACHE_PATH, "%s.json" % cache_key)
+
+
+def lookup_cached_export(params):
+    """Return the (key, output) of a previous export matching the prepared export, or None.
+
+       A hit refreshes the entry's last-use time, which is kept as the modification time of the entry file.
+    """
+    cache_key = params.get("cache_key")
+    if not cache_key:
+        return None
+    entry_path = get_cache_entry_path(cache_key)
+    try:
+        with open(entry_path, 'r') as entry_file:
+            entry = json.load(entry_file)
+    except (IOError, ValueError):
+        return None
+
+    if (time.time() - entry["created"]) > CACHE_CONFIG["ttl"] or \
+            not os.path.isdir(os.path.join(STORAGE_PATH, entry["key"])):
+        with cache_lock():
+            if os.path.isfile(entry_path):
+                os.remove(entry_path)
+        return None
+
+    os.utime(entry_path, None)
+    sys_logger.info("Export cache hit for [%s] returning existing export [%s]" % (cache_key, entry["key"]))
+    return str(entry["key"]), entry["output"]
+
+
+def store_cached_export(cache_key, base_dir, output):
+    """Record a completed export in the result cache, then evict least recently used entries over max_bytes."""
+    entry = dict(key=os.path.basename(base_dir), output=output, created=time.time(), bytes=get_dir_size(base_dir))
+    with cache_lock():
+        temp_path = os.path.join(CACHE_PATH, ".%s.%d" % (cache_key, os.getpid()))
+        with open(temp_path, 'w') as entry_file:
+            json.dump(entry, entry_file)
+        os.rename(temp_path, get_cache_entry_path(cache_key))
+        evict_cached_exports()
+    storage_manager.empty_trash()
+
+
+def evict_cached_exports():
+    """Remove least recently used cache entries, and their export directories, until the cache fits max_bytes.
+
+       The caller must hold the cache lock, and empty the storage trash once it has released it.
+    """
+    max_bytes = CACHE_CONFIG.get("max_bytes")
+    if not max_bytes:
+        return
+    entries = list()
+    total_bytes = 0
+    for filename in os.listdir(CACHE_PATH):
+        if filename.startswith(".") or not filename.endswith(".json"):
+            continue
+        entry_path = os.path.join(CACHE_PATH, filename)
+        try:
+            with open(entry_path, 'r') as entry_file:
+                entry = json.load(entry_file)
+            entries.append((os.path.getmtime(entry_path), entry_path, entry))
+            total_bytes += entry["bytes"]
+        except (IOError, OSError, ValueError):
+            continue
+
+    for last_used, entry_path, entry in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        os.remove(entry_path)
+        storage_manager.discard(entry["key"], "evicted from export cache")
+        total_bytes -= entry["bytes"]
+
+
+def get_checkpoint_entry_path(resume_key):
+    return os.path.join(CACHE_PATH, "%s.checkpoint" % resume_key)
+
+
+def store_checkpoint_entry(resume_key, base_dir):
+    """Record an export in progress as the one to be resumed should an identical export be requested again by the
+       same client.
+    """
+    make_cache_path()
+    entry_path = get_checkpoint_entry_path(resume_key)
+    temp_path = os.path.join(CACHE_PATH, ".%s.%d.%d" % (os.path.basename(entry_path), os.getpid(),
+                                                        threading.current_thread().ident))
+    with open(temp_path, 'w') as entry_file:
+        json.dump(dict(key=os.path.basename(base_dir), created=time.time()), entry_file)
+    os.rename(temp_path, entry_path)
 
+
+def remove_checkpoint_entry(resume_key, base_dir):
+    entry_path = get_checkpoint_entry_path(resume_key)
+    with cache_lock():
+        try:
+            with open(entry_path, 'r') as entry_file:
+                if json.load(entry_file)["key"] != os.path.basename(base_dir):
+                    return
+            os.remove(entry_path)
+        except (IOError, OSError, ValueError):
+            pass
+
+
+def lookup_checkpoint(params):
+    """Return the (key, output directory) of an interrupted export identical to the prepared export, or None.
+
+       The export must not have completed or be running, and must have been started within the maximum age of
+       checkpoints.
+    """
+    resume_key = params.get("resume_key")
+    if not resume_key or not CHECKPOINT_CONFIG["enabled"]:
+        return None
+    entry_path = get_checkpoint_entry_path(resume_key)
+    try:
+        with open(entry_path, 'r') as entry_file:
+            entry = json.load(entry_file)
+    except (IOError, ValueError):
+        return None
+
+    key = str(entry["key"])
+    base_dir = os.path.abspath(os.path.join(STORAGE_PATH, key))
+    if (time.time() - entry["created"]) > CHECKPOINT_CONFIG["max_age"] or not os.path.isdir(base_dir) or \
+            os.path.isfile(os.path.join(base_dir, MANIFEST_FILE)):
+        remove_checkpoint_entry(resume_key, base_dir)
+        return None
+    if is_running(base_dir) or not check_access(base_dir):
+        return None
+    sys_logger.info("Resuming interrupted export [%s] for [%s]" % (key, resume_key))
+    return key, base_dir
+
+
+class ExportFlight(object):
+    """An export in flight. If result is not None, it is the (key, output) of an identical export which completed
+       while this request waited for it. Otherwise, the request leads the flight and must run the export itself.
+    """
+
+    def __init__(self, flight_file=None):
+        self.flight_file = flight_file
+        self.result = None
+
+    def complete(self, key, output):
+        """Publish the result of the export to requests waiting on this flight."""
+        if self.flight_file is None:
+            return
+        self.flight_file.seek(0)
+        self.flight_file.truncate()
+        json.dump(dict(key=key, output=output, finished=time.time()), self.flight_file)
+        self.flight_file.flush()
+
+
+def read_flight_result(flight_file, since, params):
+    """Return the (key, output) published to a flight file after the time since, or None.
+
+       The export may have been led by another client with the same attribute scope and configured credentials, which
+       determine the catalog data exported. The objects fetched by the export may still be subject to access control
+       of their own, so the owner of the prepared export is only granted access to the export once it has confirmed
+       that its credentials give access to them. Otherwise, None is returned, so that the export is run separately.
+    """
+    try:
+        flight_file.seek(0)
+        result = json.loads(flight_file.read() or "null")
+    except ValueError:
+        return None
+    if not result or result["finished"] < since:
+        return None
+    export_dir = os.path.join(STORAGE_PATH, result["key"])
+    manifest = get_manifest(export_dir)
+    if manifest is None:
+        return None
+    if not check_access(export_dir, manifest):
+        urls = manifest.get("sources", dict()).values()
+        if urls and not can_access_objects(params["server"], params["credentials"], urls):
+            sys_logger.info("Not joining export [%s], whose objects are not all accessible to [%s]" %
+                            (result["key"], params["owner"]))
+            return None
+        grant_access(export_dir, params["owner"])
+    return str(result["key"]), result["output"]
+
+
+@contextmanager
+def single_flight(params):
+    """Coalesce concurrent, identical exports across threads and processes.
+
+       The first request for a given flight key leads the flight by holding an exclusive lock on the flight file for
+       that key while it runs the export, and publishes the result to the flight file on completion. Identical
+       requests arriving in the meantime wait for the lock, and then use the published result. Should the leader fail,
+       the next waiting request to obtain the lock leads a new flight.
+    """
+    flight_key = params.get("flight_key")
+    if not flight_key or not SINGLE_FLIGHT_CONFIG["enabled"]:
+        yield ExportFlight()
+        return
+
+    make_cache_path()
+    flight = ExportFlight(open(os.path.join(CACHE_PATH, "%s.inflight" % flight_key), 'a+'))
+    try:
+        try:
+            fcntl.flock(flight.flight_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            sys_logger.info("Waiting for identical export in progress [%s]" % flight_key)
+            since = time.time()
+            with timed(metrics, params.get("timings"), "flight"):
+                locked = False
+                while not locked and (time.time() - since) < SINGLE_FLIGHT_CONFIG["max_wait"]:
+                    time.sleep(FLIGHT_POLL_INTERVAL)
+                    try:
+                        fcntl.flock(flight.flight_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        locked = True
+                    except IOError as e:
+                        if e.errno not in (errno.EAGAIN, errno.EACCES):
+                            raise
+            if not locked:
+                metrics.increment("ioboxd_export_flights_total", result="timeout")
+                raise ServiceUnavailable("Timed out waiting for an identical export in progress, please try again "
+                                         "later.", headers={'Retry-After': str(SINGLE_FLIGHT_CONFIG["retry_after"])})
+            flight.result = read_flight_result(flight.flight_file, since, params)
+        metrics.increment("ioboxd_export_flights_total", result="joined" if flight.result else "led")
+        yield flight
     finally:
-        logger.removeHandler(log_handler)
+        flight.flight_file.close()
+    if flight.result is None:
+        sweep_flights()
+
+
+def sweep_flights():
+    """Remove flight files which have not been used for a day and are not locked."""
+    now = time.time()
+    with cache_lock():
+        for filename in os.listdir(CACHE_PATH):
+            if not filename.endswith(".inflight"):
+                continue
+            flight_path = os.path.join(CACHE_PATH, filename)
+            try:
+                if (now - os.path.getmtime(flight_path)) < FLIGHT_FILE_MAX_AGE:
+                    continue
+                with open(flight_path, 'a') as flight_file:
+                    fcntl.flock(flight_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.remove(flight_path)
+            except (IOError, OSError):
+                continue
+
+
+def get_host_semaphore(host):
+    """Return the semaphore bounding the number of concurrent queries against a catalog host from this process."""
+    with host_semaphores_lock:
+        semaphore = host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(QUERY_CONCURRENCY_CONFIG["max_per_host"])
+            host_semaphores[host] = semaphore
+        return semaphore
+
+
+def partition_queries(config):
+    """Split an export configuration into independent single-query configurations that may be run concurrently.
+
+       Only exports that do not create a bag are partitioned, since bag creation requires all query outputs to be
+       accumulated by a single downloader. The "env" queries, which set variables that other queries may interpolate,
+       are included in every partition. Returns None if the export should not be partitioned.
+    """
+    if "bag" in config or QUERY_CONCURRENCY_CONFIG["max_per_export"] < 2:
+        return None
+    queries = config.get("catalog", dict()).get("query_processors") or list()
+    env_queries = [query for query in queries if query.get("processor") == "env"]
+    other_queries = [query for query in queries if query.get("processor") != "env"]
+    if len(other_queries) < 2:
+        return None
+
+    query_configs = list()
+    for query in other_queries:
+        query_config = dict(config)
+        query_config["catalog"] = dict(config["catalog"])
+        query_config["catalog"]["query_processors"] = env_queries + [query]
+        query_configs.append(query_config)
+    return query_configs
+
+
+def load_downloader():
+    """Import the deriva downloader stack (deriva.transfer with all of its processors, and bdbag).
+
+       This is by far the slowest part of the service to import, and is not needed to retrieve exports, so it is
+       imported by the first export run by a service process, or by ioboxd.startup.warm_up(), rather than on import.
+    """
+    import deriva.transfer.download
+    from bdbag import bdbag_api
+    return deriva.transfer, bdbag_api
+
+
+def update_bags(base_dir, output, remote_file_manifest, bag_archiver=None):
+    """Add the files listed in a remote file manifest to the bags of an export, archiving each bag afterwards if
+       bag_archiver is specified, and return the export output updated accordingly.
+    """
+    transfer, bdbag_api = load_downloader()
+    updated = dict()
+    for name, metadata in output.items():
+        metadata = metadata or dict()
+        bag_path = os.path.abspath(metadata.get("local_path") or os.path.join(base_dir, name))
+        if not os.path.isdir(bag_path) or not bdbag_api.is_bag(bag_path):
+            updated[name] = metadata
+            continue
+        bdbag_api.make_bag(bag_path, update=True, remote_file_manifest=remote_file_manifest)
+        if bag_archiver:
+            archive_path = bdbag_api.archive_bag(bag_path, bag_archiver)
+            shutil.rmtree(bag_path)
+            metadata["local_path"] = archive_path
+            name = os.path.basename(archive_path)
+        updated[name] = metadata
+    return updated
+
+
+def download(base_dir, params, config):
+    transfer, bdbag_api = load_downloader()
+    downloader = transfer.GenericDownloader(params["server"], output_dir=base_dir, config=config,
+                                            credentials=params["credentials"])
+    catalog = getattr(downloader, "catalog", None)
+    store = getattr(downloader, "store", None)
+    with pooled_sessions(params["server"], params["credentials"], catalog=catalog, store=store), \
+            fetching_objects(store, base_dir, params), tracking_queries(catalog, params.get("progress"), config):
+        return downloader.download(identity=params["identity"], wallet=params["wallet"])
+
+
+def download_parallel(base_dir, params, query_configs):
+    """Run partitioned query configurations concurrently, bounded per export and per catalog host.
+
+       All queries are run to completion and their errors logged individually, after which the first error (in query
+       order) is raised, or the merged outputs of all queries are returned.
+    """
+    semaphore = get_host_semaphore(params["server"]["host"])
+    checkpoint = params.get("checkpoint")
+    results = [None] * len(query_configs)
+    errors = [None] * len(query_configs)
+    # the timings of each query are kept apart while the queries run, since the timings of the export are not
+    # thread-safe, and are merged into them once all queries have completed
+    query_timings = [OrderedDict() for i in range(len(query_configs))]
+    pending = Queue.Queue()
+    for index in range(len(query_configs)):
+        # the results of queries completed by a previous attempt are reused only if they are bound to a catalog
+        # snapshot, and therefore unchanged
+        if checkpoint and params.get("cache_key"):
+            results[index] = checkpoint.get_query_output(index)
+            if results[index] is not None:
+                logger.info("Query %d of %d was completed by a previous attempt." % (index + 1, len(query_configs)))
+                metrics.increment("ioboxd_resumed_queries_total")
+                continue
+        pending.put(index)
+
+    log_sink = export_logs.current()
+
+    def worker():
+        with export_logs.bound(log_sink):
+            run_queries()
+
+    def run_queries():
+        while True:
+            try:
+                index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            query = query_configs[index]["catalog"]["query_processors"][-1]
+            description = query.get("processor_params", dict()).get("output_path", query.get("processor"))
+            with semaphore:
+                try:
+                    start = time.time()
+                    with timed(metrics, query_timings[index], "query:%s" % description):
+                        results[index] = download(base_dir, params, query_configs[index])
+                    if checkpoint:
+                        checkpoint.query_completed(index, results[index])
+                    logger.info("Query %d of %d [%s] completed in %.3f seconds." %
+                                (index + 1, len(query_configs), description, time.time() - start))
+                except Exception as e:
+                    errors[index] = e
+                    logger.error("Query %d of %d [%s] failed: %s" %
+                                 (index + 1, len(query_configs), description, format_exception(e)))
+
+    threads = list()
+    for i in range(min(QUERY_CONCURRENCY_CONFIG["max_per_export"], len(query_configs))):
+        thread = threading.Thread(target=worker, name="ioboxd-query-%d" % i)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    timings = params.get("timings")
+    if timings is not None:
+        for phases in query_timings:
+            for phase, elapsed in phases.items():
+                timings[phase] = round(timings.get(phase, 0) + elapsed, 6)
+
+    for error in errors:
+        if error is not None:
+            raise error
+
+    output = dict()
+    for result in results:
+        output.update(result or dict())
+    return output
+
+
+def open_checkpoint(base_dir, params, checkpoint):
+    """Lock the checkpoint of an export, staging the files fetched by its previous attempts for reuse, if any."""
+    try:
+        resumed = checkpoint.open()
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            raise Conflict("The export %s is already running." % os.path.basename(base_dir))
+        raise
+    try:
+        if resumed:
+            params["resume_sources"] = checkpoint.stage_files()
+            metrics.increment("ioboxd_export_resumes_total")
+            sys_logger.info("Resuming export at [%s] with %d completed queries and %d fetched files" %
+                            (base_dir, len(checkpoint.queries), len(params["resume_sources"])))
+        if params.get("resume_key"):
+            store_checkpoint_entry(params["resume_key"], base_dir)
+    except Exception:
+        checkpoint.close()
+        raise
+
+
+def run_export(base_dir, params, quiet=False):
+    """Run an export previously prepared by prepare_export(), writing its outputs and log to base_dir.
+
+       This does not depend on the web request context and may therefore be run on a background thread.
+    """
+    transfer, bdbag_api = load_downloader()
+    # the checkpoint is locked before anything is written to the export directory, which may be in use by another
+    # attempt at the export
+    checkpoint = params["checkpoint"] = create_checkpoint(base_dir)
+    if checkpoint:
+        open_checkpoint(base_dir, params, checkpoint)
+    log_path = os.path.abspath(os.path.join(base_dir, '.log'))
+    with export_logs.export_log(log_path, logging.WARN if quiet else logging.INFO):
+        timings = params.get("timings")
+        progress = params["progress"] = create_progress(base_dir)
+        outcome = "failed"
+        error = None
+        try:
+            sys_logger.info("Creating export at [%s] on behalf of user: %s" % (base_dir, params["user_id"]))
+            query_configs = partition_queries(params["config"])
+            progress.phase("download")
+            with timed(metrics, timings, "download"):
+                if query_configs:
+                    output = download_parallel(base_dir, params, query_configs)
+                else:
+                    output = download(base_dir, params, params["config"])
+            if checkpoint:
+                checkpoint.unstage_files()
+            if params.get("remote_file_manifest"):
+                progress.phase("bag")
+                with timed(metrics, timings, "bag"):
+                    output = update_bags(base_dir, output, params["remote_file_manifest"], params.get("bag_archiver"))
+            manifest = None
+            try:
+                progress.phase("manifest")
+                with timed(metrics, timings, "manifest"):
+                    manifest = create_manifest(base_dir, params.get("stream_archiver"), params.get("sources"))
+                if CONTENT_ENCODING_CONFIG["enabled"] and CONTENT_ENCODING_CONFIG["precompress"]:
+                    progress.phase("encode")
+                    with timed(metrics, timings, "encode"):
+                        encode_manifest(base_dir, manifest)
+            except Exception as e:
+                sys_logger.warning("Unable to create manifest for export [%s]: %s" % (base_dir, format_exception(e)))
+            if manifest:
+                try:
+                    progress.phase("publish")
+                    with timed(metrics, timings, "publish"):
+                        storage_backend.publish(base_dir, manifest)
+                except Exception as e:
+                    sys_logger.warning("Unable to publish export [%s] to storage backend: %s" %
+                                       (base_dir, format_exception(e)))
+            if checkpoint:
+                checkpoint.remove()
+                if params.get("resume_key"):
+                    remove_checkpoint_entry(params["resume_key"], base_dir)
+            nbytes = get_dir_size(base_dir)
+            if timings is not None:
+                timings["bytes"] = nbytes
+            metrics.increment("ioboxd_export_bytes_total", nbytes)
+            outcome = "done"
+            try:
+                storage_manager.register(os.path.basename(base_dir), params["owner"], nbytes)
+            except Exception as e:
+                sys_logger.warning("Unable to register export [%s] in storage index: %s" %
+                                   (base_dir, format_exception(e)))
+            if params.get("cache_key"):
+                try:
+                    store_cached_export(params["cache_key"], base_dir, output)
+                except Exception as e:
+                    sys_logger.warning("Unable to store export [%s] in export cache: %s" %
+                                       (base_dir, format_exception(e)))
+            return output
+        except transfer.download.DerivaDownloadAuthenticationError as e:
+            error = format_exception(e)
+            raise Unauthorized(error)
+        except transfer.download.DerivaDownloadAuthorizationError as e:
+            error = format_exception(e)
+            raise Forbidden(error)
+        except transfer.download.DerivaDownloadConfigurationError as e:
+            error = format_exception(e)
+            raise Conflict(error)
+        except Exception as e:
+            error = format_exception(e)
+            raise BadGateway(error)
+        finally:
+            metrics.increment("ioboxd_exports_total", outcome=outcome)
+            progress.finish(outcome, error)
+            if checkpoint:
+                checkpoint.close()
+
+
+def export(config=None, base_dir=None, quiet=False, files_only=False):
+    params = prepare_export(config, files_only)
+    create_access_descriptor(base_dir, params["owner"])
+    return run_export(base_dir, params, quiet=quiet)
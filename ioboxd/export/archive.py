@@ -0,0 +1,375 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Streaming archive generation.
+
+   Bags exported as directories can be serialized on the fly into the response body, in any of the archive formats
+   supported by bdbag, without ever materializing the archive on disk. Archives are generated in a single pass over the
+   bag's files, in bounded memory, and are byte-for-byte deterministic for unchanged input files.
+
+   Zip and gzip compression is spread over a shared pool of worker threads, in the manner of pigz: each block of input
+   is compressed independently and ends on a byte boundary (with a sync flush), so that the compressed blocks can
+   simply be concatenated, in order, into a single valid deflate stream. Files in already-compressed formats are
+   stored in zip archives without compression.
+"""
+
+import os
+import bz2
+import stat
+import time
+import zlib
+import struct
+import tarfile
+import threading
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from ioboxd.core import config
+
+ARCHIVE_FORMATS = {
+    "zip": (".zip", "application/zip"),
+    "tgz": (".tgz", "application/x-gzip"),
+    "bz2": (".bz2", "application/x-bzip2"),
+    "tar": (".tar", "application/x-tar"),
+}
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+ZIP64_LIMIT = 0xFFFFFFFF
+# entries whose size approaches the 32-bit limit use zip64 sizes, since deflate may slightly expand incompressible data
+ZIP64_ENTRY_THRESHOLD = 0xF0000000
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_FLAG_UTF8 = 0x800
+
+# an empty, final deflate block, terminating a deflate stream of sync flushed blocks
+DEFLATE_FINAL_BLOCK = b'\x03\x00'
+# gzip header with no file name and modification time, for deterministic output
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03'
+
+DEFAULT_ARCHIVE_COMPRESSION_CONFIG = {
+    "level": 6,
+    "extension_levels": dict([(ext, 0) for ext in [
+        ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".zip", ".7z", ".rar", ".bam", ".cram",
+        ".jpg", ".jpeg", ".png", ".gif", ".webp", ".jp2", ".mp3", ".mp4", ".m4a", ".mov", ".mkv", ".avi", ".webm"]])
+}
+ARCHIVE_COMPRESSION_CONFIG = dict(DEFAULT_ARCHIVE_COMPRESSION_CONFIG)
+ARCHIVE_COMPRESSION_CONFIG.update(config.get("archive_compression", dict()))
+
+# zlib and hashlib release the GIL while processing large buffers, so threads are sufficient to use multiple cores
+FINALIZE_WORKERS = config.get("finalize_workers", 0) or multiprocessing.cpu_count()
+
+worker_pool = None
+worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    """Return the shared worker pool of this process, creating it on first use, or None if it is disabled."""
+    global worker_pool
+    if FINALIZE_WORKERS < 2:
+        return None
+    with worker_pool_lock:
+        if worker_pool is None:
+            worker_pool = ThreadPool(FINALIZE_WORKERS)
+        return worker_pool
+
+
+def ordered_map(pool, func, items):
+    """Apply func to each tuple of arguments in items on the pool, generating the results in order.
+
+       Unlike Pool.imap(), items are consumed only as results are consumed, within a window of twice the pool size, so
+       that memory use is bounded however many items there are.
+    """
+    window = 2 * FINALIZE_WORKERS
+    pending = collections.deque()
+    for args in items:
+        pending.append(pool.apply_async(func, args))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def get_compression_level(name):
+    """Return the compression level for a file name, from its longest matching extension in the configuration."""
+    name = name.lower()
+    matches = [ext for ext in ARCHIVE_COMPRESSION_CONFIG["extension_levels"] if name.endswith(ext.lower())]
+    if matches:
+        return ARCHIVE_COMPRESSION_CONFIG["extension_levels"][max(matches, key=len)]
+    return ARCHIVE_COMPRESSION_CONFIG["level"]
+
+
+def get_archive_name(name, archiver):
+    return name + ARCHIVE_FORMATS[archiver][0]
+
+
+def get_archive_content_type(archiver):
+    return ARCHIVE_FORMATS[archiver][1]
+
+
+def list_archive_members(directory, arcname):
+    """Return the sorted (path, member name, stat) of every directory and file under directory."""
+    members = [(directory, arcname, os.stat(directory))]
+    for dirname, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirname, name)
+            member_name = "/".join([arcname, os.path.relpath(path, directory).replace(os.sep, "/")])
+            members.append((path, member_name, os.stat(path)))
+    return members
+
+
+def read_blocks(path, block_size=READ_BLOCK_SIZE):
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(block_size)
+            if not buf:
+                break
+            yield buf
+
+
+def stream_archive(directory, arcname, archiver):
+    """Generate the bytes of an archive of directory, with its contents rooted at arcname within the archive."""
+    if archiver == "zip":
+        return stream_zip(list_archive_members(directory, arcname), get_worker_pool())
+    elif archiver == "tgz":
+        return gzip_stream(stream_tar(list_archive_members(directory, arcname)), ARCHIVE_COMPRESSION_CONFIG["level"],
+                           get_worker_pool())
+    elif archiver == "bz2":
+        return compress_stream(stream_tar(list_archive_members(directory, arcname)), bz2.BZ2Compressor())
+    elif archiver == "tar":
+        return stream_tar(list_archive_members(directory, arcname))
+    raise ValueError("Unsupported archive format: %s" % archiver)
+
+
+def compress_stream(stream, compressor):
+    for buf in stream:
+        buf = compressor.compress(buf)
+        if buf:
+            yield buf
+    yield compressor.flush()
+
+
+def reblock(stream, block_size=READ_BLOCK_SIZE):
+    """Regroup the buffers of a stream into blocks of at least block_size bytes, except for the last."""
+    pending = list()
+    nbytes = 0
+    for buf in stream:
+        pending.append(buf)
+        nbytes += len(buf)
+        if nbytes >= block_size:
+            yield b''.join(pending)
+            pending = list()
+            nbytes = 0
+    if pending:
+        yield b''.join(pending)
+
+
+def deflate_block(buf, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(buf) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def deflate_blocks(blocks, level, pool):
+    """Generate the raw deflate stream of a sequence of blocks, compressing the blocks concurrently on the pool.
+
+       The final item generated is not data, but the tuple (crc, compressed size, size) of the input.
+    """
+    totals = [0, 0]
+
+    def tasks():
+        for buf in blocks:
+            totals[0] = zlib.crc32(buf, totals[0])
+            totals[1] += len(buf)
+            yield buf, level
+
+    compressed_size = 0
+    for buf in ordered_map(pool, deflate_block, tasks()):
+        compressed_size += len(buf)
+        yield buf
+    compressed_size += len(DEFLATE_FINAL_BLOCK)
+    yield DEFLATE_FINAL_BLOCK
+    yield totals[0] & 0xFFFFFFFF, compressed_size, totals[1]
+
+
+def gzip_stream(stream, level, pool=None):
+    """Generate the gzip compressed form of a stream, compressing blocks concurrently on the pool, if any."""
+    if pool is None:
+        for buf in compress_stream(stream, zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)):
+            yield buf
+        return
+    yield GZIP_HEADER
+    for buf in deflate_blocks(reblock(stream), level, pool):
+        if isinstance(buf, tuple):
+            crc, compressed_size, size = buf
+            yield struct.pack('<II', crc, size & 0xFFFFFFFF)
+        else:
+            yield buf
+
+
+def stream_tar(members):
+    """Generate a POSIX (pax) format tar stream of the given members."""
+    nbytes = 0
+    for path, member_name, st in members:
+        info = tarfile.TarInfo(member_name)
+        info.mtime = int(st.st_mtime)
+        info.mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+            info.name = member_name + "/"
+        else:
+            info.type = tarfile.REGTYPE
+            info.size = st.st_size
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8')
+        nbytes += len(header)
+        yield header
+        if info.type == tarfile.REGTYPE:
+            for buf in read_blocks(path):
+                nbytes += len(buf)
+                yield buf
+            remainder = st.st_size % tarfile.BLOCKSIZE
+            if remainder:
+                padding = tarfile.BLOCKSIZE - remainder
+                nbytes += padding
+                yield tarfile.NUL * padding
+
+    # end of archive marker, padded to a whole record
+    trailer = 2 * tarfile.BLOCKSIZE
+    remainder = (nbytes + trailer) % tarfile.RECORDSIZE
+    if remainder:
+        trailer += tarfile.RECORDSIZE - remainder
+    yield tarfile.NUL * trailer
+
+
+def dos_date_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+           ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def crc32_file(path):
+    crc = 0
+    for buf in read_blocks(path):
+        crc = zlib.crc32(buf, crc)
+    return crc & 0xFFFFFFFF
+
+
+def deflate_file(path, level=zlib.Z_DEFAULT_COMPRESSION, pool=None):
+    """Generate the raw deflate stream of a file, compressing blocks concurrently on the pool, if any.
+
+       The final item generated is not data, but the tuple (crc, compressed size, size) of the file.
+    """
+    if pool is not None:
+        for buf in deflate_blocks(read_blocks(path), level, pool):
+            yield buf
+        return
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    compressed_size = 0
+    for buf in read_blocks(path):
+        crc = zlib.crc32(buf, crc)
+        size += len(buf)
+        buf = compressor.compress(buf)
+        if buf:
+            compressed_size += len(buf)
+            yield buf
+    buf = compressor.flush()
+    compressed_size += len(buf)
+    yield buf
+    yield crc & 0xFFFFFFFF, compressed_size, size
+
+
+def stream_zip(members, pool=None):
+    """Generate a zip stream of the given members, using data descriptors and zip64 extensions where needed.
+
+       Files are deflated, at the compression level for their name, concurrently on the pool, if any. Files with a
+       compression level of 0 are stored instead, with their checksum computed in advance, so that they need no data
+       descriptor.
+    """
+    offset = 0
+    central_directory = list()
+    for path, member_name, st in members:
+        is_dir = stat.S_ISDIR(st.st_mode)
+        name = (member_name + "/" if is_dir else member_name)
+        if not isinstance(name, bytes):
+            name = name.encode('utf-8')
+        mod_time, mod_date = dos_date_time(st.st_mtime)
+        level = None if is_dir else get_compression_level(member_name)
+        stored = is_dir or level == 0
+        zip64 = not is_dir and st.st_size >= ZIP64_ENTRY_THRESHOLD
+        version = 45 if zip64 else 20
+        method = 0 if stored else zlib.DEFLATED
+        flags = ZIP_FLAG_UTF8 | (0 if stored else ZIP_FLAG_DATA_DESCRIPTOR)
+        crc = compressed_size = size = 0
+        if stored and not is_dir:
+            crc = crc32_file(path)
+            compressed_size = size = st.st_size
+        if zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, size, compressed_size)
+        else:
+            extra = b''
+        header_offset = offset
+
+        local_header = struct.pack('<IHHHHHIIIHH', 0x04034b50, version, flags, method, mod_time, mod_date,
+                                   crc, ZIP64_LIMIT if zip64 else compressed_size, ZIP64_LIMIT if zip64 else size,
+                                   len(name), len(extra)) + name + extra
+        offset += len(local_header)
+        yield local_header
+
+        if stored and not is_dir:
+            for buf in read_blocks(path):
+                offset += len(buf)
+                yield buf
+        elif not is_dir:
+            for buf in deflate_file(path, level, pool):
+                if isinstance(buf, tuple):
+                    crc, compressed_size, size = buf
+                    break
+                offset += len(buf)
+                yield buf
+            if zip64:
+                descriptor = struct.pack('<IIQQ', 0x08074b50, crc, compressed_size, size)
+            else:
+                descriptor = struct.pack('<IIII', 0x08074b50, crc, compressed_size, size)
+            offset += len(descriptor)
+            yield descriptor
+
+        central_directory.append((name, version, flags, method, mod_time, mod_date, crc, compressed_size, size,
+                                  header_offset, st.st_mode))
+
+    cd_offset = offset
+    cd_size = 0
+    for name, version, flags, method, mod_time, mod_date, crc, compressed_size, size, header_offset, mode in \
+            central_directory:
+        zip64_fields = list()
+        if size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT or version == 45:
+            zip64_fields.extend([size, compressed_size])
+            size = compressed_size = ZIP64_LIMIT
+        if header_offset >= ZIP64_LIMIT:
+            zip64_fields.append(header_offset)
+            header_offset = ZIP64_LIMIT
+        extra = b''
+        if zip64_fields:
+            version = 45
+            extra = struct.pack('<HH' + 'Q' * len(zip64_fields), 0x0001, 8 * len(zip64_fields), *zip64_fields)
+        external_attr = (mode & 0xFFFF) << 16
+        if stat.S_ISDIR(mode):
+            external_attr |= 0x10
+        record = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, flags, method,
+                             mod_time, mod_date, crc, compressed_size, size, len(name), len(extra), 0, 0, 0,
+                             external_attr, header_offset) + name + extra
+        cd_size += len(record)
+        yield record
+
+    count = len(central_directory)
+    if count >= 0xFFFF or cd_size >= ZIP64_LIMIT or cd_offset >= ZIP64_LIMIT:
+        zip64_end_offset = cd_offset + cd_size
+        yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, count, count, cd_size, cd_offset)
+        yield struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+        yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, ZIP64_LIMIT, ZIP64_LIMIT, 0)
+    else:
+        yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0)
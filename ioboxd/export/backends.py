@@ -0,0 +1,156 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Storage backends for export files.
+
+   Exports are always created in a local directory under the storage path, which also holds their service state
+   (manifest, access descriptor, log). The storage backend determines how the files of completed exports are stored
+   and served, so that their bytes need not be sent by the service processes themselves:
+
+   * The "local" backend (the default) keeps export files in the local directory. They are sent by the service, or,
+     if "sendfile" is configured, handed over to the front-end web server with an X-Sendfile (Apache mod_xsendfile,
+     lighttpd) or X-Accel-Redirect (nginx) response header once the request has been authorized.
+
+   * The "s3" backend additionally uploads the files of each completed export to a bucket of an S3 compatible object
+     store (e.g. Amazon S3, MinIO or Ceph), and redirects authorized retrieval requests to a short-lived presigned URL,
+     so that the object store serves the files directly. Local copies of the uploaded files are removed if
+     "delete_local" is configured. It requires the boto3 module.
+
+   Bags whose archives are generated on the fly (see "stream_bag_archives") are always sent by the service.
+"""
+
+import os
+import json
+import urllib
+from ioboxd.core import STORAGE_PATH, config, logger as sys_logger
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+PUBLISHED_FILE = ".published"
+
+DEFAULT_STORAGE_BACKEND_CONFIG = {
+    "type": "local",
+    "sendfile": None,
+    "accel_redirect_prefix": "/iobox-storage/",
+    "endpoint_url": None,
+    "region": None,
+    "bucket": None,
+    "prefix": "",
+    "access_key_id": None,
+    "secret_access_key": None,
+    "url_expires": 300,
+    "delete_local": False
+}
+
+
+class LocalStorageBackend(object):
+
+    def __init__(self, storage_path, sendfile=None, accel_redirect_prefix=None):
+        if sendfile not in (None, "x-sendfile", "x-accel-redirect"):
+            raise ValueError("Unsupported sendfile method: %s" % sendfile)
+        self.storage_path = storage_path
+        self.sendfile = sendfile
+        self.accel_redirect_prefix = accel_redirect_prefix
+
+    def publish(self, export_dir, manifest):
+        """Store the files of a completed export, described by its manifest."""
+        pass
+
+    def remove(self, key):
+        """Remove the stored files of an export which is being deleted."""
+        pass
+
+    def redirect(self, export_dir, entry, method='GET'):
+        """Return a URL from which the client may retrieve the file described by a manifest entry, or None."""
+        return None
+
+    def offload(self, file_path):
+        """Return the response headers handing the sending of a local file over to the front-end web server, or None.
+        """
+        if self.sendfile == "x-sendfile":
+            return {'X-Sendfile': file_path}
+        if self.sendfile == "x-accel-redirect":
+            path = os.path.relpath(file_path, self.storage_path)
+            return {'X-Accel-Redirect': self.accel_redirect_prefix + urllib.quote(path)}
+        return None
+
+
+class S3StorageBackend(LocalStorageBackend):
+
+    def __init__(self, storage_path, bucket, prefix="", endpoint_url=None, region=None, access_key_id=None,
+                 secret_access_key=None, url_expires=300, delete_local=False, sendfile=None,
+                 accel_redirect_prefix=None):
+        LocalStorageBackend.__init__(self, storage_path, sendfile, accel_redirect_prefix)
+        if boto3 is None:
+            raise ImportError("The s3 storage backend requires the boto3 module.")
+        if not bucket:
+            raise ValueError("The s3 storage backend requires a bucket.")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url_expires = url_expires
+        self.delete_local = delete_local
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region,
+                                   aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
+
+    def get_object_key(self, key, path):
+        return "%s%s/%s" % (self.prefix, key, path)
+
+    @staticmethod
+    def is_published(export_dir):
+        return os.path.isfile(os.path.join(export_dir, PUBLISHED_FILE))
+
+    def publish(self, export_dir, manifest):
+        key = os.path.basename(export_dir)
+        entries = [entry for entry in manifest["files"] if "archiver" not in entry]
+        for entry in entries:
+            self.client.upload_file(os.path.join(export_dir, entry["path"]), self.bucket,
+                                    self.get_object_key(key, entry["path"]),
+                                    ExtraArgs=dict(ContentType=entry["content_type"]))
+        with open(os.path.join(export_dir, PUBLISHED_FILE), 'w') as published:
+            json.dump(dict(bucket=self.bucket, prefix=self.get_object_key(key, "")), published)
+        if self.delete_local:
+            for entry in entries:
+                try:
+                    os.remove(os.path.join(export_dir, entry["path"]))
+                except OSError as e:
+                    sys_logger.warning("Unable to remove local copy of [%s]: %s" % (entry["path"], e))
+
+    def remove(self, key):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.get_object_key(key, "")):
+            objects = [dict(Key=item["Key"]) for item in page.get("Contents", [])]
+            if objects:
+                self.client.delete_objects(Bucket=self.bucket, Delete=dict(Objects=objects, Quiet=True))
+
+    def redirect(self, export_dir, entry, method='GET'):
+        if "archiver" in entry or not self.is_published(export_dir):
+            return None
+        params = dict(Bucket=self.bucket, Key=self.get_object_key(os.path.basename(export_dir), entry["path"]))
+        if method == 'HEAD':
+            return self.client.generate_presigned_url("head_object", Params=params, ExpiresIn=self.url_expires)
+        filename = urllib.quote(os.path.basename(entry["path"]).encode('utf-8'))
+        params.update(ResponseContentType=entry["content_type"],
+                      ResponseContentDisposition="filename*=UTF-8''%s" % filename)
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=self.url_expires)
+
+
+def create_storage_backend(backend_config):
+    if backend_config["type"] == "local":
+        return LocalStorageBackend(STORAGE_PATH, backend_config["sendfile"], backend_config["accel_redirect_prefix"])
+    if backend_config["type"] == "s3":
+        return S3StorageBackend(STORAGE_PATH, backend_config["bucket"], backend_config["prefix"],
+                                backend_config["endpoint_url"], backend_config["region"],
+                                backend_config["access_key_id"], backend_config["secret_access_key"],
+                                backend_config["url_expires"], backend_config["delete_local"],
+                                backend_config["sendfile"], backend_config["accel_redirect_prefix"])
+    raise ValueError("Unsupported storage backend type: %s" % backend_config["type"])
+
+
+storage_backend_config = dict(DEFAULT_STORAGE_BACKEND_CONFIG)
+storage_backend_config.update(config.get("storage_backend", dict()))
+storage_backend = create_storage_backend(storage_backend_config)
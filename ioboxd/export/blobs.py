@@ -0,0 +1,175 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Shared cache of object store content.
+
+   Objects fetched from the object store (hatrac) by any export are added to a content-addressed cache under the
+   ".blobs" directory of the storage path, and hard linked into later exports fetching the same object, so that popular
+   objects are fetched and stored once rather than once per export.
+
+   Each cached object is stored once, as "objects/<sha256>", and each object URL (including its host and version, if
+   any) as a symbolic link "urls/<hash of URL>" to the object it was last found to have. Cached objects may have been
+   fetched on behalf of any client, so they are only reused once the object store confirms, with the credentials of
+   the export reusing them, that the client may access the object and that its checksum is unchanged.
+
+   Cached objects are shared by the exports linking them, and are made read-only.
+
+   Hard linking an object into an export updates its inode change time, which therefore records its last use. When the
+   cache exceeds its size cap, the least recently used objects are removed. Exports holding links to them are
+   unaffected, although their bytes are only freed once those exports are removed as well. Sweeps run opportunistically
+   as objects are added, and may also be run periodically with "python -m ioboxd.export.blobs".
+"""
+
+import os
+import time
+import errno
+import fcntl
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from ioboxd.core import STORAGE_PATH, config, logger as sys_logger
+
+DEFAULT_BLOB_CACHE_CONFIG = {
+    "enabled": True,
+    "max_bytes": 50 * 1024 * 1024 * 1024,
+    "min_size": 1024 * 1024,
+    "sweep_interval": 60
+}
+
+
+class BlobCache(object):
+
+    def __init__(self, path, max_bytes, min_size, sweep_interval):
+        self.path = path
+        self.objects_path = os.path.join(path, "objects")
+        self.urls_path = os.path.join(path, "urls")
+        self.lock_path = os.path.join(path, ".lock")
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.sweep_interval = sweep_interval
+
+    @contextmanager
+    def locked(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def make_dirs(path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def get_object_path(self, sha256):
+        return os.path.join(self.objects_path, sha256[:2], sha256)
+
+    def get_url_path(self, url):
+        return os.path.join(self.urls_path, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def lookup(self, url):
+        """Return the (sha256, object path) of the cached content last fetched from url, or None if there is none."""
+        try:
+            target = os.readlink(self.get_url_path(url))
+        except OSError:
+            return None
+        sha256 = os.path.basename(target)
+        object_path = self.get_object_path(sha256)
+        if not os.path.isfile(object_path):
+            return None
+        return sha256, object_path
+
+    def link(self, src, dst):
+        """Hard link src to dst atomically, replacing any existing dst."""
+        self.make_dirs(os.path.dirname(dst))
+        temp_path = "%s.%d.%d" % (dst, os.getpid(), threading.current_thread().ident)
+        os.link(src, temp_path)
+        os.rename(temp_path, dst)
+
+    def add(self, url, file_path, sha256):
+        """Add the content of file_path, fetched from url, to the cache, and sweep if a sweep is due."""
+        if os.path.getsize(file_path) < self.min_size:
+            return
+        object_path = self.get_object_path(sha256)
+        if not os.path.isfile(object_path):
+            os.chmod(file_path, 0o444)
+            self.link(file_path, object_path)
+        url_path = self.get_url_path(url)
+        self.make_dirs(self.urls_path)
+        temp_path = "%s.%d.%d" % (url_path, os.getpid(), threading.current_thread().ident)
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        os.symlink(os.path.relpath(object_path, self.urls_path), temp_path)
+        os.rename(temp_path, url_path)
+        self.sweep_if_due()
+
+    def sweep_if_due(self):
+        try:
+            last_sweep = os.path.getmtime(self.lock_path)
+        except OSError:
+            last_sweep = 0
+        if (time.time() - last_sweep) >= self.sweep_interval:
+            self.sweep()
+
+    def sweep(self):
+        """Remove the least recently used objects until the cache fits within its size cap."""
+        if not os.path.isdir(self.path):
+            return
+        with self.locked():
+            os.utime(self.lock_path, None)
+            if self.max_bytes:
+                self.evict()
+            # URLs of evicted objects are left as dangling links, which are removed here
+            try:
+                names = os.listdir(self.urls_path)
+            except OSError:
+                names = list()
+            for name in names:
+                url_path = os.path.join(self.urls_path, name)
+                if not os.path.exists(url_path):
+                    try:
+                        os.remove(url_path)
+                    except OSError:
+                        continue
+
+    def evict(self):
+        lru = list()
+        for dirname, dirnames, filenames in os.walk(self.objects_path):
+            for filename in filenames:
+                object_path = os.path.join(dirname, filename)
+                try:
+                    stat = os.stat(object_path)
+                except OSError:
+                    continue
+                lru.append((stat.st_ctime, stat.st_size, object_path))
+        lru.sort()
+        total_bytes = sum([size for ctime, size, object_path in lru])
+        for ctime, size, object_path in lru:
+            if total_bytes <= self.max_bytes:
+                break
+            sys_logger.info("Removing cached object [%s]: blob cache size cap exceeded" % object_path)
+            try:
+                os.remove(object_path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+
+blob_cache_config = dict(DEFAULT_BLOB_CACHE_CONFIG)
+blob_cache_config.update(config.get("blob_cache", dict()))
+blob_cache = BlobCache(os.path.abspath(os.path.join(STORAGE_PATH, ".blobs")),
+                       blob_cache_config["max_bytes"],
+                       blob_cache_config["min_size"],
+                       blob_cache_config["sweep_interval"]) if blob_cache_config["enabled"] else None
+
+if __name__ == "__main__":
+    sys_logger.addHandler(logging.StreamHandler())
+    if blob_cache:
+        blob_cache.sweep()
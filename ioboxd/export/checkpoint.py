@@ -0,0 +1,170 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Export checkpoints.
+
+   While an export runs, the completion of each of its partitioned queries (see ioboxd.export.api.partition_queries)
+   and of each file fetched from the object store is appended to a ".checkpoint" journal in its export directory, one
+   JSON object per line. The journal is removed once the export completes, so an export directory which has one was
+   interrupted: by a failure, or by the exit of the process running it (e.g. a recycled WSGI daemon process).
+
+   When an identical export is requested again, the interrupted export is resumed in its existing directory rather
+   than started over (see ioboxd.export.api.lookup_checkpoint). Files fetched by the interrupted export are staged
+   under ".resume" in the export directory, and reused by the resumed export once their checksums have been verified
+   (see ioboxd.export.objects). Completed queries are skipped if the export is bound to a catalog snapshot, so that
+   their results cannot have changed.
+
+   The journal is locked by the process running the export, so that it is not resumed by another process meanwhile.
+"""
+
+import os
+import json
+import errno
+import fcntl
+import shutil
+import threading
+from ioboxd.core import config, logger as sys_logger
+
+CHECKPOINT_FILE = ".checkpoint"
+RESUME_PATH = ".resume"
+
+DEFAULT_CHECKPOINT_CONFIG = {
+    "enabled": True,
+    "max_age": 86400
+}
+CHECKPOINT_CONFIG = dict(DEFAULT_CHECKPOINT_CONFIG)
+CHECKPOINT_CONFIG.update(config.get("export_checkpoints", dict()))
+
+
+def is_running(base_dir):
+    """Test whether the export whose checkpoint journal is in base_dir is being run by some process."""
+    try:
+        with open(os.path.join(base_dir, CHECKPOINT_FILE), 'r') as checkpoint_file:
+            try:
+                fcntl.flock(checkpoint_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return True
+                raise
+            fcntl.flock(checkpoint_file, fcntl.LOCK_UN)
+            return False
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+
+
+class ExportCheckpoint(object):
+    """The checkpoint journal of an export, and the completed work of its previous attempts, if any."""
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.path = os.path.join(base_dir, CHECKPOINT_FILE)
+        self.resume_path = os.path.join(base_dir, RESUME_PATH)
+        self.lock = threading.Lock()
+        self.checkpoint_file = None
+        self.queries = dict()
+        self.files = dict()
+
+    def open(self):
+        """Lock and load the journal, and return whether it records work completed by a previous attempt."""
+        self.checkpoint_file = open(self.path, 'a+')
+        try:
+            fcntl.flock(self.checkpoint_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.checkpoint_file.close()
+            self.checkpoint_file = None
+            raise
+        self.checkpoint_file.seek(0)
+        length = 0
+        for line in self.checkpoint_file.read().splitlines(True):
+            try:
+                record = json.loads(line) if line.endswith('\n') else None
+            except ValueError:
+                record = None
+            if record is None:
+                # the last record was being written when the previous attempt was interrupted
+                break
+            length += len(line)
+            if record["type"] == "query":
+                self.queries[record["index"]] = record["output"]
+            elif record["type"] == "file":
+                self.files[record["url"]] = record
+        self.checkpoint_file.truncate(length)
+        return bool(self.queries or self.files)
+
+    def close(self):
+        if self.checkpoint_file is not None:
+            self.checkpoint_file.close()
+            self.checkpoint_file = None
+
+    def append(self, record):
+        with self.lock:
+            if self.checkpoint_file is None:
+                return
+            try:
+                self.checkpoint_file.write(json.dumps(record, separators=(',', ':')) + '\n')
+                self.checkpoint_file.flush()
+            except (IOError, OSError) as e:
+                # a missing record only means that the work is repeated if the export is resumed
+                sys_logger.warning("Unable to write export checkpoint [%s]: %s" % (self.path, e))
+
+    def query_completed(self, index, output):
+        self.append(dict(type="query", index=index, output=output))
+
+    def file_fetched(self, url, path, sha256):
+        self.append(dict(type="file", url=url, path=path, sha256=sha256))
+
+    def get_query_output(self, index):
+        """Return the output of a partitioned query completed by a previous attempt, if its files are still present."""
+        output = self.queries.get(index)
+        if output is None:
+            return None
+        for name, metadata in output.items():
+            local_path = (metadata or dict()).get("local_path") or os.path.join(self.base_dir, name)
+            if not os.path.exists(local_path):
+                return None
+        return output
+
+    def stage_files(self):
+        """Stage the files fetched by previous attempts for reuse, and return them as a mapping of URL to a pair of
+           (staged path, checksum).
+
+           Files are hard linked into the staging directory under their checksums, so that they survive the removal of
+           the export outputs by the downloader when it starts over.
+        """
+        staged = dict()
+        for url, record in self.files.items():
+            staged_path = os.path.join(self.resume_path, record["sha256"])
+            if not os.path.isfile(staged_path):
+                file_path = os.path.join(self.base_dir, record["path"])
+                if not os.path.isfile(file_path):
+                    continue
+                if not os.path.isdir(self.resume_path):
+                    os.makedirs(self.resume_path)
+                try:
+                    os.link(file_path, staged_path)
+                except OSError:
+                    shutil.copy2(file_path, staged_path)
+            staged[url] = (staged_path, record["sha256"])
+        return staged
+
+    def unstage_files(self):
+        shutil.rmtree(self.resume_path, ignore_errors=True)
+
+    def remove(self):
+        """Remove the journal and the staged files of a completed export."""
+        self.unstage_files()
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.close()
+
+
+def create_checkpoint(base_dir):
+    """Return the checkpoint of an export run in base_dir, or None if checkpoints are not enabled."""
+    return ExportCheckpoint(base_dir) if CHECKPOINT_CONFIG["enabled"] else None
@@ -0,0 +1,219 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Compressed representations of export files.
+
+   Text export files (e.g. CSV and JSON query results) are offered to clients in compressed form, negotiated with the
+   Accept-Encoding request header. Each compressed variant is generated once, and kept in the hidden ".encoded"
+   directory of the export alongside the original file, so that files are never compressed per request. Variants are
+   generated in the background on first retrieval, or when the export completes if so configured, and the original
+   file is sent until they are ready.
+
+   The "gzip" encoding is always available. The "br" and "zstd" encodings are also available if the brotli and
+   zstandard modules are installed.
+"""
+
+import os
+import errno
+import threading
+import Queue
+from deriva.core import format_exception
+from ioboxd.core import config, logger as sys_logger
+from ioboxd.export.archive import read_blocks, gzip_stream, get_worker_pool
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENCODED_DIR = ".encoded"
+
+DEFAULT_CONTENT_ENCODING_CONFIG = {
+    "enabled": True,
+    "min_size": 1024,
+    "level": 6,
+    "precompress": False,
+    "workers": 2,
+    "max_queued": 64,
+    "types": ["text/", "application/json", "application/xml", "application/x-ndjson", "application/javascript"]
+}
+CONTENT_ENCODING_CONFIG = dict(DEFAULT_CONTENT_ENCODING_CONFIG)
+CONTENT_ENCODING_CONFIG.update(config.get("content_encoding", dict()))
+
+
+def encode_gzip(path, out):
+    for buf in gzip_stream(read_blocks(path), CONTENT_ENCODING_CONFIG["level"], get_worker_pool()):
+        out.write(buf)
+
+
+def encode_brotli(path, out):
+    compressor = brotli.Compressor(quality=min(11, CONTENT_ENCODING_CONFIG["level"] + 2))
+    for buf in read_blocks(path):
+        out.write(compressor.process(buf))
+    out.write(compressor.finish())
+
+
+def encode_zstd(path, out):
+    with open(path, 'rb') as f:
+        zstandard.ZstdCompressor(level=CONTENT_ENCODING_CONFIG["level"]).copy_stream(f, out)
+
+
+# available encodings, in order of server preference, as (content coding, file extension, encoder)
+ENCODINGS = [encoding for encoding in [
+    ("zstd", ".zst", encode_zstd) if zstandard else None,
+    ("br", ".br", encode_brotli) if brotli else None,
+    ("gzip", ".gz", encode_gzip),
+] if encoding]
+
+pending = set()
+pending_lock = threading.Lock()
+encode_queue = Queue.Queue(CONTENT_ENCODING_CONFIG["max_queued"])
+encode_threads = list()
+
+
+def is_compressible(entry):
+    """Test whether a manifest entry describes a file worth offering in compressed form."""
+    if not CONTENT_ENCODING_CONFIG["enabled"] or "archiver" in entry:
+        return False
+    content_type = entry.get("content_type") or ""
+    return entry.get("size", 0) >= CONTENT_ENCODING_CONFIG["min_size"] and \
+        any([content_type.startswith(t) for t in CONTENT_ENCODING_CONFIG["types"]])
+
+
+def get_encoded_path(directory, entry, extension):
+    return os.path.join(directory, ENCODED_DIR, entry["path"] + extension)
+
+
+def parse_accept_encoding(header):
+    """Return the content codings acceptable to the client, as a mapping of coding to quality value."""
+    accepted = dict()
+    for item in (header or "").split(","):
+        parts = [part.strip() for part in item.split(";")]
+        if not parts[0]:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            if param.lower().startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[parts[0].lower()] = quality
+    return accepted
+
+
+def select_encodings(header):
+    """Return the available encodings acceptable to the client, in order of preference."""
+    accepted = parse_accept_encoding(header)
+    candidates = list()
+    for index, (coding, extension, encoder) in enumerate(ENCODINGS):
+        quality = accepted.get(coding, accepted.get("x-gzip") if coding == "gzip" else None)
+        if quality is None:
+            quality = accepted.get("*", 0.0)
+        if quality > 0:
+            candidates.append((-quality, index, coding, extension))
+    return [(coding, extension) for q, index, coding, extension in sorted(candidates)]
+
+
+def encode_file(path, encoded_path, encoder):
+    parent = os.path.dirname(encoded_path)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    temp_path = "%s.%d.%d" % (encoded_path, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(temp_path, 'wb') as out:
+            encoder(path, out)
+        os.rename(temp_path, encoded_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def encode_entry(directory, entry):
+    """Generate any missing compressed variants of the file described by a manifest entry."""
+    path = os.path.join(directory, entry["path"])
+    for coding, extension, encoder in ENCODINGS:
+        encoded_path = get_encoded_path(directory, entry, extension)
+        if os.path.isfile(encoded_path):
+            continue
+        try:
+            encode_file(path, encoded_path, encoder)
+        except Exception as e:
+            sys_logger.warning("Unable to encode [%s] as %s: %s" % (path, coding, format_exception(e)))
+
+
+def encode_manifest(directory, manifest):
+    """Generate the compressed variants of all compressible files of an export."""
+    for entry in manifest["files"]:
+        if is_compressible(entry):
+            encode_entry(directory, entry)
+
+
+def encode_worker():
+    while True:
+        key, directory, entry = encode_queue.get()
+        try:
+            encode_entry(directory, entry)
+        finally:
+            with pending_lock:
+                pending.discard(key)
+            encode_queue.task_done()
+
+
+def start_encode_workers():
+    """Start the encoder threads, unless they are already running.
+
+       Dedicated threads are used, since the encoders themselves may wait on the shared worker pool. They are started
+       lazily, so that processes which never encode a file do not carry idle threads.
+    """
+    with pending_lock:
+        while len(encode_threads) < CONTENT_ENCODING_CONFIG["workers"]:
+            thread = threading.Thread(target=encode_worker, name="ioboxd-encode-%d" % len(encode_threads))
+            thread.daemon = True
+            thread.start()
+            encode_threads.append(thread)
+
+
+def schedule_encode_entry(directory, entry):
+    """Queue the generation of the compressed variants of a file for the encoder threads, unless that is already
+       pending. If the queue is full, the file is not scheduled, and will be scheduled again on a later retrieval.
+    """
+    if CONTENT_ENCODING_CONFIG["workers"] < 1:
+        return
+    key = os.path.join(directory, entry["path"])
+    with pending_lock:
+        if key in pending:
+            return
+        pending.add(key)
+    start_encode_workers()
+    try:
+        encode_queue.put_nowait((key, directory, entry))
+    except Queue.Full:
+        with pending_lock:
+            pending.discard(key)
+
+
+def get_encoded_variant(directory, entry, accept_encoding):
+    """Return the (content coding, path) of the preferred compressed variant of a file acceptable to the client, or
+       None if the file should be sent as is. Missing variants are scheduled for generation.
+    """
+    encodings = select_encodings(accept_encoding)
+    if not encodings:
+        return None
+    for coding, extension in encodings:
+        encoded_path = get_encoded_path(directory, entry, extension)
+        if os.path.isfile(encoded_path):
+            return coding, encoded_path
+    schedule_encode_entry(directory, entry)
+    return None
@@ -0,0 +1,205 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Export cost estimation.
+
+   An export configuration is estimated without running it, and without writing anything to the storage path, using
+   cheap catalog requests for each of its queries:
+
+   * the number of rows is counted with an ERMrest aggregate request over the query's path,
+   * the size of "csv" and "json" query results is extrapolated from a small sample of result rows,
+   * the total size of the files listed by "download" and "fetch" queries is summed with an aggregate request over
+     their "length" column if the query projects one, or else extrapolated from the sizes of the sampled files,
+     obtained with HEAD requests to the object store.
+
+   Queries whose paths depend on variables set by other queries (e.g. by "env" queries) and queries using custom
+   processors cannot be estimated, and are reported as such. The expected duration of the export is derived from the
+   throughput of the exports previously run by the service, as recorded in the service metrics.
+"""
+
+import re
+import json
+import urllib
+from deriva.core import ErmrestCatalog, HatracStore, format_exception
+from ioboxd.core import config, metrics, logger as sys_logger
+from ioboxd.export.sessions import pooled_sessions
+
+DEFAULT_ESTIMATE_CONFIG = {
+    "sample_rows": 10,
+    "max_heads": 10,
+    "default_bytes_per_second": 10 * 1024 * 1024,
+    "seconds_per_query": 1.0,
+    "max_export_bytes": 0
+}
+ESTIMATE_CONFIG = dict(DEFAULT_ESTIMATE_CONFIG)
+ESTIMATE_CONFIG.update(config.get("export_estimate", dict()))
+
+QUERY_PATH = re.compile(r'^/(entity|attribute|attributegroup|aggregate)/(.+)$')
+PAGING_MODIFIERS = re.compile(r'@(sort|after|before)\([^)]*\)')
+RESULT_PROCESSORS = {"csv": "csv", "json": "json", "json-stream": "json"}
+FILE_PROCESSORS = ["download", "fetch"]
+
+
+def parse_query_path(query_path):
+    """Split an ERMrest query path into its (api, entity path, projection, limit).
+
+       Sort and paging modifiers, which do not affect the number of result rows, are removed from the entity path.
+    """
+    path, _, query = query_path.partition("?")
+    match = QUERY_PATH.match(path)
+    if not match:
+        raise ValueError("Unsupported query path: %s" % query_path)
+    api, rest = match.groups()
+    rest = PAGING_MODIFIERS.sub("", rest).rstrip("/")
+    projection = None
+    if api != "entity":
+        rest, _, projection = rest.rpartition("/")
+    limit = None
+    for param in query.split("&"):
+        name, _, value = param.partition("=")
+        if name == "limit" and value.isdigit():
+            limit = int(value)
+    return api, rest, projection, limit
+
+
+def get_projected_column(projection, alias):
+    """Return the column projected as alias (e.g. "length:=Length" or "length"), or None."""
+    for item in (projection or "").split(";", 1)[0].split(","):
+        name, _, column = item.partition(":=")
+        if not column:
+            column = name
+        if urllib.unquote(name).split(":")[-1] == alias:
+            return column
+    return None
+
+
+def count_rows(catalog, api, path, projection, limit):
+    """Return the number of rows of a query, and the total of its projected "length" column if it has one."""
+    if api == "aggregate":
+        return 1, None
+    aggregates = ["cnt:=cnt(*)"]
+    if api == "attributegroup":
+        keys = projection.split(";", 1)[0].split(",")
+        if len(keys) == 1:
+            # each group is a distinct value of the single group key
+            aggregates = ["cnt:=cnt_d(%s)" % (keys[0].partition(":=")[2] or keys[0])]
+    length_column = get_projected_column(projection, "length")
+    if length_column:
+        aggregates.append("bytes:=sum(%s)" % length_column)
+    result = catalog.get("/aggregate/%s/%s" % (path, ",".join(aggregates))).json()[0]
+    rows = result.get("cnt") or 0
+    nbytes = result.get("bytes") if length_column and not limit else None
+    if limit is not None:
+        rows = min(rows, limit)
+    return rows, nbytes
+
+
+def get_sample(catalog, query_path, output_format, sample_rows):
+    """Return the content of the first sample_rows rows of a query result in the given format."""
+    path, _, query = query_path.partition("?")
+    params = [param for param in query.split("&") if param and not param.startswith(("limit=", "accept="))]
+    params += ["limit=%d" % sample_rows, "accept=%s" % output_format]
+    return catalog.get("%s?%s" % (path, "&".join(params))).content
+
+
+def get_file_size(store, row):
+    """Return the size of the file listed by a result row, from the row itself or a HEAD request, or None."""
+    if row.get("length") is not None:
+        return int(row["length"])
+    url = row.get("url")
+    if not url or not url.startswith("/"):
+        return None
+    response = store.head(url)
+    length = response.headers.get("Content-Length")
+    return int(length) if length else None
+
+
+def estimate_query(catalog, store, query):
+    processor = query.get("processor")
+    processor_params = query.get("processor_params") or dict()
+    query_path = processor_params.get("query_path") or ""
+    estimate = dict(processor=processor, output_path=processor_params.get("output_path"), estimated=False)
+    if query.get("processor_type") or (processor not in RESULT_PROCESSORS and processor not in FILE_PROCESSORS):
+        estimate["reason"] = "The %s processor cannot be estimated." % (query.get("processor_type") or processor)
+        return estimate
+    if "{" in query_path:
+        estimate["reason"] = "The query path depends on variables set at export time."
+        return estimate
+
+    api, path, projection, limit = parse_query_path(query_path)
+    rows, nbytes = count_rows(catalog, api, path, projection, limit)
+    estimate.update(estimated=True, rows=rows)
+    sample_rows = ESTIMATE_CONFIG["sample_rows"]
+    if processor in RESULT_PROCESSORS:
+        sample = get_sample(catalog, query_path, RESULT_PROCESSORS[processor], sample_rows)
+        estimate["bytes"] = int(len(sample) * rows / float(min(rows, sample_rows))) if rows else 0
+        estimate["files"] = 1
+        return estimate
+
+    if nbytes is None and rows:
+        sample = json.loads(get_sample(catalog, query_path, "json", sample_rows))
+        sizes = list()
+        for row in sample[:ESTIMATE_CONFIG["max_heads"]]:
+            try:
+                size = get_file_size(store, row)
+            except Exception as e:
+                sys_logger.warning("Unable to get the size of [%s]: %s" % (row.get("url"), format_exception(e)))
+                size = None
+            if size is not None:
+                sizes.append(size)
+        nbytes = int(sum(sizes) * rows / float(len(sizes))) if sizes else None
+    if processor == "fetch":
+        # fetched files are only listed in the bag's fetch.txt, and are not stored by the export
+        estimate.update(remote_files=rows, remote_bytes=nbytes, files=1, bytes=0)
+    else:
+        estimate.update(files=rows, bytes=nbytes)
+    return estimate
+
+
+def get_export_throughput():
+    """Return the average bytes per second of the exports previously run by the service, or None."""
+    counters, histograms = metrics.collect()
+    nbytes = counters.get(("ioboxd_export_bytes_total", ()), 0)
+    histogram = histograms.get(("ioboxd_export_phase_seconds", (("phase", "download"),)))
+    if not nbytes or not histogram or not histogram[1]:
+        return None
+    return nbytes / histogram[1]
+
+
+def estimate_export(params):
+    """Estimate the rows, bytes, files and duration of an export previously prepared by prepare_export()."""
+    server, credentials = params["server"], params["credentials"]
+    catalog = ErmrestCatalog(server["protocol"], server["host"], server["catalog_id"], credentials)
+    store = HatracStore(server["protocol"], server["host"], credentials)
+    queries = params["config"].get("catalog", dict()).get("query_processors") or list()
+
+    estimates = list()
+    with pooled_sessions(server, credentials, catalog=catalog, store=store):
+        for query in queries:
+            if query.get("processor") == "env":
+                continue
+            try:
+                estimates.append(estimate_query(catalog, store, query))
+            except Exception as e:
+                processor_params = query.get("processor_params") or dict()
+                estimates.append(dict(processor=query.get("processor"), output_path=processor_params.get("output_path"),
+                                      estimated=False, reason=format_exception(e)))
+
+    totals = dict(rows=0, bytes=0, files=0, remote_files=0, remote_bytes=0)
+    for estimate in estimates:
+        for key in totals.keys():
+            totals[key] += estimate.get(key) or 0
+    throughput = get_export_throughput()
+    seconds = len(estimates) * ESTIMATE_CONFIG["seconds_per_query"] + \
+        totals["bytes"] / float(throughput or ESTIMATE_CONFIG["default_bytes_per_second"])
+
+    result = dict(totals)
+    result.update(seconds=round(seconds, 1),
+                  throughput_basis="history" if throughput else "default",
+                  complete=all([estimate["estimated"] and estimate.get("bytes") is not None and
+                                (estimate["processor"] != "fetch" or estimate.get("remote_bytes") is not None)
+                                for estimate in estimates]),
+                  queries=estimates)
+    return result
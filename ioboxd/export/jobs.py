@@ -0,0 +1,203 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Asynchronous export job execution.
+
+   Jobs are queued to a bounded pool of worker threads in the current process. The state of each job is persisted
+   to a status file in its export directory, so that it can be polled through any of the service processes.
+"""
+
+import os
+import json
+import errno
+import datetime
+import threading
+import Queue
+import pytz
+import web
+from collections import OrderedDict
+from deriva.core import format_exception
+from ioboxd.core import config, logger as sys_logger, ServiceUnavailable
+from ioboxd.metrics import process_exists
+from ioboxd.export.api import run_export
+from ioboxd.export.admission import admission_controller
+
+JOB_STATUS_FILE = ".job"
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+DEFAULT_JOBS_CONFIG = {
+    "workers": 2,
+    "max_queued": 32,
+    "retry_after": 30
+}
+
+
+def now():
+    return datetime.datetime.now(pytz.timezone('UTC')).isoformat()
+
+
+def load_job_status(base_dir):
+    try:
+        with open(os.path.join(base_dir, JOB_STATUS_FILE), 'r') as job_file:
+            return json.load(job_file)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def read_job_status(base_dir):
+    """Return the job status dictionary for an export directory, or None if it was not created by a job.
+
+       A job which was queued or running in a process that has since exited is reported as failed. Its status file is
+       left as is, since it may be replaced concurrently by a request resuming the export.
+    """
+    job_status = load_job_status(base_dir)
+    if job_status and job_status.get("status") in (JOB_QUEUED, JOB_RUNNING) and job_status.get("pid") and \
+            not process_exists(job_status["pid"]):
+        job_status.update(status=JOB_FAILED, error="The export was interrupted.")
+    return job_status
+
+
+def write_job_status(base_dir, status, replace=False, **kwargs):
+    """Atomically update the job status file of an export directory, merging kwargs into the existing status unless
+       replace is set.
+    """
+    job_status = (load_job_status(base_dir) if not replace else None) or dict()
+    job_status.update(kwargs)
+    job_status["status"] = status
+    job_status["updated"] = now()
+    temp_path = os.path.join(base_dir, ".%s.%d.%d" % (JOB_STATUS_FILE, os.getpid(), threading.current_thread().ident))
+    with open(temp_path, 'w') as job_file:
+        json.dump(job_status, job_file)
+    os.rename(temp_path, os.path.join(base_dir, JOB_STATUS_FILE))
+    return job_status
+
+
+def write_job_outcome(base_dir, uris=None, error=None):
+    """Record the completion of a job with the result URIs of its export, or its failure with an exception."""
+    if isinstance(error, web.HTTPError):
+        return write_job_status(base_dir, JOB_FAILED, finished=now(), error_status=error.status,
+                                error=(error.data or '').strip())
+    if error is not None:
+        return write_job_status(base_dir, JOB_FAILED, finished=now(), error=format_exception(error))
+    return write_job_status(base_dir, JOB_DONE, finished=now(), uris=[uris] if isinstance(uris, basestring) else uris)
+
+
+class ExportJob(object):
+    """A prepared export, along with a callback used to map its outputs to result URIs on completion."""
+
+    def __init__(self, key, base_dir, params, make_uris):
+        self.key = key
+        self.base_dir = base_dir
+        self.params = params
+        self.make_uris = make_uris
+
+    def run(self):
+        try:
+            with admission_controller.admitted(self.params["owner"], blocking=True,
+                                               timings=self.params.get("timings")):
+                write_job_status(self.base_dir, JOB_RUNNING, started=now(), pid=os.getpid())
+                output = run_export(self.base_dir, self.params)
+            write_job_outcome(self.base_dir, uris=self.make_uris(output))
+            sys_logger.info("Export job [%s] completed, timings: %s" %
+                            (self.key, json.dumps(self.params.get("timings"), separators=(', ', ':'))))
+        except web.HTTPError as e:
+            write_job_outcome(self.base_dir, error=e)
+        except Exception as e:
+            sys_logger.error("Unhandled exception in export job [%s]: %s" % (self.key, format_exception(e)))
+            write_job_outcome(self.base_dir, error=e)
+
+
+class ExportJobQueue(object):
+    """A bounded queue of export jobs serviced by a fixed number of daemon worker threads.
+
+       Worker threads are started lazily on first submission, so that processes which never receive an asynchronous
+       export request do not carry idle threads.
+    """
+
+    def __init__(self, workers, max_queued, retry_after):
+        self.workers = workers
+        self.retry_after = retry_after
+        self.queue = Queue.Queue(max_queued)
+        self.threads = list()
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, name="ioboxd-export-worker-%d" % len(self.threads))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job.run()
+            finally:
+                self.queue.task_done()
+
+    def submit(self, job):
+        if self.workers < 1:
+            raise ServiceUnavailable("Asynchronous export is not enabled on this server.")
+        self.start()
+        # the status of a previous attempt at a resumed export is replaced
+        write_job_status(job.base_dir, JOB_QUEUED, replace=True, key=job.key, submitted=now(), pid=os.getpid())
+        try:
+            self.queue.put_nowait(job)
+        except Queue.Full:
+            write_job_status(job.base_dir, JOB_FAILED, finished=now(), error="Export job queue is full.")
+            raise ServiceUnavailable("Too many export jobs are queued, please try again later.",
+                                     headers={'Retry-After': str(self.retry_after)})
+
+
+jobs_config = dict(DEFAULT_JOBS_CONFIG)
+jobs_config.update(config.get("export_jobs", dict()))
+job_queue = ExportJobQueue(jobs_config["workers"], jobs_config["max_queued"], jobs_config["retry_after"])
+
+
+def is_job_pending(base_dir):
+    """Test whether an export directory has an asynchronous job waiting for a worker of a running process."""
+    job_status = read_job_status(base_dir)
+    return bool(job_status and job_status.get("status") == JOB_QUEUED and job_status.get("pid") and
+                process_exists(job_status["pid"]))
+
+
+def async_requested():
+    """Test whether the client asked for asynchronous processing, via "Prefer: respond-async" or "?async=true"."""
+    prefer = web.ctx.env.get('HTTP_PREFER', '')
+    if 'respond-async' in [p.strip().lower() for p in prefer.split(',')]:
+        return True
+    return web.input(_method="get").get("async", "false").lower() in ("true", "1", "yes")
+
+
+def submit_export(key, base_dir, params, make_uris):
+    # the timings of the request are logged in its audit record once it returns, so the job records its own
+    params = dict(params, timings=OrderedDict(params.get("timings") or ()))
+    job_queue.submit(ExportJob(key, base_dir, params, make_uris))
+
+
+def run_sync_export(key, base_dir, params, make_uris):
+    """Run an export synchronously, and return its output.
+
+       If the export resumes an interrupted job, the status of the job is replaced and kept up to date, so that the
+       clients of the job may follow the export.
+    """
+    if load_job_status(base_dir) is None:
+        return run_export(base_dir, params)
+    write_job_status(base_dir, JOB_RUNNING, replace=True, key=key, started=now(), pid=os.getpid())
+    try:
+        output = run_export(base_dir, params)
+        write_job_outcome(base_dir, uris=make_uris(output))
+    except Exception as e:
+        write_job_outcome(base_dir, error=e)
+        raise
+    return output
@@ -0,0 +1,110 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Export manifests.
+
+   When an export completes, a manifest describing its result files (relative path, size, checksum and content type)
+   and the identities permitted to access it is written to the export directory. Retrieval requests are then answered
+   from the manifest, which is also kept in a bounded in-process cache, rather than by listing the export directory and
+   reading its access descriptor on every request.
+"""
+
+import os
+import json
+import errno
+import hashlib
+import mimetypes
+from ioboxd.core import config, LRUCache
+from ioboxd.export.archive import get_archive_name, get_archive_content_type, get_worker_pool
+
+MANIFEST_FILE = ".manifest"
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+manifest_cache = LRUCache(config.get("manifest_cache_size", 1024))
+
+
+def compute_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            buf = f.read(CHECKSUM_BLOCK_SIZE)
+            if not buf:
+                break
+            digest.update(buf)
+    return digest.hexdigest()
+
+
+def read_access_descriptor(directory):
+    with open(os.path.abspath(os.path.join(directory, ".access")), 'r') as access:
+        return [identity.strip() for identity in access.readlines() if identity.strip()]
+
+
+def create_manifest(directory, stream_archiver=None, sources=None):
+    """Describe the result files of a completed export in its manifest file, and return the manifest.
+
+       Service metadata files, whose names begin with ".", are excluded. Files are listed in directory walk order, so
+       that the first file with a given name takes precedence in retrieval by name, as it does when walking the export.
+
+       If stream_archiver is specified, each top-level directory of the export is a bag to be archived in that format
+       when retrieved, and is described by a single entry for the archive rather than entries for its contents.
+
+       File checksums are computed concurrently on the shared worker pool, if it is enabled.
+
+       The sources of the files fetched from the object store, a mapping of relative path to URL, are also recorded,
+       for reuse by later exports. Sources of files no longer present in the export are omitted.
+    """
+    files = list()
+    for dirname, dirnames, filenames in os.walk(directory):
+        dirnames[:] = sorted([d for d in dirnames if not d.startswith(".")])
+        if stream_archiver and dirname == directory:
+            for bag_name in dirnames:
+                name = get_archive_name(bag_name, stream_archiver)
+                files.append(dict(path=bag_name,
+                                  name=name,
+                                  archiver=stream_archiver,
+                                  content_type=get_archive_content_type(stream_archiver)))
+            dirnames[:] = []
+        for filename in sorted(filenames):
+            if filename.startswith("."):
+                continue
+            file_path = os.path.join(dirname, filename)
+            content_type, content_encoding = mimetypes.guess_type(filename)
+            files.append(dict(path=os.path.relpath(file_path, directory),
+                              size=os.path.getsize(file_path),
+                              content_type=content_type or 'application/octet-stream'))
+
+    checksummed = [entry for entry in files if "archiver" not in entry]
+    paths = [os.path.join(directory, entry["path"]) for entry in checksummed]
+    pool = get_worker_pool()
+    for entry, sha256 in zip(checksummed, pool.map(compute_sha256, paths) if pool else map(compute_sha256, paths)):
+        entry["sha256"] = sha256
+    sources = dict([(path, url) for path, url in (sources or dict()).items()
+                    if os.path.isfile(os.path.join(directory, path))])
+    manifest = dict(files=files, owners=read_access_descriptor(directory), sources=sources)
+
+    temp_path = os.path.join(directory, ".%s.%d" % (MANIFEST_FILE, os.getpid()))
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.rename(temp_path, os.path.join(directory, MANIFEST_FILE))
+    return manifest
+
+
+def get_manifest(directory):
+    """Return the manifest of an export, or None if the export has no manifest (yet)."""
+    manifest = manifest_cache.get(directory)
+    if manifest is not None:
+        return manifest
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    manifest["by_name"] = dict()
+    for entry in manifest["files"]:
+        manifest["by_name"].setdefault(entry.get("name", os.path.basename(entry["path"])), entry)
+    manifest_cache.put(directory, manifest)
+    return manifest
@@ -0,0 +1,215 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Reuse of object store content across exports.
+
+   Files fetched from the object store (hatrac) by an export are recorded in its manifest as "sources", mapping each
+   file to the URL it was fetched from. An export may name a previous export as its base, in which case objects which
+   the base export already fetched, and which are unchanged, are hard linked (or copied, across filesystems) from the
+   base export into the new one rather than fetched again.
+
+   Objects not available from a base export are looked up in the blob cache shared by all exports (see
+   ioboxd.export.blobs), and objects fetched from the object store are added to it.
+
+   When an interrupted export is resumed (see ioboxd.export.checkpoint), the objects fetched by its previous attempts
+   are reused first, once their local copies have been verified against the checksums recorded in its checkpoint.
+
+   Versioned object URLs are immutable, so their content is reused from a base export or a previous attempt without
+   any request to the object store. The content of an unversioned URL is reused only if the object store confirms
+   that its checksum is unchanged. Objects in the blob cache may have been fetched on behalf of any client, so their
+   reuse is always confirmed by the object store with the credentials of the export, which also authorizes the client
+   to access them.
+
+   Files of an export may be hard links to objects shared with the blob cache and other exports, so existing files are
+   unlinked rather than overwritten in place when objects are fetched.
+"""
+
+import os
+import errno
+import shutil
+import threading
+import requests
+from contextlib import contextmanager
+from deriva.core import HatracStore, format_exception
+from ioboxd.core import logger as sys_logger, metrics
+from ioboxd.export.sessions import pooled_sessions
+from ioboxd.export.manifest import compute_sha256
+from ioboxd.export.blobs import blob_cache
+
+
+def is_versioned(url):
+    return ":" in url.rstrip("/").rsplit("/", 1)[-1]
+
+
+def link_or_copy(src, dst):
+    parent = os.path.dirname(dst)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def can_access_objects(server, credentials, urls):
+    """Test whether all the objects at urls, which are on the object store of server, may be retrieved with
+       credentials, by a HEAD request for each.
+    """
+    base_url = "%s://%s" % (server["protocol"], server["host"])
+    store = HatracStore(server["protocol"], server["host"], credentials)
+    with pooled_sessions(server, credentials, store=store):
+        for url in urls:
+            if url.startswith(base_url + "/"):
+                url = url[len(base_url):]
+            if not url.startswith("/"):
+                return False
+            try:
+                store.head(url)
+            except Exception as e:
+                sys_logger.info("Object [%s] is not accessible: %s" % (url, format_exception(e)))
+                return False
+    return True
+
+
+def reused_response(url):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    return response
+
+
+class ObjectFetcher(object):
+    """Fetches objects on behalf of an object store binding, reusing local copies of unchanged objects where possible,
+       and recording the source of every object fetched to the export directory.
+    """
+
+    def __init__(self, store, output_dir, base_sources, sources, progress=None, checkpoint=None, resume_sources=None):
+        self.store = store
+        self.get_obj = store.get_obj
+        self.output_dir = output_dir
+        self.base_sources = base_sources or dict()
+        self.sources = sources
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self.resume_sources = resume_sources or dict()
+        self.lock = threading.Lock()
+
+    def record(self, url, destfilename):
+        """Record the source of an object, and its completion in the export checkpoint, if any. Returns the checksum
+           of the object if it was computed, or None.
+        """
+        path = os.path.relpath(os.path.abspath(destfilename), self.output_dir)
+        with self.lock:
+            self.sources[path] = url
+        if not os.path.isfile(destfilename):
+            return None
+        if self.progress is not None:
+            self.progress.file_fetched(os.path.getsize(destfilename))
+        if self.checkpoint is None:
+            return None
+        sha256 = compute_sha256(destfilename)
+        self.checkpoint.file_fetched(url, path, sha256)
+        return sha256
+
+    def get_cache_url(self, url):
+        # object paths are relative to the object store host, which must be part of the cache key
+        if url.startswith("http"):
+            return url
+        return getattr(self.store, "_server_uri", "") + url
+
+    def is_unchanged(self, url, base_path=None, sha256=None, authorize=False):
+        """Test whether the content of url is that of a local copy, given by its path or checksum. Unless authorize is
+           set, versioned URLs are assumed unchanged without a request to the object store.
+        """
+        if is_versioned(url) and not authorize:
+            return True
+        content_equals = getattr(self.store, "content_equals", None)
+        if content_equals is None:
+            return False
+        try:
+            return content_equals(url, sha256=sha256 or compute_sha256(base_path))
+        except Exception as e:
+            sys_logger.warning("Unable to compare object [%s] with local copy: %s" % (url, format_exception(e)))
+            return False
+
+    def is_resumable(self, url):
+        staged = self.resume_sources.get(url)
+        if not staged or not os.path.isfile(staged[0]):
+            return False
+        staged_path, sha256 = staged
+        # the previous attempt may have been interrupted by a failure of the host, so its files are verified
+        return compute_sha256(staged_path) == sha256 and self.is_unchanged(url, sha256=sha256)
+
+    def reuse(self, url, destfilename):
+        """Place a local copy of url at destfilename, if there is an unchanged one, and return whether there was."""
+        base_path = self.base_sources.get(url)
+        if self.is_resumable(url):
+            link_or_copy(self.resume_sources[url][0], destfilename)
+            source = "checkpoint"
+        elif base_path and os.path.isfile(base_path) and self.is_unchanged(url, base_path):
+            link_or_copy(base_path, destfilename)
+            source = "base_export"
+        else:
+            cached = blob_cache.lookup(self.get_cache_url(url)) if blob_cache else None
+            if not cached or not self.is_unchanged(url, sha256=cached[0], authorize=True):
+                return False
+            try:
+                link_or_copy(cached[1], destfilename)
+            except (IOError, OSError):
+                # the object was evicted from the cache in the meantime
+                return False
+            source = "blob_cache"
+        metrics.increment("ioboxd_reused_objects_total", source=source)
+        metrics.increment("ioboxd_reused_bytes_total", os.path.getsize(destfilename), source=source)
+        return True
+
+    def cache(self, url, destfilename, sha256=None):
+        if not blob_cache or not os.path.isfile(destfilename) or os.path.getsize(destfilename) < blob_cache.min_size:
+            return
+        try:
+            blob_cache.add(self.get_cache_url(url), destfilename, sha256 or compute_sha256(destfilename))
+        except Exception as e:
+            sys_logger.warning("Unable to add object [%s] to blob cache: %s" % (url, format_exception(e)))
+
+    def __call__(self, path, *args, **kwargs):
+        # the HatracStore.get_obj(path, headers, destfilename, callback) signature
+        destfilename = kwargs.get("destfilename", args[1] if len(args) > 1 else None)
+        if not destfilename:
+            return self.get_obj(path, *args, **kwargs)
+        if self.reuse(path, destfilename):
+            self.record(path, destfilename)
+            return reused_response(path)
+        # an existing file may be linked to a shared object, which must not be overwritten in place
+        if os.path.lexists(destfilename):
+            os.remove(destfilename)
+        response = self.get_obj(path, *args, **kwargs)
+        self.cache(path, destfilename, self.record(path, destfilename))
+        return response
+
+
+@contextmanager
+def fetching_objects(store, output_dir, params):
+    """Substitute an ObjectFetcher for the get_obj() method of an object store binding, for the duration of the context.
+
+       The sources of fetched objects are added to params["sources"], and objects are reused from the base export
+       sources in params["base_sources"], if any. Fetched objects are reported to params["progress"], if any, and
+       recorded in params["checkpoint"], if any, and objects fetched by previous attempts of a resumed export are
+       reused from params["resume_sources"].
+    """
+    if store is None or not hasattr(store, "get_obj"):
+        yield
+        return
+    store.get_obj = ObjectFetcher(store, output_dir, params.get("base_sources"), params.setdefault("sources", dict()),
+                                  params.get("progress"), params.get("checkpoint"), params.get("resume_sources"))
+    try:
+        yield
+    finally:
+        del store.get_obj
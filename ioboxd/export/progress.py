@@ -0,0 +1,298 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Export progress events.
+
+   While an export runs, the service appends progress events to a ".progress" file in its export directory, one JSON
+   object per line, so that they can be followed through any of the service processes. Events are recorded:
+
+   * when the export enters a phase ("download", "bag", "manifest", "encode", "publish"),
+   * when each catalog query of the export starts and completes, with the number of rows (of results retrieved as a
+     whole) and bytes it returned,
+   * periodically, at most once per "min_interval" seconds, as files are fetched from the object store,
+   * when the export is done or has failed, which ends the events of the export.
+
+   Every event carries a snapshot of the progress of the export so far, including the number of files fetched out of
+   the total number of files listed by its "download" queries (where known), and the estimated remaining time of the
+   download phase derived from it. Events are numbered from 1, so that a client may resume following them from the
+   last event it received. The events of a resumed export (see ioboxd.export.checkpoint) replace those of its previous
+   attempt, and are numbered on from them.
+
+   Requests waiting for or streaming events each occupy a WSGI thread, so there are at most "max_waiters" of them per
+   process, well below the number of threads of the process, which remain available to run and retrieve exports.
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from ioboxd.core import config, logger as sys_logger
+
+PROGRESS_FILE = ".progress"
+
+EVENT_PHASE = "phase"
+EVENT_QUERY = "query"
+EVENT_PROGRESS = "progress"
+EVENT_DONE = "done"
+EVENT_FAILED = "failed"
+FINAL_EVENTS = (EVENT_DONE, EVENT_FAILED)
+
+DEFAULT_PROGRESS_CONFIG = {
+    "enabled": True,
+    "min_interval": 1.0,
+    "poll_interval": 0.5,
+    "max_wait": 20,
+    "max_stream_seconds": 60,
+    "keepalive": 15,
+    "max_waiters": 1,
+    "retry_after": 5
+}
+PROGRESS_CONFIG = dict(DEFAULT_PROGRESS_CONFIG)
+PROGRESS_CONFIG.update(config.get("export_progress", dict()))
+
+progress_waiters = threading.BoundedSemaphore(max(PROGRESS_CONFIG["max_waiters"], 0))
+
+
+def acquire_waiter():
+    """Reserve a slot for a request waiting for or streaming progress events, and return whether one was available.
+       The slot must be released with release_waiter().
+    """
+    return progress_waiters.acquire(False)
+
+
+def release_waiter():
+    progress_waiters.release()
+
+
+class ExportProgress(object):
+    """Records the progress events of an export to its export directory.
+
+       If the export directory is None, progress is tracked but no events are recorded.
+    """
+
+    def __init__(self, base_dir=None, min_interval=PROGRESS_CONFIG["min_interval"]):
+        self.path = os.path.join(base_dir, PROGRESS_FILE) if base_dir else None
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_event = 0
+        self.event_id = 0
+        if self.path and os.path.isfile(self.path):
+            events, finished = read_progress(base_dir)
+            self.event_id = events[-1]["id"] if events else 0
+            os.remove(self.path)
+        self.download_start = None
+        self.state = dict(phase=None, query=None, queries=0, rows=0, query_bytes=0, files=0, files_total=None,
+                          file_bytes=0)
+
+    def snapshot(self):
+        """Return the progress of the export so far. The caller must hold the lock."""
+        state = dict(self.state)
+        now = time.time()
+        state["elapsed"] = round(now - self.start, 1)
+        files, files_total = state["files"], state["files_total"]
+        if state["phase"] == "download" and files and files_total and self.download_start:
+            state["eta"] = round((now - self.download_start) * max(files_total - files, 0) / float(files), 1)
+        return state
+
+    def record(self, event, **details):
+        """Record an event along with a snapshot of the progress so far. The caller must hold the lock."""
+        self.last_event = time.time()
+        if not self.path:
+            return
+        self.event_id += 1
+        record = self.snapshot()
+        record.update(details)
+        record.update(id=self.event_id, event=event, time=round(self.last_event, 3))
+        try:
+            with open(self.path, 'a') as progress_file:
+                progress_file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        except (IOError, OSError) as e:
+            # progress events are informational, and must not fail the export
+            sys_logger.warning("Unable to record progress event to [%s]: %s" % (self.path, e))
+
+    def phase(self, name):
+        with self.lock:
+            self.state["phase"] = name
+            if name == "download":
+                self.download_start = time.time()
+            self.record(EVENT_PHASE)
+
+    def query_started(self, query):
+        with self.lock:
+            self.state["query"] = query
+            self.record(EVENT_QUERY, status="started")
+
+    def query_completed(self, query, rows=None, nbytes=0, files=None, error=None):
+        """Account for a completed catalog query. If files is given, it is the number of files listed by the query,
+           which are to be fetched by the export.
+        """
+        with self.lock:
+            self.state["queries"] += 1
+            self.state["rows"] += rows or 0
+            self.state["query_bytes"] += nbytes
+            if files is not None:
+                self.state["files_total"] = (self.state["files_total"] or 0) + files
+            details = dict(status="failed" if error else "completed", query_rows=rows, query_bytes=nbytes)
+            if error:
+                details["error"] = error
+            self.state["query"] = query
+            self.record(EVENT_QUERY, **details)
+            self.state["query"] = None
+
+    def file_fetched(self, nbytes):
+        with self.lock:
+            self.state["files"] += 1
+            self.state["file_bytes"] += nbytes
+            if (time.time() - self.last_event) >= self.min_interval:
+                self.record(EVENT_PROGRESS)
+
+    def finish(self, outcome, error=None):
+        with self.lock:
+            self.state["query"] = None
+            self.download_start = None
+            self.record(EVENT_DONE if outcome == EVENT_DONE else EVENT_FAILED, **(dict(error=error) if error else {}))
+
+
+def create_progress(base_dir):
+    """Return the progress recorder of an export run in base_dir, which records events only if enabled."""
+    return ExportProgress(base_dir if PROGRESS_CONFIG["enabled"] else None)
+
+
+def get_query_path(path):
+    return path.split("?", 1)[0].rstrip("/")
+
+
+class QueryTracker(object):
+    """Reports the catalog queries made through a method of a catalog binding (get() or getAsFile()) as progress.
+
+       The results of the queries whose paths are among file_query_paths list files to be fetched by the export.
+    """
+
+    def __init__(self, method, progress, file_query_paths, as_file=False):
+        self.method = method
+        self.progress = progress
+        self.file_query_paths = file_query_paths
+        self.as_file = as_file
+
+    def __call__(self, path, *args, **kwargs):
+        query = get_query_path(path)
+        self.progress.query_started(query)
+        try:
+            response = self.method(path, *args, **kwargs)
+        except Exception as e:
+            self.progress.query_completed(query, error=str(e))
+            raise
+        rows = files = None
+        if self.as_file:
+            # the getAsFile(path, destfilename, ...) signature
+            destfilename = kwargs.get("destfilename", args[0] if args else None)
+            nbytes = os.path.getsize(destfilename) if destfilename and os.path.isfile(destfilename) else 0
+        else:
+            content = response.content or ''
+            nbytes = len(content)
+            if content[:1] == '[':
+                try:
+                    rows = len(response.json())
+                except ValueError:
+                    rows = None
+            if query in self.file_query_paths:
+                files = rows
+        self.progress.query_completed(query, rows, nbytes, files)
+        return response
+
+
+@contextmanager
+def tracking_queries(catalog, progress, export_config):
+    """Substitute QueryTrackers for the query methods of a catalog binding, for the duration of the context.
+
+       The paths of the "download" queries of the export configuration, which list the files fetched by the export, are
+       matched against the queries made, unless they depend on variables set at export time.
+    """
+    if catalog is None or progress is None:
+        yield
+        return
+    queries = export_config.get("catalog", dict()).get("query_processors") or list()
+    file_query_paths = set([get_query_path((query.get("processor_params") or dict()).get("query_path") or "")
+                            for query in queries if query.get("processor") == "download"])
+    methods = [name for name in ("get", "getAsFile") if hasattr(catalog, name)]
+    for name in methods:
+        setattr(catalog, name, QueryTracker(getattr(catalog, name), progress, file_query_paths, name == "getAsFile"))
+    try:
+        yield
+    finally:
+        for name in methods:
+            delattr(catalog, name)
+
+
+def read_progress(base_dir, since=0):
+    """Return the progress events of an export numbered after since, and whether the export has finished.
+
+       An export without progress events has finished if it has a manifest, or failed as an asynchronous job.
+    """
+    events = list()
+    try:
+        with open(os.path.join(base_dir, PROGRESS_FILE), 'r') as progress_file:
+            for line in progress_file:
+                if not line.endswith('\n'):
+                    # an event being written
+                    break
+                event = json.loads(line)
+                if event["id"] > since:
+                    events.append(event)
+                if event["event"] in FINAL_EVENTS:
+                    return events, True
+    except IOError:
+        pass
+    return events, False
+
+
+def wait_progress(base_dir, since=0, wait=0, finished=None):
+    """Return the progress events of an export numbered after since, waiting up to wait seconds for one if there are
+       none yet, and whether the export has finished.
+
+       If given, finished is called to test whether an export without a final event has finished nonetheless, e.g.
+       because it was run before progress events were recorded, or its process exited while running it.
+    """
+    deadline = time.time() + min(wait, PROGRESS_CONFIG["max_wait"])
+    while True:
+        events, done = read_progress(base_dir, since)
+        if events or done:
+            return events, done
+        if finished is not None and finished():
+            return events, True
+        if time.time() >= deadline:
+            return events, False
+        time.sleep(PROGRESS_CONFIG["poll_interval"])
+
+
+def format_event(event):
+    """Format a progress event as a server-sent event."""
+    return "id: %d\nevent: %s\ndata: %s\n\n" % (event["id"], event["event"], json.dumps(event, separators=(',', ':')))
+
+
+def stream_progress(base_dir, since=0, finished=None, waiter=False):
+    """Generate the progress events of an export numbered after since as server-sent events, until the export has
+       finished or max_stream_seconds have elapsed, after which the client is expected to reconnect.
+
+       If waiter is set, the caller has reserved a waiter slot for the stream, which is released when the stream ends.
+    """
+    try:
+        deadline = time.time() + PROGRESS_CONFIG["max_stream_seconds"]
+        keepalive = PROGRESS_CONFIG["keepalive"]
+        yield "retry: %d\n\n" % int(PROGRESS_CONFIG["poll_interval"] * 1000)
+        while time.time() < deadline:
+            events, done = wait_progress(base_dir, since, min(keepalive, deadline - time.time()), finished)
+            for event in events:
+                since = event["id"]
+                yield format_event(event)
+            if done:
+                return
+            if not events:
+                yield ": keepalive\n\n"
+    finally:
+        if waiter:
+            release_waiter()
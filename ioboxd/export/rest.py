@@ -1,8 +1,138 @@
 import os
 import web
+import json
 import urllib
-from ioboxd.core import web_method, RestHandler, NotFound, Forbidden, BadRequest, STORAGE_PATH
-from ioboxd.export.api import check_access
+from ioboxd.core import web_method, RestHandler, NotFound, Forbidden, BadRequest, Conflict, RequestEntityTooLarge, \
+    ServiceUnavailable, STORAGE_PATH, metrics, get_client_identity, read_request_body
+from ioboxd.metrics import timed
+from ioboxd.export.api import check_access, create_output_dir, create_access_descriptor, grant_access, \
+    prepare_export, lookup_cached_export, single_flight, lookup_checkpoint
+from ioboxd.export.storage import storage_manager
+from ioboxd.export.backends import storage_backend
+from ioboxd.export.admission import admission_controller
+from ioboxd.export.manifest import get_manifest
+from ioboxd.export.archive import stream_archive
+from ioboxd.export.encoding import is_compressible, get_encoded_variant
+from ioboxd.export.estimate import estimate_export, ESTIMATE_CONFIG
+from ioboxd.export.uploads import create_upload, read_upload, write_upload_chunk, delete_upload
+from ioboxd.export.jobs import read_job_status, async_requested, submit_export, is_job_pending, run_sync_export, \
+    JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+from ioboxd.export.progress import wait_progress, stream_progress, acquire_waiter, release_waiter, PROGRESS_CONFIG
+
+
+def read_export_config():
+    """Parse the export configuration in the request body, which is bounded by the maximum request body size."""
+    with timed(metrics, web.ctx.ioboxd_timings, "parse"):
+        body = read_request_body()
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise BadRequest("Error parsing configuration: %s" % e)
+
+
+def create_export_dir(params):
+    """Return the (key, output directory) of an interrupted, identical export to be resumed, or of a new export.
+
+       An interrupted export which has already been resubmitted as an asynchronous job is not resumed again.
+    """
+    resumable = lookup_checkpoint(params)
+    if resumable and not is_job_pending(resumable[1]):
+        # the access descriptor of the interrupted export may list clients which were granted access to it since
+        grant_access(resumable[1], params["owner"])
+        return resumable
+    key, output_dir = create_output_dir()
+    create_access_descriptor(output_dir, params["owner"])
+    return key, output_dir
+
+
+class ExportHandler (RestHandler):
+    """Common export request processing, specialized by the export providers."""
+
+    files_only = False
+
+    def __init__(self):
+        RestHandler.__init__(self)
+
+    def output_urls(self, url, output):
+        """Map the output of an export to the URL or list of URLs to return to the client.
+
+           By default, this is the URL of the export itself, preceded by the landing page or resolver URLs of the
+           identifier of its (first) output, if it was assigned one.
+        """
+        output_metadata = (output.values()[0] or {}) if output else {}
+
+        identifier_landing_page = output_metadata.get("identifier_landing_page")
+        if identifier_landing_page:
+            url = [identifier_landing_page, url]
+        else:
+            identifier = output_metadata.get("identifier")
+            if identifier:
+                url = ["https://n2t.net/" + identifier, "https://identifiers.org/" + identifier, url]
+        return url
+
+    def export_response(self, urls):
+        return self.create_response(urls)
+
+    @web_method()
+    def POST(self):
+        params = prepare_export(config=read_export_config(), files_only=self.files_only)
+        base_url = ''.join([web.ctx.home, web.ctx.path, '/' if not web.ctx.path.endswith("/") else ""])
+
+        # return the result of an identical, previous export if we still have it
+        cached = lookup_cached_export(params)
+        if cached:
+            key, output = cached
+            return self.export_response(self.output_urls(base_url + key, output))
+
+        # reject exports estimated to exceed the configured size limit, if any
+        max_bytes = ESTIMATE_CONFIG["max_export_bytes"]
+        if max_bytes:
+            with timed(metrics, params["timings"], "estimate"):
+                estimate = estimate_export(params)
+            if estimate["bytes"] > max_bytes:
+                raise RequestEntityTooLarge("The export is estimated to write %d bytes, which exceeds the limit of %d "
+                                            "bytes." % (estimate["bytes"], max_bytes))
+
+        # perform the export asynchronously, if requested
+        if async_requested():
+            key, output_dir = create_export_dir(params)
+            url = base_url + key
+            submit_export(key, output_dir, params, lambda output: self.output_urls(url, output))
+            return self.accepted_response(url + "/status")
+
+        # perform the export once there is capacity for it, unless an identical export already in progress completes
+        # in the meantime
+        with single_flight(params) as flight:
+            if flight.result:
+                key, output = flight.result
+                return self.export_response(self.output_urls(base_url + key, output))
+            with admission_controller.admitted(params["owner"], timings=params["timings"]):
+                key, output_dir = create_export_dir(params)
+                output = run_sync_export(key, output_dir, params,
+                                         lambda output: self.output_urls(base_url + key, output))
+            flight.complete(key, output)
+        return self.export_response(self.output_urls(base_url + key, output))
+
+
+class ExportEstimateHandler (RestHandler):
+    """Estimates the cost of an export without running it, specialized by the export providers."""
+
+    files_only = False
+
+    def __init__(self):
+        RestHandler.__init__(self)
+
+    @web_method()
+    def POST(self):
+        params = prepare_export(config=read_export_config(), files_only=self.files_only)
+        with timed(metrics, params["timings"], "estimate"):
+            estimate = estimate_export(params)
+        web.ctx.status = '200 OK'
+        web.ctx.ioboxd_content_type = 'application/json'
+        web.header('Content-Type', web.ctx.ioboxd_content_type)
+        body = json.dumps(estimate, indent=2) + '\n'
+        web.header('Content-Length', len(body))
+        return body
 
 
 class ExportRetrieve (RestHandler):
@@ -12,41 +142,125 @@ class ExportRetrieve (RestHandler):
 
     def send_log(self, file_path):
         web.ctx.ioboxd_content_type = 'text/plain'
-        web.header('Content-Type', web.ctx.ioboxd_content_type)
-        return self.get_content(file_path, web.ctx.webauthn2_context)
+        return self.get_content(file_path, web.ctx.webauthn2_context, self.get_body, web.ctx.ioboxd_content_type)
 
-    def send_content(self, file_path):
-        web.ctx.ioboxd_content_type = 'application/octet-stream'  # should eventually try to be more specific here
-        web.header('Content-Type', web.ctx.ioboxd_content_type)
+    def send_content(self, file_path, entry=None, export_dir=None):
+        """Send an export file, or the compressed variant of it preferred by the client if the file is described by a
+           manifest entry.
+        """
+        web.ctx.ioboxd_content_type = 'application/octet-stream'
+        if entry:
+            # files stored remotely by the storage backend are served by it directly
+            url = storage_backend.redirect(export_dir, entry, web.ctx.method)
+            if url:
+                return self.redirect_response(url)
         web.header('Content-Disposition', "filename*=UTF-8''%s" % urllib.quote(os.path.basename(file_path)))
-        return self.get_content(file_path, web.ctx.webauthn2_context)
+        if entry:
+            self.http_etag = '"%s"' % entry["sha256"]
+            web.ctx.ioboxd_content_type = entry["content_type"]
+            if is_compressible(entry):
+                self.http_vary = list(self.http_vary or []) + ['Accept-Encoding']
+                variant = get_encoded_variant(export_dir, entry, web.ctx.env.get('HTTP_ACCEPT_ENCODING'))
+                if variant:
+                    coding, file_path = variant
+                    # each representation of the file has its own entity tag
+                    self.http_etag = '"%s-%s"' % (entry["sha256"], coding)
+                    web.header('Content-Encoding', coding)
+        return self.get_content(file_path, web.ctx.webauthn2_context, self.get_body, web.ctx.ioboxd_content_type,
+                                offload=storage_backend.offload)
+
+    def send_archive(self, bag_path, entry):
+        """Send a bag directory as an archive generated on the fly.
+
+           The archive length is not known in advance, so the response is sent without a Content-Length, and byte
+           range requests are not supported.
+        """
+        web.ctx.status = '200 OK'
+        web.ctx.ioboxd_content_type = entry["content_type"]
+        web.header('Content-Type', web.ctx.ioboxd_content_type)
+        web.header('Content-Disposition', "filename*=UTF-8''%s" % urllib.quote(entry["name"].encode('utf-8')))
+        web.header('Accept-Ranges', 'none')
+        if not self.get_body:
+            return
+        return self.timed_archive(stream_archive(bag_path, entry["path"], entry["archiver"]))
+
+    @staticmethod
+    def timed_archive(stream):
+        # the archive is generated as the response body is consumed, after the request has been logged, so its
+        # generation time and size are only reported to the service metrics
+        nbytes = 0
+        with timed(metrics, None, "archive"):
+            for buf in stream:
+                nbytes += len(buf)
+                yield buf
+        metrics.increment("ioboxd_archive_bytes_total", nbytes)
 
     @web_method()
     def GET(self, key, requested_file=None):
         export_dir = os.path.abspath(os.path.join(STORAGE_PATH, key))
-        if not os.path.isdir(export_dir):
+        if key.startswith(".") or not os.path.isdir(export_dir):
             raise NotFound("The resource %s does not exist. It was never created or has been deleted." % key)
-        if not check_access(export_dir):
+        manifest = get_manifest(export_dir)
+        if not check_access(export_dir, manifest):
             return Forbidden("The currently authenticated user is not permitted to access the specified resource.")
+        storage_manager.touch(key)
+
+        if manifest is None:
+            return self.walk_export(key, export_dir, requested_file)
+
+        # the export is complete and its manifest describes the files we can reply with
+        log_path = os.path.abspath(os.path.join(export_dir, ".log"))
+        if requested_file == 'log' and os.path.isfile(log_path):
+            return self.send_log(log_path)
+
+        files = manifest["files"]
+        if not files:
+            self.not_found_with_log(log_path)
+        if not requested_file:
+            # if there is more than one file in the resource bucket and the caller wasn't explicit about
+            # which one to retrieve, it is a bad request.
+            if len(files) > 1:
+                raise BadRequest("The resource %s contains more than one file, it is therefore necessary "
+                                 "to specify a filename in the request URL." % key)
+            entry = files[0]
+        else:
+            entry = manifest["by_name"].get(requested_file)
+            if not entry:
+                raise NotFound("The requested file \"%s\" does not exist." % requested_file)
+
+        if entry.get("archiver"):
+            return self.send_archive(os.path.abspath(os.path.join(export_dir, entry["path"])), entry)
+        return self.send_content(os.path.abspath(os.path.join(export_dir, entry["path"])), entry, export_dir)
 
+    @staticmethod
+    def not_found_with_log(log_path):
+        # raise a 404 but also try to send back the log (if it exists) as additional diagnostic info.
+        log_text = 'No additional diagnostic information available.\n'
+        if os.path.isfile(log_path):
+            with open(log_path) as log:
+                log_text = log.read()
+        raise NotFound(log_text)
+
+    def walk_export(self, key, export_dir, requested_file=None):
+        """Locate the requested file by walking an export directory which has no manifest."""
+        job_status = read_job_status(export_dir)
         for dirname, dirnames, filenames in os.walk(export_dir):
             # first, deal with the special case "metadata" files...
-            if ".access" in filenames:
-                filenames.remove(".access")
             log_path = os.path.abspath(os.path.join(dirname, ".log"))
             if ".log" in filenames:
                 if requested_file and requested_file == 'log':
                     return self.send_log(log_path)
-                filenames.remove(".log")
+            # service metadata files such as ".access", ".log" and ".job" are never returned as export content
+            filenames = [filename for filename in filenames if not filename.startswith(".")]
+
+            # an asynchronous export that has not yet completed has nothing to reply with yet
+            if job_status and job_status.get("status") in (JOB_QUEUED, JOB_RUNNING):
+                raise Conflict("The export %s is %s. Poll the status resource for completion."
+                               % (key, job_status.get("status")))
 
             # if there are no remaining files in the dir list, we don't have anything to reply with.
-            # so, raise a 404 but also try to send back the log (if it exists) as additional diagnostic info.
             if not filenames:
-                log_text = 'No additional diagnostic information available.\n'
-                if os.path.isfile(log_path):
-                    with open(log_path) as log:
-                        log_text = log.read()
-                raise NotFound(log_text)
+                self.not_found_with_log(log_path)
             else:
                 # otherwise we've got at least one file to reply with...
                 for filename in filenames:
@@ -68,3 +282,146 @@ class ExportRetrieve (RestHandler):
 
         # if we got here it means the caller asked for something that does not exist.
         raise NotFound("The requested file \"%s\" does not exist." % requested_file)
+
+
+class ExportStatus (RestHandler):
+
+    def __init__(self):
+        RestHandler.__init__(self)
+
+    @web_method()
+    def GET(self, key):
+        export_dir = os.path.abspath(os.path.join(STORAGE_PATH, key))
+        if key.startswith(".") or not os.path.isdir(export_dir):
+            raise NotFound("The resource %s does not exist. It was never created or has been deleted." % key)
+        if not check_access(export_dir):
+            raise Forbidden("The currently authenticated user is not permitted to access the specified resource.")
+
+        job_status = read_job_status(export_dir)
+        if job_status is None:
+            raise NotFound("The resource %s was not created by an asynchronous export request." % key)
+
+        web.ctx.status = '200 OK'
+        web.ctx.ioboxd_content_type = 'application/json'
+        web.header('Content-Type', web.ctx.ioboxd_content_type)
+        body = json.dumps(job_status, indent=2) + '\n'
+        web.header('Content-Length', len(body))
+        return body if self.get_body else ''
+
+
+class ExportProgress (RestHandler):
+
+    def __init__(self):
+        RestHandler.__init__(self)
+
+    @staticmethod
+    def get_since():
+        since = web.ctx.env.get('HTTP_LAST_EVENT_ID') or web.input(_method="get").get("since") or "0"
+        try:
+            return int(since)
+        except ValueError:
+            raise BadRequest("Invalid event id: %s" % since)
+
+    @staticmethod
+    def acquire_waiter():
+        if not acquire_waiter():
+            raise ServiceUnavailable("Too many requests are waiting for export progress, please try again later.",
+                                     headers={'Retry-After': str(PROGRESS_CONFIG["retry_after"])})
+
+    @staticmethod
+    def is_finished(export_dir):
+        # exports which completed or failed without recording a final progress event
+        job_status = read_job_status(export_dir)
+        if job_status:
+            return job_status.get("status") in (JOB_DONE, JOB_FAILED)
+        return get_manifest(export_dir) is not None
+
+    @web_method()
+    def GET(self, key):
+        export_dir = os.path.abspath(os.path.join(STORAGE_PATH, key))
+        if key.startswith(".") or not os.path.isdir(export_dir):
+            raise NotFound("The resource %s does not exist. It was never created or has been deleted." % key)
+        if not check_access(export_dir):
+            raise Forbidden("The currently authenticated user is not permitted to access the specified resource.")
+        since = self.get_since()
+        web.header('Cache-Control', 'no-store')
+
+        if 'text/event-stream' in web.ctx.env.get('HTTP_ACCEPT', ''):
+            if self.get_body:
+                self.acquire_waiter()
+            web.ctx.status = '200 OK'
+            web.ctx.ioboxd_content_type = 'text/event-stream'
+            web.header('Content-Type', web.ctx.ioboxd_content_type)
+            web.header('X-Accel-Buffering', 'no')
+            if not self.get_body:
+                return
+            return stream_progress(export_dir, since, lambda: self.is_finished(export_dir), waiter=True)
+
+        wait = web.input(_method="get").get("wait") or "0"
+        try:
+            wait = float(wait) if self.get_body else 0
+        except ValueError:
+            raise BadRequest("Invalid wait: %s" % wait)
+        if wait > 0:
+            self.acquire_waiter()
+            try:
+                events, finished = wait_progress(export_dir, since, wait, lambda: self.is_finished(export_dir))
+            finally:
+                release_waiter()
+        else:
+            events, finished = wait_progress(export_dir, since, 0, lambda: self.is_finished(export_dir))
+        web.ctx.status = '200 OK'
+        web.ctx.ioboxd_content_type = 'application/json'
+        web.header('Content-Type', web.ctx.ioboxd_content_type)
+        body = json.dumps(dict(events=events, last_id=events[-1]["id"] if events else since, finished=finished),
+                          indent=2) + '\n'
+        web.header('Content-Length', len(body))
+        return body if self.get_body else ''
+
+
+class ExportUploads (RestHandler):
+
+    def __init__(self):
+        RestHandler.__init__(self)
+
+    @web_method()
+    def POST(self):
+        total = web.ctx.env.get('HTTP_UPLOAD_LENGTH')
+        try:
+            total = int(total) if total else None
+        except ValueError:
+            raise BadRequest("Invalid Upload-Length header: %s" % total)
+        identity = get_client_identity()
+        upload_id, upload = create_upload(identity.get('id') if identity else None, total)
+        url = ''.join([web.ctx.home, web.ctx.path, '/' if not web.ctx.path.endswith("/") else "", upload_id])
+        web.header('Upload-Offset', str(upload["size"]))
+        return self.create_response(url)
+
+
+class ExportUpload (RestHandler):
+
+    def __init__(self):
+        RestHandler.__init__(self)
+
+    @web_method()
+    def GET(self, upload_id):
+        upload = read_upload(upload_id)
+        web.ctx.status = '200 OK'
+        web.ctx.ioboxd_content_type = 'application/json'
+        web.header('Content-Type', web.ctx.ioboxd_content_type)
+        web.header('Upload-Offset', str(upload["size"]))
+        web.header('Cache-Control', 'no-store')
+        body = json.dumps(upload, indent=2) + '\n'
+        web.header('Content-Length', len(body))
+        return body if self.get_body else ''
+
+    @web_method()
+    def PUT(self, upload_id):
+        upload = write_upload_chunk(upload_id, web.ctx.env.get('HTTP_CONTENT_RANGE'))
+        web.header('Upload-Offset', str(upload["size"]))
+        return self.update_response()
+
+    @web_method()
+    def DELETE(self, upload_id):
+        delete_upload(upload_id)
+        return self.delete_response()
@@ -0,0 +1,131 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Per-process pool of persistent HTTP sessions to catalog and object store hosts.
+
+   The deriva bindings used by an export each create a new requests session, so every export would otherwise pay for
+   new TCP and TLS connection setup. Sessions are pooled by binding type, host and credential, and are handed out
+   exclusively, so a session (and its keep-alive connections) is only ever used by one export thread at a time.
+
+   The connections each session opens to a host are bounded by "max_connections_per_host". Requests made through a
+   session while all of its connections to the host are in use wait for one to be released, rather than opening more.
+"""
+
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from ioboxd.core import config
+
+DEFAULT_SESSION_POOL_CONFIG = {
+    "enabled": True,
+    "max_sessions": 32,
+    "idle_timeout": 30,
+    "max_connections_per_host": 4
+}
+
+
+class SessionPool(object):
+    """A bounded pool of idle sessions, keyed by an arbitrary hashable key.
+
+       Sessions idle for longer than idle_timeout seconds are closed, as are the least recently used idle sessions once
+       more than max_sessions are pooled.
+    """
+
+    def __init__(self, max_sessions, idle_timeout):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        """Remove and return the most recently used idle session for key, or None if there is none."""
+        with self.lock:
+            self.evict()
+            sessions = self.idle.get(key)
+            if not sessions:
+                return None
+            last_used, session = sessions.pop()
+            return session
+
+    def release(self, key, session):
+        """Return a session to the pool for reuse."""
+        with self.lock:
+            self.idle.setdefault(key, list()).append((time.time(), session))
+            self.evict()
+
+    def evict(self):
+        """Close expired sessions, then the least recently used sessions over the limit. The caller holds the lock."""
+        expiry = time.time() - self.idle_timeout
+        pooled = list()
+        for key, sessions in self.idle.items():
+            for last_used, session in sessions:
+                pooled.append((last_used, key, session))
+        pooled.sort()
+        excess = len(pooled) - self.max_sessions
+        for i, (last_used, key, session) in enumerate(pooled):
+            if i < excess or last_used < expiry:
+                self.idle[key].remove((last_used, session))
+                if not self.idle[key]:
+                    del self.idle[key]
+                session.close()
+
+
+session_pool_config = dict(DEFAULT_SESSION_POOL_CONFIG)
+session_pool_config.update(config.get("session_pool", dict()))
+session_pool = SessionPool(session_pool_config["max_sessions"], session_pool_config["idle_timeout"])
+
+
+def limit_connections(session, maxsize):
+    """Bound the connections of a session to each host to maxsize, blocking requests for a connection beyond it."""
+    for adapter in session.adapters.values():
+        if not hasattr(adapter, "init_poolmanager") or \
+                (getattr(adapter, "_pool_maxsize", None) == maxsize and getattr(adapter, "_pool_block", False)):
+            continue
+        adapter.poolmanager.clear()
+        adapter.init_poolmanager(adapter._pool_connections, maxsize, block=True)
+
+
+def get_session_key(binding_type, server, credentials):
+    credential_hash = hashlib.sha256(json.dumps(credentials, sort_keys=True).encode('utf-8')).hexdigest()
+    return binding_type, server["protocol"], server["host"], credential_hash
+
+
+@contextmanager
+def pooled_sessions(server, credentials, **bindings):
+    """Substitute pooled sessions into the given deriva bindings for the duration of the context.
+
+       Each keyword argument names a binding type (e.g. "catalog" or "store") and gives the binding instance. Bindings
+       without a pooled session available keep the session they were created with, and on exit the session in use by
+       each binding is returned to the pool, so that it is available to later exports with the same credentials.
+
+       The connections of the sessions of the bindings are bounded by max_connections_per_host, whether pooled or not.
+    """
+    bindings = dict([(binding_type, binding) for binding_type, binding in bindings.items()
+                     if binding is not None and hasattr(binding, "_session")])
+    max_connections = session_pool_config["max_connections_per_host"]
+    if not session_pool_config["enabled"]:
+        if max_connections:
+            for binding in bindings.values():
+                limit_connections(binding._session, max_connections)
+        yield
+        return
+
+    keys = dict()
+    for binding_type, binding in bindings.items():
+        key = get_session_key(binding_type, server, credentials)
+        keys[binding_type] = key
+        session = session_pool.acquire(key)
+        if session is not None:
+            binding._session.close()
+            binding._session = session
+        if max_connections:
+            limit_connections(binding._session, max_connections)
+    try:
+        yield
+    finally:
+        for binding_type, key in keys.items():
+            session_pool.release(key, bindings[binding_type]._session)
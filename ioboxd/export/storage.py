@@ -0,0 +1,235 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Export storage management.
+
+   Completed exports are recorded in a small index file at the root of the storage path, holding the owner, size and
+   creation time of each export. The time of last retrieval of an export is kept as the modification time of its
+   access descriptor, so that recording a retrieval requires neither locking nor rewriting the index.
+
+   A sweep removes exports not retrieved within the maximum age, then evicts the least recently retrieved exports of
+   any user over the per-user quota, and finally the least recently retrieved exports over the total quota. Sweeps run
+   opportunistically as exports complete, and may also be run periodically with "python -m ioboxd.export.storage".
+
+   Exports are removed in two steps, so that the index is not kept locked while their files are deleted: while the
+   index is locked, the directories of the exports to be removed are only renamed into the ".trash" directory of the
+   storage path, and once the lock is released, the contents of the trash are deleted, along with the copies of the
+   exports held by the storage backend.
+"""
+
+import os
+import json
+import time
+import errno
+import fcntl
+import uuid
+import shutil
+import logging
+from contextlib import contextmanager
+from ioboxd.core import STORAGE_PATH, config, logger as sys_logger
+from ioboxd.export.backends import storage_backend
+
+DEFAULT_STORAGE_QUOTA_CONFIG = {
+    "max_age_hours": 72,
+    "max_bytes": 0,
+    "max_bytes_per_user": 0,
+    "sweep_interval": 60
+}
+
+
+def get_dir_size(directory):
+    nbytes = 0
+    for dirname, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            nbytes += os.path.getsize(os.path.join(dirname, filename))
+    return nbytes
+
+
+class StorageManager(object):
+
+    def __init__(self, storage_path, max_age_hours, max_bytes, max_bytes_per_user, sweep_interval):
+        self.storage_path = storage_path
+        self.max_age = max_age_hours * 3600
+        self.max_bytes = max_bytes
+        self.max_bytes_per_user = max_bytes_per_user
+        self.sweep_interval = sweep_interval
+        self.index_path = os.path.join(storage_path, ".index")
+        self.lock_path = os.path.join(storage_path, ".index.lock")
+        self.trash_path = os.path.join(storage_path, ".trash")
+
+    @contextmanager
+    def locked(self):
+        """Serialize access to the index across threads and processes with an exclusive lock file."""
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_index(self):
+        try:
+            with open(self.index_path, 'r') as index_file:
+                return json.load(index_file)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return dict(swept=0, exports=dict())
+            raise
+        except ValueError:
+            sys_logger.warning("Discarding corrupt storage index [%s]" % self.index_path)
+            return dict(swept=0, exports=dict())
+
+    def write_index(self, index):
+        temp_path = "%s.%d" % (self.index_path, os.getpid())
+        with open(temp_path, 'w') as index_file:
+            json.dump(index, index_file)
+        os.rename(temp_path, self.index_path)
+
+    def get_export_dir(self, key):
+        return os.path.join(self.storage_path, key)
+
+    def get_last_access(self, key, entry):
+        try:
+            return os.path.getmtime(os.path.join(self.get_export_dir(key), ".access"))
+        except OSError:
+            return entry.get("created", 0)
+
+    def register(self, key, owner, nbytes=None):
+        """Record a completed export in the index, and sweep if a sweep is due."""
+        if nbytes is None:
+            nbytes = get_dir_size(self.get_export_dir(key))
+        entry = dict(owner=owner or "*", bytes=nbytes, created=time.time())
+        with self.locked():
+            index = self.read_index()
+            index["exports"][key] = entry
+            if (time.time() - index.get("swept", 0)) >= self.sweep_interval:
+                self.sweep_index(index)
+            self.write_index(index)
+        self.empty_trash()
+
+    def touch(self, key):
+        """Record the retrieval of an export."""
+        try:
+            os.utime(os.path.join(self.get_export_dir(key), ".access"), None)
+        except OSError:
+            pass
+
+    def remove(self, key, reason):
+        """Move an export to the trash, to be deleted by empty_trash(). The caller must hold the lock."""
+        sys_logger.info("Removing export [%s]: %s" % (key, reason))
+        if not os.path.isdir(self.trash_path):
+            try:
+                os.makedirs(self.trash_path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # the export key is recovered from the name of the trash entry when it is deleted
+        try:
+            os.rename(self.get_export_dir(key), os.path.join(self.trash_path, "%s.%s" % (key, uuid.uuid4().hex)))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                sys_logger.warning("Unable to remove export [%s]: %s" % (key, e))
+
+    def empty_trash(self):
+        """Delete the exports moved to the trash, and their copies held by the storage backend. The caller must not
+           hold the lock.
+        """
+        try:
+            names = os.listdir(self.trash_path)
+        except OSError:
+            return
+        for name in names:
+            key = name.rsplit(".", 1)[0]
+            try:
+                storage_backend.remove(key)
+            except Exception as e:
+                sys_logger.warning("Unable to remove export [%s] from storage backend: %s" % (key, e))
+            shutil.rmtree(os.path.join(self.trash_path, name), ignore_errors=True)
+
+    def discard(self, key, reason):
+        """Remove an export on behalf of another component, e.g. the export cache, along with its index entry.
+
+           The export is only moved to the trash, so the caller must call empty_trash() once it holds no locks.
+        """
+        with self.locked():
+            index = self.read_index()
+            self.remove(key, reason)
+            if index["exports"].pop(key, None) is not None:
+                self.write_index(index)
+
+    def sweep(self):
+        if not os.path.isdir(self.storage_path):
+            return
+        with self.locked():
+            index = self.read_index()
+            self.sweep_index(index)
+            self.write_index(index)
+        self.empty_trash()
+
+    def sweep_index(self, index):
+        """Apply the retention period and quotas to the exports in the index. The caller must hold the lock."""
+        now = time.time()
+        exports = index["exports"]
+        index["swept"] = now
+
+        # reconcile the index with the top level of the storage directory. Unindexed directories are exports which are
+        # in progress, failed, or predate the index, and are only subject to the retention period.
+        try:
+            keys = set([key for key in os.listdir(self.storage_path) if not key.startswith(".")])
+        except OSError:
+            keys = set()
+        for key in list(exports.keys()):
+            if key not in keys:
+                del exports[key]
+        for key in keys - set(exports.keys()):
+            export_dir = self.get_export_dir(key)
+            try:
+                if os.path.isdir(export_dir) and self.max_age and (now - os.path.getmtime(export_dir)) > self.max_age:
+                    self.remove(key, "unindexed export exceeded maximum age")
+            except OSError:
+                continue
+
+        lru = sorted([(self.get_last_access(key, entry), key, entry) for key, entry in exports.items()])
+
+        def evict(key, reason):
+            self.remove(key, reason)
+            del exports[key]
+
+        if self.max_age:
+            for last_access, key, entry in lru:
+                if (now - last_access) > self.max_age:
+                    evict(key, "not retrieved within maximum age")
+            lru = [item for item in lru if item[1] in exports]
+
+        if self.max_bytes_per_user:
+            user_bytes = dict()
+            for last_access, key, entry in lru:
+                user_bytes[entry["owner"]] = user_bytes.get(entry["owner"], 0) + entry["bytes"]
+            for last_access, key, entry in lru:
+                if user_bytes[entry["owner"]] > self.max_bytes_per_user:
+                    evict(key, "user [%s] exceeded storage quota" % entry["owner"])
+                    user_bytes[entry["owner"]] -= entry["bytes"]
+            lru = [item for item in lru if item[1] in exports]
+
+        if self.max_bytes:
+            total_bytes = sum([entry["bytes"] for last_access, key, entry in lru])
+            for last_access, key, entry in lru:
+                if total_bytes <= self.max_bytes:
+                    break
+                evict(key, "total storage quota exceeded")
+                total_bytes -= entry["bytes"]
+
+
+storage_quota_config = dict(DEFAULT_STORAGE_QUOTA_CONFIG)
+storage_quota_config.update(config.get("storage_quota", dict()))
+storage_manager = StorageManager(STORAGE_PATH,
+                                 storage_quota_config["max_age_hours"],
+                                 storage_quota_config["max_bytes"],
+                                 storage_quota_config["max_bytes_per_user"],
+                                 storage_quota_config["sweep_interval"])
+
+if __name__ == "__main__":
+    sys_logger.addHandler(logging.StreamHandler())
+    storage_manager.sweep()
@@ -0,0 +1,177 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Staged, resumable uploads of export inputs.
+
+   Large export inputs, such as the remote file manifest of a bag, are uploaded ahead of the export request, in one or
+   more chunks, and then referenced by the export configuration by upload ID. Each chunk gives its position in the
+   upload with a Content-Range header, so that after a dropped connection the client can ask for the current size of
+   the upload and resume from there. Once all of its bytes have been received an upload is complete, and can no longer
+   be modified.
+
+   Uploads are kept under the ".uploads" directory of the storage path, each in a directory holding its data file and
+   a small metadata file, and are removed once older than the configured maximum age.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import shutil
+from ioboxd.core import STORAGE_PATH, AUTHENTICATION, config, client_has_identity, copy_request_body, \
+    BadRequest, Forbidden, NotFound, Conflict, RequestEntityTooLarge, logger as sys_logger
+
+UPLOADS_PATH = os.path.abspath(os.path.join(STORAGE_PATH, ".uploads"))
+UPLOAD_DATA_FILE = "data"
+UPLOAD_METADATA_FILE = ".upload"
+CONTENT_RANGE = re.compile(r'^bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)$')
+
+DEFAULT_UPLOADS_CONFIG = {
+    "enabled": True,
+    "max_bytes": 1024 * 1024 * 1024,
+    "max_age_hours": 24
+}
+UPLOADS_CONFIG = dict(DEFAULT_UPLOADS_CONFIG)
+UPLOADS_CONFIG.update(config.get("uploads", dict()))
+
+
+def get_upload_dir(upload_id):
+    if not upload_id or upload_id.startswith(".") or "/" in upload_id:
+        raise NotFound("The upload %s does not exist." % upload_id)
+    return os.path.join(UPLOADS_PATH, upload_id)
+
+
+def read_upload(upload_id):
+    """Return the metadata of an upload, including its current size, checking that the client may access it."""
+    upload_dir = get_upload_dir(upload_id)
+    try:
+        with open(os.path.join(upload_dir, UPLOAD_METADATA_FILE), 'r') as metadata_file:
+            upload = json.load(metadata_file)
+        upload["size"] = os.path.getsize(os.path.join(upload_dir, UPLOAD_DATA_FILE))
+    except (IOError, OSError, ValueError):
+        raise NotFound("The upload %s does not exist. It was never created or has expired." % upload_id)
+    if AUTHENTICATION and not client_has_identity(upload["owner"]):
+        raise Forbidden("The currently authenticated user is not permitted to access the specified upload.")
+    return upload
+
+
+def write_upload_metadata(upload_id, upload):
+    upload_dir = get_upload_dir(upload_id)
+    metadata = dict([(k, v) for k, v in upload.items() if k != "size"])
+    temp_path = os.path.join(upload_dir, ".%s.%d" % (UPLOAD_METADATA_FILE, os.getpid()))
+    with open(temp_path, 'w') as metadata_file:
+        json.dump(metadata, metadata_file)
+    os.rename(temp_path, os.path.join(upload_dir, UPLOAD_METADATA_FILE))
+
+
+def sweep_uploads():
+    """Remove uploads older than the maximum age."""
+    if not UPLOADS_CONFIG["max_age_hours"] or not os.path.isdir(UPLOADS_PATH):
+        return
+    expiry = time.time() - UPLOADS_CONFIG["max_age_hours"] * 3600
+    for upload_id in os.listdir(UPLOADS_PATH):
+        upload_dir = os.path.join(UPLOADS_PATH, upload_id)
+        try:
+            if os.path.getmtime(upload_dir) < expiry:
+                sys_logger.info("Removing expired upload [%s]" % upload_id)
+                shutil.rmtree(upload_dir, ignore_errors=True)
+        except OSError:
+            continue
+
+
+def create_upload(owner, total=None):
+    """Create an empty upload of the given total size, if known, and return its ID and metadata."""
+    if not UPLOADS_CONFIG["enabled"]:
+        raise NotFound("Uploads are not enabled on this server.")
+    if total is not None and total > UPLOADS_CONFIG["max_bytes"]:
+        raise RequestEntityTooLarge("The upload may not exceed %d bytes." % UPLOADS_CONFIG["max_bytes"])
+    sweep_uploads()
+    upload_id = str(uuid.uuid4())
+    upload_dir = os.path.join(UPLOADS_PATH, upload_id)
+    os.makedirs(upload_dir)
+    open(os.path.join(upload_dir, UPLOAD_DATA_FILE), 'wb').close()
+    upload = dict(id=upload_id, owner=owner or "*", created=time.time(), total=total, complete=False)
+    write_upload_metadata(upload_id, upload)
+    upload["size"] = 0
+    return upload_id, upload
+
+
+def parse_content_range(header):
+    """Parse a Content-Range request header into (first, last, total), where each may be None."""
+    match = CONTENT_RANGE.match(header.strip())
+    if not match:
+        raise BadRequest("Invalid Content-Range header: %s" % header)
+    first, last, total = match.groups()
+    first = int(first) if first is not None else None
+    last = int(last) if last is not None else None
+    total = int(total) if total != "*" else None
+    if first is not None and last < first:
+        raise BadRequest("Invalid Content-Range header: %s" % header)
+    return first, last, total
+
+
+def write_upload_chunk(upload_id, content_range=None):
+    """Write the request body to an upload, at the position given by content_range, and return the upload metadata.
+
+       Without a content range, the body replaces the whole content of the upload and completes it. A chunk may start
+       at or before the current end of the upload (so that a retried chunk is harmless), but not past it.
+    """
+    upload = read_upload(upload_id)
+    upload_dir = get_upload_dir(upload_id)
+    if upload["complete"]:
+        raise Conflict("The upload %s is complete, and can no longer be modified." % upload_id)
+
+    if content_range:
+        first, last, total = parse_content_range(content_range)
+    else:
+        first, last, total = 0, None, None
+    if total is not None:
+        if upload["total"] is not None and total != upload["total"]:
+            raise Conflict("The upload %s has a total size of %d bytes." % (upload_id, upload["total"]))
+        if total > UPLOADS_CONFIG["max_bytes"]:
+            raise RequestEntityTooLarge("The upload may not exceed %d bytes." % UPLOADS_CONFIG["max_bytes"])
+        upload["total"] = total
+
+    with open(os.path.join(upload_dir, UPLOAD_DATA_FILE), 'r+b') as data_file:
+        fcntl.flock(data_file, fcntl.LOCK_EX)
+        size = os.fstat(data_file.fileno()).st_size
+        if first is not None:
+            if first > size:
+                raise Conflict("The upload %s has %d bytes, so the next chunk must start at or before byte %d."
+                               % (upload_id, size, size), headers={'Upload-Offset': str(size)})
+            data_file.seek(first)
+            if not content_range:
+                data_file.truncate()
+            max_bytes = UPLOADS_CONFIG["max_bytes"] - first
+            if last is not None:
+                max_bytes = min(max_bytes, last - first + 1)
+            nbytes = copy_request_body(data_file, max_bytes)
+            if last is not None and nbytes != last - first + 1:
+                raise BadRequest("The request body does not match its Content-Range.")
+            data_file.flush()
+        upload["size"] = os.fstat(data_file.fileno()).st_size
+
+    if upload["total"] is not None and upload["size"] > upload["total"]:
+        raise BadRequest("The upload exceeds its total size of %d bytes." % upload["total"])
+    if not content_range or (upload["total"] is not None and upload["size"] == upload["total"]):
+        upload["complete"] = True
+        upload["total"] = upload["size"]
+    write_upload_metadata(upload_id, upload)
+    return upload
+
+
+def delete_upload(upload_id):
+    read_upload(upload_id)
+    shutil.rmtree(get_upload_dir(upload_id), ignore_errors=True)
+
+
+def get_completed_upload_path(upload_id):
+    """Return the path of the data of a complete upload, for use as an export input."""
+    upload = read_upload(upload_id)
+    if not upload["complete"]:
+        raise Conflict("The upload %s is not complete." % upload_id)
+    return os.path.join(get_upload_dir(upload_id), UPLOAD_DATA_FILE)
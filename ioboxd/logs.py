@@ -0,0 +1,165 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Service logging.
+
+   Records of the "ioboxd" service logger, including the audit record of every request, are handed through a bounded
+   queue to a background writer thread, rather than being formatted and written to syslog on the request thread. The
+   writer formats and writes records in batches, flushing once per batch, so that a slow or congested syslog does not
+   delay requests. If the queue is full, records are dropped rather than blocking the request.
+
+   Audit records are logged as dictionaries, and serialized as JSON by the writer.
+
+   The log of each export is written by a single handler on the root logger, which routes each record to the log file
+   of the export running on the thread that logged it, if any. Concurrent exports therefore neither contend on a
+   shared handler nor write to each other's log files, and the logger configuration is never changed by an export.
+"""
+
+import copy
+import json
+import logging
+import threading
+import Queue
+from contextlib import contextmanager
+
+EXPORT_LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+class AuditFormatter(logging.Formatter):
+    """A formatter which serializes records whose message is a dictionary, such as request audit records, as JSON."""
+
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            record.msg = json.dumps(record.msg, separators=(', ', ':'))
+            record.args = None
+        return logging.Formatter.format(self, record)
+
+
+class QueueHandler(logging.Handler):
+    """A handler which passes records to a LogWriter, to be written on its thread."""
+
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    @staticmethod
+    def prepare(record):
+        # the record may be handled by other handlers meanwhile, and its arguments may be modified after the call to the
+        # logger returns, so a copy with its message merged (or, if it is to be serialized by the writer, copied) is
+        # queued
+        record = copy.copy(record)
+        if isinstance(record.msg, dict):
+            record.msg = copy.deepcopy(record.msg)
+        else:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.writer.enqueue(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(object):
+    """Writes queued records to a list of handlers on a background thread."""
+
+    def __init__(self, handlers, max_queued, batch_size, on_drop=None):
+        self.handlers = handlers
+        self.queue = Queue.Queue(max_queued)
+        self.batch_size = batch_size
+        self.on_drop = on_drop
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="ioboxd-log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            if self.on_drop:
+                self.on_drop()
+
+    def write(self, records):
+        for record in records:
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        for handler in self.handlers:
+            handler.flush()
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            self.write([record for record in records if record is not None])
+            if None in records:
+                return
+
+    def stop(self, timeout=5):
+        """Write the remaining queued records and stop the writer thread, e.g. as the process exits."""
+        if not self.thread or not self.thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        self.thread.join(timeout)
+
+
+class ExportLogRouter(logging.Handler):
+    """A handler which routes records to the log of the export running on the current thread, if any."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.local = threading.local()
+
+    def current(self):
+        """Return the export log bound to the current thread, or None."""
+        return getattr(self.local, "sink", None)
+
+    def handle(self, record):
+        # overridden so that records are only serialized per export log, rather than across all of them by the lock of
+        # this handler
+        sink = self.current()
+        if sink is not None and record.levelno >= sink.level:
+            sink.handle(record)
+        return sink is not None
+
+    def emit(self, record):
+        self.handle(record)
+
+    @contextmanager
+    def bound(self, sink):
+        """Route the records logged by the current thread to sink, e.g. on a thread working for an export."""
+        previous = self.current()
+        self.local.sink = sink
+        try:
+            yield sink
+        finally:
+            self.local.sink = previous
+
+    @contextmanager
+    def export_log(self, log_path, level=logging.INFO):
+        """Write the records logged by the current thread at or above level to the log file at log_path."""
+        sink = logging.FileHandler(log_path)
+        sink.setFormatter(AuditFormatter(EXPORT_LOG_FORMAT))
+        sink.setLevel(level)
+        try:
+            with self.bound(sink):
+                yield sink
+        finally:
+            sink.close()
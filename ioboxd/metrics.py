@@ -0,0 +1,211 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Service metrics.
+
+   Counters and histograms are accumulated in memory by each service process, and periodically written to a snapshot
+   file named for the process under a shared directory. Metrics are reported by merging the snapshots of all processes,
+   so that they are complete regardless of which process serves the request. Snapshots of processes which have exited
+   (e.g. recycled WSGI daemon processes) are folded into a single "retired" snapshot, so that counters remain monotonic.
+"""
+
+import os
+import json
+import time
+import errno
+import fcntl
+import threading
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0,
+                   1800.0, 3600.0]
+RETIRED_SNAPSHOT = "retired"
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class MetricsRegistry(object):
+
+    def __init__(self, snapshot_path=None, flush_interval=10, buckets=None):
+        self.snapshot_path = snapshot_path
+        self.flush_interval = flush_interval
+        self.buckets = buckets or DEFAULT_BUCKETS
+        self.counters = dict()
+        self.histograms = dict()
+        self.last_flush = 0
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(
+                buckets=self.buckets,
+                counters=[[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                histograms=[[name, list(labels), list(h[0]), h[1], h[2]]
+                            for (name, labels), h in self.histograms.items()])
+
+    @staticmethod
+    def merge(target, snapshot):
+        """Merge a snapshot into target, a pair of (counters, histograms) dictionaries."""
+        counters, histograms = target
+        for name, labels, value in snapshot.get("counters", []):
+            key = (name, tuple([tuple(label) for label in labels]))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, bucket_counts, total, count in snapshot.get("histograms", []):
+            key = (name, tuple([tuple(label) for label in labels]))
+            histogram = histograms.setdefault(key, [[0] * len(bucket_counts), 0.0, 0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], bucket_counts)]
+            histogram[1] += total
+            histogram[2] += count
+
+    @contextmanager
+    def locked_snapshots(self):
+        if not os.path.isdir(self.snapshot_path):
+            try:
+                os.makedirs(self.snapshot_path)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+        with open(os.path.join(self.snapshot_path, ".lock"), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_snapshot(self, name):
+        try:
+            with open(os.path.join(self.snapshot_path, "%s.json" % name), 'r') as snapshot_file:
+                return json.load(snapshot_file)
+        except (IOError, ValueError):
+            return dict()
+
+    def write_snapshot(self, name, snapshot):
+        temp_path = os.path.join(self.snapshot_path, ".%s.%d" % (name, os.getpid()))
+        with open(temp_path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.rename(temp_path, os.path.join(self.snapshot_path, "%s.json" % name))
+
+    def flush(self, force=False):
+        """Write this process's snapshot, if the flush interval has elapsed since the last write."""
+        if not self.snapshot_path:
+            return
+        now = time.time()
+        if not force and (now - self.last_flush) < self.flush_interval:
+            return
+        self.last_flush = now
+        with self.locked_snapshots():
+            self.write_snapshot(str(os.getpid()), self.snapshot())
+
+    def collect(self):
+        """Return the merged (counters, histograms) of all service processes, retiring snapshots of exited ones."""
+        target = (dict(), dict())
+        if not self.snapshot_path:
+            self.merge(target, self.snapshot())
+            return target
+
+        with self.locked_snapshots():
+            self.write_snapshot(str(os.getpid()), self.snapshot())
+            retired = self.read_snapshot(RETIRED_SNAPSHOT)
+            retired_target = (dict(), dict())
+            self.merge(retired_target, retired)
+            retiring = False
+            for filename in os.listdir(self.snapshot_path):
+                name, ext = os.path.splitext(filename)
+                if ext != ".json" or not name.isdigit():
+                    continue
+                snapshot = self.read_snapshot(name)
+                if process_exists(int(name)):
+                    self.merge(target, snapshot)
+                else:
+                    self.merge(retired_target, snapshot)
+                    os.remove(os.path.join(self.snapshot_path, filename))
+                    retiring = True
+            if retiring:
+                counters, histograms = retired_target
+                self.write_snapshot(RETIRED_SNAPSHOT, dict(
+                    buckets=self.buckets,
+                    counters=[[name, list(labels), value] for (name, labels), value in counters.items()],
+                    histograms=[[name, list(labels), h[0], h[1], h[2]] for (name, labels), h in histograms.items()]))
+            self.merge(target, dict(
+                counters=[[name, labels, value] for (name, labels), value in retired_target[0].items()],
+                histograms=[[name, labels, h[0], h[1], h[2]] for (name, labels), h in retired_target[1].items()]))
+        return target
+
+    def render(self):
+        """Render the merged metrics of all service processes in the Prometheus text exposition format."""
+        counters, histograms = self.collect()
+        lines = list()
+
+        def format_labels(labels, extra=None):
+            labels = list(labels) + (extra or [])
+            if not labels:
+                return ''
+            return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                                                   .replace('\n', '\\n')) for k, v in labels])
+
+        for metric in sorted(set([name for name, labels in counters.keys()])):
+            lines.append('# TYPE %s counter' % metric)
+            for (name, labels), value in sorted(counters.items()):
+                if name == metric:
+                    lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+        for metric in sorted(set([name for name, labels in histograms.keys()])):
+            lines.append('# TYPE %s histogram' % metric)
+            for (name, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+                if name != metric:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', repr(bound))]), cumulative))
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', '+Inf')]), count))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), repr(total)))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def timed(registry, timings, phase, metric="ioboxd_export_phase_seconds"):
+    """Time the enclosed block, adding the elapsed seconds to timings[phase] and observing it in the registry.
+
+       Phases of the form "name:detail" are accumulated separately in timings, but observed under "name".
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        if timings is not None:
+            timings[phase] = round(timings.get(phase, 0) + elapsed, 6)
+        registry.observe(metric, elapsed, phase=phase.split(":", 1)[0])
@@ -0,0 +1,22 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+import web
+from ioboxd.core import web_method, RestHandler, metrics
+
+
+class ServiceMetrics (RestHandler):
+
+    def __init__(self):
+        RestHandler.__init__(self)
+
+    @web_method()
+    def GET(self):
+        body = metrics.render()
+        web.ctx.status = '200 OK'
+        web.ctx.ioboxd_content_type = 'text/plain; version=0.0.4'
+        web.header('Content-Type', web.ctx.ioboxd_content_type)
+        web.header('Content-Length', len(body))
+        return body if self.get_body else ''
@@ -0,0 +1,44 @@
+#
+# Copyright 2016 University of Southern California
+# Distributed under the Apache License, Version 2.0. See LICENSE for more info.
+#
+
+"""Service process startup.
+
+   WSGI daemon processes are recycled after a number of requests (see "maximum-requests" in wsgi_ioboxd.conf), and
+   each new process must load the service before it can serve a request. The WSGI script is therefore preloaded with
+   WSGIImportScript as each daemon process starts, before it accepts requests, and the export stack, which is
+   otherwise only imported by the first export a process runs, is warmed up at the same time.
+
+   The time taken by both steps is reported as the "ioboxd_startup_seconds" metric.
+"""
+
+import time
+import mimetypes
+from ioboxd.core import config, metrics, logger as sys_logger
+
+WARM_UP = config.get("warm_up", True)
+
+
+def warm_up():
+    """Load the state which would otherwise be loaded by the first export of this process."""
+    from ioboxd.export.api import load_downloader
+    from ioboxd.export.archive import get_worker_pool
+    load_downloader()
+    get_worker_pool()
+    mimetypes.init()
+
+
+def process_started(start_time):
+    """Record the time taken to load the service since start_time, then warm up if configured to."""
+    load_seconds = time.time() - start_time
+    metrics.observe("ioboxd_startup_seconds", load_seconds, phase="load")
+    warm_up_seconds = 0
+    if WARM_UP:
+        start = time.time()
+        warm_up()
+        warm_up_seconds = time.time() - start
+        metrics.observe("ioboxd_startup_seconds", warm_up_seconds, phase="warm_up")
+    sys_logger.info("Service process started: loaded in %.3f seconds, warmed up in %.3f seconds" %
+                    (load_seconds, warm_up_seconds))
+    metrics.flush(force=True)